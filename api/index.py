@@ -1,13 +1,46 @@
-from flask import Flask, request, jsonify, render_template, Response, url_for, redirect
+from flask import Flask, request, jsonify, render_template, Response, url_for, redirect, g, has_request_context
 import requests
+import click
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import json
 import base64
 import random
 import time
+import hashlib
+import threading
+import gzip
+import io
+import atexit
+import contextvars
+import sqlite3
+import bisect
+import shutil
+import tempfile
 from functools import wraps
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from werkzeug.datastructures import FileStorage
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
-from urllib.parse import quote
+from urllib.parse import quote, unquote, urlsplit
+from email.utils import formatdate, format_datetime
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows 本地开发：没有文件锁，写入日志不做单实例保护
+    fcntl = None
+
+try:
+    import brotli  # 可选：安装后 /icons*.json 支持 br 压缩
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image, ImageOps  # 可选：安装 Pillow 后才能启用 IMAGE_OPTIMIZE
+except ImportError:
+    Image = ImageOps = None
 
 app = Flask(__name__,
             static_folder=os.path.join(os.path.dirname(__file__), '../static'),
@@ -105,45 +138,338 @@ if os.getenv("UPLOAD_SERVICE", "").upper() == "GITHUB":
 if os.getenv("UPLOAD_SERVICE", "").upper() == "PICUI" and not PICUI_TOKEN:
     print("警告：UPLOAD_SERVICE=PICUI 但 PICUI_TOKEN 未配置，PICUI 上传将全部失败（强制 Token 模式）")
 
+# ===== 出站 HTTP：每个上游一个长连接 Session（连接池 + 429/5xx 重试）=====
+# Session 放在模块级，Serverless 热启动时复用 TCP/TLS 连接
+HTTP_POOL_SIZE = int((os.getenv("HTTP_POOL_SIZE", "10") or "10").strip())
+HTTP_MAX_RETRIES = int((os.getenv("HTTP_MAX_RETRIES", "2") or "2").strip())
+HTTP_BACKOFF_FACTOR = float((os.getenv("HTTP_BACKOFF_FACTOR", "0.5") or "0.5").strip())
+HTTP_RETRY_AFTER_MAX = float((os.getenv("HTTP_RETRY_AFTER_MAX", "10") or "10").strip())
+
+# 各上游默认超时（秒），可用 HTTP_TIMEOUT_<BACKEND> 覆盖，例如 HTTP_TIMEOUT_PICUI=20
+HTTP_TIMEOUT_DEFAULTS = {
+    "github": 30,
+    "picui": 30,
+    "picgo": 30,
+    "imgurl": 30,
+    "clipdrop": 60,
+    "removebg": 60,
+    "custom_ai": 90,
+}
+
+# ===== 指标：每个上游的耗时直方图 / 状态码计数 / 重试次数 =====
+# GET /metrics 输出 Prometheus 文本格式（设置 METRICS_TOKEN 后需要 Authorization: Bearer <token>）；
+# 每个响应带 Server-Timing 头，列出本次请求在各上游花费的时间。
+METRICS_TOKEN = (os.getenv("METRICS_TOKEN", "") or "").strip()
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# 当前请求的 {上游: [总耗时秒, 次数]}；线程池通过 ContextThreadPoolExecutor 继承
+_server_timings = contextvars.ContextVar("server_timings", default=None)
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """提交任务时复制当前 contextvars，使工作线程里的出站请求也计入本次请求的 Server-Timing"""
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+class UpstreamMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {}  # (upstream, target, method) -> [各桶计数..., +Inf 计数, 总耗时]
+        self.requests = {}  # (upstream, target, method, status) -> 次数
+        self.retries = {}  # upstream -> 次数
+
+    def observe(self, upstream, target, method, status, seconds):
+        key = (upstream, target, method)
+        with self._lock:
+            hist = self.latency.get(key)
+            if hist is None:
+                hist = self.latency[key] = [0] * (len(METRICS_LATENCY_BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(METRICS_LATENCY_BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[len(METRICS_LATENCY_BUCKETS)] += 1
+            hist[-1] += seconds
+            rkey = key + (status,)
+            self.requests[rkey] = self.requests.get(rkey, 0) + 1
+        timings = _server_timings.get()
+        if timings is not None:
+            entry = timings.setdefault(upstream, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    def retry(self, upstream):
+        with self._lock:
+            self.retries[upstream] = self.retries.get(upstream, 0) + 1
+
+    def render(self):
+        def labels(**kv):
+            return ",".join(
+                f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in kv.items()
+            )
+
+        with self._lock:
+            latency = {k: list(v) for k, v in self.latency.items()}
+            requests_total = dict(self.requests)
+            retries = dict(self.retries)
+
+        lines = [
+            "# HELP tubiaoku_upstream_request_duration_seconds Outbound request latency per upstream.",
+            "# TYPE tubiaoku_upstream_request_duration_seconds histogram",
+        ]
+        for (upstream, target, method), hist in sorted(latency.items()):
+            base = labels(upstream=upstream, target=target, method=method)
+            for bound, count in zip(METRICS_LATENCY_BUCKETS, hist):
+                lines.append(f'tubiaoku_upstream_request_duration_seconds_bucket{{{base},le="{bound}"}} {count}')
+            total = hist[len(METRICS_LATENCY_BUCKETS)]
+            lines.append(f'tubiaoku_upstream_request_duration_seconds_bucket{{{base},le="+Inf"}} {total}')
+            lines.append(f"tubiaoku_upstream_request_duration_seconds_sum{{{base}}} {hist[-1]:.6f}")
+            lines.append(f"tubiaoku_upstream_request_duration_seconds_count{{{base}}} {total}")
+        lines += [
+            "# HELP tubiaoku_upstream_requests_total Outbound requests by status code (error = no response).",
+            "# TYPE tubiaoku_upstream_requests_total counter",
+        ]
+        for (upstream, target, method, status), count in sorted(requests_total.items()):
+            lines.append(
+                f"tubiaoku_upstream_requests_total{{{labels(upstream=upstream, target=target, method=method, status=status)}}} {count}"
+            )
+        lines += [
+            "# HELP tubiaoku_upstream_retries_total Automatic retries performed by the HTTP adapter.",
+            "# TYPE tubiaoku_upstream_retries_total counter",
+        ]
+        for upstream, count in sorted(retries.items()):
+            lines.append(f"tubiaoku_upstream_retries_total{{{labels(upstream=upstream)}}} {count}")
+        return "\n".join(lines) + "\n"
+
+upstream_metrics = UpstreamMetrics()
+
+def _metrics_target(url):
+    """指标里的目标：主机名；api.github.com 再区分 gists / repos"""
+    parts = urlsplit(url or "")
+    host = parts.netloc or "unknown"
+    if host == "api.github.com":
+        segment = parts.path.strip("/").split("/", 1)[0]
+        return f"{host}/{segment}" if segment else host
+    return host
+
+class InstrumentedSession(requests.Session):
+    """记录每次出站请求（含重试与响应体下载）的总耗时与最终状态码"""
+
+    def __init__(self, upstream):
+        super().__init__()
+        self.upstream = upstream
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            r = super().request(method, url, *args, **kwargs)
+            status = str(r.status_code)
+            return r
+        finally:
+            upstream_metrics.observe(self.upstream, _metrics_target(url), method.upper(), status, time.perf_counter() - start)
+
+_NON_IDEMPOTENT_METHODS = frozenset({"POST", "PUT", "PATCH"})
+
+class _UpstreamRetry(Retry):
+    """
+    幂等请求遇到 429/5xx、读超时重试；写请求（POST 上传/抠图、PATCH Gist、PUT 仓库文件）只在 429 时重试：
+    5xx / 读超时时服务端可能已经执行，重发会重复上传、重复提交或被当成并发冲突。连接失败（请求没发出去）对所有方法都重试
+    """
+
+    def __init__(self, *args, upstream=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upstream = upstream
+
+    def new(self, **kw):
+        other = super().new(**kw)
+        other.upstream = self.upstream
+        return other
+
+    def increment(self, *args, **kwargs):
+        # 超过次数时 super() 会抛 MaxRetryError，那一次不算重试
+        other = super().increment(*args, **kwargs)
+        upstream_metrics.retry(self.upstream or "unknown")
+        return other
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if (method or "").upper() in _NON_IDEMPOTENT_METHODS:
+            return bool(self.total) and status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, HTTP_RETRY_AFTER_MAX)
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def http_session(backend: str):
+    """按上游名称返回共享的 requests.Session"""
+    with _http_sessions_lock:
+        session = _http_sessions.get(backend)
+        if session is not None:
+            return session
+
+        retry = _UpstreamRetry(
+            total=HTTP_MAX_RETRIES,
+            connect=HTTP_MAX_RETRIES,
+            read=HTTP_MAX_RETRIES,
+            status=HTTP_MAX_RETRIES,
+            backoff_factor=HTTP_BACKOFF_FACTOR,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # 读超时只重试幂等方法（urllib3 按 allowed_methods 判断）；写请求的 429 见 is_retry
+            allowed_methods=frozenset({"GET", "HEAD", "DELETE", "OPTIONS"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+            upstream=backend,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+        session = InstrumentedSession(backend)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _http_sessions[backend] = session
+        return session
+
+def http_timeout(backend: str):
+    raw = (os.getenv(f"HTTP_TIMEOUT_{backend.upper()}", "") or "").strip()
+    try:
+        return float(raw) if raw else HTTP_TIMEOUT_DEFAULTS.get(backend, 30)
+    except ValueError:
+        return HTTP_TIMEOUT_DEFAULTS.get(backend, 30)
+
+@app.before_request
+def _start_server_timing():
+    g.request_started_at = time.perf_counter()
+    g.server_timings_token = _server_timings.set({})
+
+@app.after_request
+def _add_server_timing(resp):
+    timings = _server_timings.get()
+    started = g.get("request_started_at")
+    if timings is None or started is None:
+        return resp
+    parts = [
+        f'{name};dur={seconds * 1000:.1f};desc="{count} call{"s" if count != 1 else ""}"'
+        for name, (seconds, count) in sorted(timings.items())
+    ]
+    parts.append(f"total;dur={(time.perf_counter() - started) * 1000:.1f}")
+    resp.headers["Server-Timing"] = ", ".join(parts)
+    return resp
+
+@app.teardown_request
+def _reset_server_timing(exc=None):
+    token = g.pop("server_timings_token", None)
+    if token is not None:
+        _server_timings.reset(token)
+
+@app.get("/metrics")
+def metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization", "") != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"error": "未授权"}), 401
+    body = upstream_metrics.render()
+    store = catalog_store()
+    if isinstance(store, JournaledCatalogStore):
+        body += store.render_metrics()
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
 # ===== Gist 读取/更新工具函数 =====
 
-def get_gist_data():
-    headers = {
+# /icons*.json 订阅缓存：TTL 内直接返回内存中已序列化好的 bytes；
+# 过期后带 If-None-Match 回源，GitHub 返回 304 时不消耗 rate limit，直接续期
+ICONS_CACHE_TTL = float((os.getenv("ICONS_CACHE_TTL", "60") or "60").strip())
+
+_gist_lock = threading.Lock()
+_gist_state = {"etag": None, "last_modified": None, "data": None, "snapshot": None}
+_icons_cache = {}  # file_name -> {"body", "etag", "last_modified", "token", "expires_at"}
+
+def _gist_headers():
+    return {
         "Authorization": f"Bearer {GITHUB_TOKEN}",
         "Accept": "application/vnd.github.v3+json",
     }
-    r = requests.get(f"https://api.github.com/gists/{GIST_ID}", headers=headers, timeout=30)
+
+def get_gist_data():
+    """读取整个 Gist；带上次的 ETag 做条件请求，未变化（304）时复用上次结果"""
+    headers = _gist_headers()
+    with _gist_lock:
+        etag = _gist_state["etag"]
+        cached = _gist_state["data"]
+    if etag and cached is not None:
+        headers["If-None-Match"] = etag
+
+    r = http_session("github").get(f"https://api.github.com/gists/{GIST_ID}", headers=headers, timeout=http_timeout("github"))
+    if r.status_code == 304 and cached is not None:
+        return cached
     r.raise_for_status()
-    return r.json()
+    data = r.json()
+
+    with _gist_lock:
+        _gist_state["etag"] = r.headers.get("ETag")
+        _gist_state["last_modified"] = r.headers.get("Last-Modified")
+        _gist_state["data"] = data
+    return data
+
+def _invalidate_gist_cache(file_name=None):
+    with _gist_lock:
+        _gist_state["etag"] = None
+        _gist_state["last_modified"] = None
+        _gist_state["data"] = None
+        _gist_state["snapshot"] = None
+        if file_name:
+            _icons_cache.pop(file_name, None)
+        else:
+            _icons_cache.clear()
+
+def update_gist_files(files, file_name=GIST_FILE_NAME):
+    """
+    一次 PATCH 更新多个 Gist 文件
+    files: {Gist 文件名: 文本内容}（内容为 None 表示删除该文件）
+    file_name: 这些文件所属的逻辑目录名（用于失效 /icons*.json 缓存）
+    """
+    headers = _gist_headers()
+    file_name = (file_name or GIST_FILE_NAME or "icons.json").strip()
+    data = {"files": {name: ({"content": text} if text is not None else None) for name, text in files.items()}}
+    response = http_session("github").patch(f"https://api.github.com/gists/{GIST_ID}", json=data, headers=headers, timeout=http_timeout("github"))
+    if response.status_code != 200:
+        raise Exception(f"更新 Gist 失败：{response.text}")
+    gist = response.json()
+    _invalidate_gist_cache(file_name)
+    # PATCH 的响应就是更新后的完整 Gist，直接作为新快照（带上它的 ETag），后续读取用条件请求确认即可
+    _set_gist_snapshot(GistSnapshot(gist), etag=response.headers.get("ETag"))
+    return gist
 
 def update_gist_data(content, file_name=GIST_FILE_NAME):
     """更新 Gist 数据（替换整个文件内容）"""
-    headers = {
-        "Authorization": f"Bearer {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json",
-    }
     file_name = (file_name or GIST_FILE_NAME or "icons.json").strip()
-    data = {"files": {file_name: {"content": json.dumps(content, ensure_ascii=False, indent=2)}}}
-    response = requests.patch(f"https://api.github.com/gists/{GIST_ID}", json=data, headers=headers, timeout=30)
-    if response.status_code != 200:
-        raise Exception(f"更新 Gist 失败：{response.text}")
-    return response.json()
+    return update_gist_files({file_name: json.dumps(content, ensure_ascii=False, indent=2)}, file_name=file_name)
 
-def _update_gist_with_retry(content, file_name=GIST_FILE_NAME, max_retry=3):
-    """对 Gist PATCH 做指数退避重试，缓解偶发失败/流控"""
-    last_err = None
-    for i in range(max_retry):
-        try:
-            return update_gist_data(content, file_name=file_name)
-        except Exception as e:
-            last_err = e
-            time.sleep(2 ** i)  # 1s,2s,4s
-    raise last_err
+# ===== Gist 分片存储：一个逻辑目录 = manifest + 多个分片文件 =====
+# Gist API 对 >1MB 的文件会截断 content（truncated=true），所以 icons 超过 GIST_SHARD_MAX_ICONS 条后
+# 新条目写入新的分片文件（icons.2.json, icons.3.json...），分片列表记在 icons.manifest.json。
+# - 第一个分片就是原来的 icons.json（保留 name/description 等元数据），未分片的旧数据无需迁移
+# - 追加只改最后一个分片；删除只改命中的分片；同一次 PATCH 提交
+# - 被截断的文件通过 raw_url 并发拉取
+# - /icons*.json 仍返回合并后的完整文档
+GIST_SHARD_MAX_ICONS = int((os.getenv("GIST_SHARD_MAX_ICONS", "5000") or "5000").strip())
 
-def _read_icons_json_from_gist(file_name=GIST_FILE_NAME):
-    gist = get_gist_data()
-    file_name = (file_name or GIST_FILE_NAME or "icons.json").strip()
-    icons_raw = gist.get("files", {}).get(file_name, {}).get("content", "{}")
+def _gist_file_stem(file_name):
+    return file_name[:-len(".json")] if file_name.endswith(".json") else file_name
+
+def _gist_manifest_name(file_name):
+    return f"{_gist_file_stem(file_name)}.manifest.json"
+
+def _gist_shard_name(file_name, n):
+    return file_name if n <= 1 else f"{_gist_file_stem(file_name)}.{n}.json"
+
+def _gist_hashes_name(file_name):
+    return f"{_gist_file_stem(file_name)}.hashes.json"
+
+def _gist_changes_name(file_name):
+    return f"{_gist_file_stem(file_name)}.changes.json"
+
+def _parse_icons_json(icons_raw):
     content = json.loads(icons_raw) if isinstance(icons_raw, str) else icons_raw
     if not isinstance(content, dict):
         content = {}
@@ -151,17 +477,524 @@ def _read_icons_json_from_gist(file_name=GIST_FILE_NAME):
         content["icons"] = []
     return content
 
+def _fetch_gist_raw(raw_url):
+    r = http_session("github").get(raw_url, timeout=http_timeout("github"))
+    r.raise_for_status()
+    return r.content.decode("utf-8")
+
+def _gist_file_texts(files, names):
+    """取出若干 Gist 文件的完整文本；被截断的文件并发走 raw_url"""
+    texts = {}
+    truncated = {}
+    for name in names:
+        f = files.get(name) or {}
+        if (f.get("truncated") or f.get("content") is None) and f.get("raw_url"):
+            truncated[name] = f["raw_url"]
+        else:
+            texts[name] = f.get("content", "{}")
+    if truncated:
+        with ContextThreadPoolExecutor(max_workers=min(8, len(truncated))) as pool:
+            futures = {name: pool.submit(_fetch_gist_raw, url) for name, url in truncated.items()}
+            for name, fut in futures.items():
+                texts[name] = fut.result()
+    return texts
+
+def _load_icons_catalog_doc(gist, file_name=GIST_FILE_NAME):
+    """读取一个逻辑目录，返回 (合并后的文档, 分片列表 [[分片文件名, 条数], ...])"""
+    file_name = (file_name or GIST_FILE_NAME or "icons.json").strip()
+    files = gist.get("files", {}) or {}
+
+    shards = [file_name]
+    manifest_file = files.get(_gist_manifest_name(file_name))
+    if manifest_file:
+        manifest = _parse_icons_json(_gist_file_texts(files, [_gist_manifest_name(file_name)])[_gist_manifest_name(file_name)])
+        if isinstance(manifest.get("shards"), list) and manifest["shards"]:
+            shards = [str(x) for x in manifest["shards"]]
+
+    texts = _gist_file_texts(files, shards)
+    content = None
+    segments = []
+    for name in shards:
+        doc = _parse_icons_json(texts.get(name, "{}"))
+        if content is None:
+            content = {**doc, "icons": list(doc["icons"])}
+        else:
+            content["icons"].extend(doc["icons"])
+        segments.append([name, len(doc["icons"])])
+    return content, segments
+
+def _load_icons_hash_index(gist, file_name=GIST_FILE_NAME):
+    """读取内容哈希索引 {sha256: url}（见 UPLOAD_DEDUP）"""
+    hashes_name = _gist_hashes_name((file_name or GIST_FILE_NAME or "icons.json").strip())
+    files = gist.get("files", {}) or {}
+    if hashes_name not in files:
+        return {}
+    doc = _parse_icons_json(_gist_file_texts(files, [hashes_name])[hashes_name])
+    hashes = doc.get("sha256")
+    return dict(hashes) if isinstance(hashes, dict) else {}
+
+# ===== 增量同步：变更日志（<目录>.changes.json）=====
+# 每次写入（追加/删除）记一条 {"seq", "at", "added", "removed"}，seq 单调递增即目录版本号（游标）。
+# 只保留最近 ICONS_CHANGELOG_MAX 条；base = 已被压缩掉的最大 seq，游标早于 base 的客户端需重新全量拉取。
+ICONS_CHANGELOG_MAX = int((os.getenv("ICONS_CHANGELOG_MAX", "500") or "500").strip())
+
+def _load_icons_change_log(gist, file_name=GIST_FILE_NAME):
+    """读取变更日志 {"seq": 当前版本, "base": 最早可追溯版本, "changes": [...]}"""
+    changes_name = _gist_changes_name((file_name or GIST_FILE_NAME or "icons.json").strip())
+    files = gist.get("files", {}) or {}
+    log = {"seq": 0, "base": 0, "changes": []}
+    if changes_name not in files:
+        return log
+    doc = _parse_icons_json(_gist_file_texts(files, [changes_name])[changes_name])
+    try:
+        log["seq"] = int(doc.get("seq") or 0)
+        log["base"] = int(doc.get("base") or 0)
+    except (TypeError, ValueError):
+        return {"seq": 0, "base": 0, "changes": []}
+    if isinstance(doc.get("changes"), list):
+        log["changes"] = [c for c in doc["changes"] if isinstance(c, dict)]
+    return log
+
+def icons_changes_since(log, since: int):
+    """
+    合并 since 之后的变更。客户端应先删 removed、再按 url 追加/覆盖 added。
+    游标早于 base（日志已压缩）或晚于当前版本时返回 full=True，需要重新拉取完整 JSON。
+    """
+    if since < log["base"] or since > log["seq"]:
+        return {"since": since, "cursor": log["seq"], "full": True}
+    added = {}
+    removed = []
+    removed_set = set()
+    for change in log["changes"]:
+        if int(change.get("seq") or 0) <= since:
+            continue
+        for url in change.get("removed") or ():
+            added.pop(url, None)
+            if url not in removed_set:
+                removed_set.add(url)
+                removed.append(url)
+        for icon in change.get("added") or ():
+            added[icon.get("url")] = icon
+    return {"since": since, "cursor": log["seq"], "full": False, "added": list(added.values()), "removed": removed}
+
+class IconCatalog:
+    """
+    某个 Gist 文件 icons 列表的内存索引：
+    - names：名称 -> 出现次数（O(1) 判重）
+    - _next_suffix：基础名 -> 下一个候选序号（已确认更小的序号都被占用）
+    - by_url：URL -> 条目（O(1) 查询）
+    - hashes：图片内容 sha256 -> URL（上传去重）
+    - changes：变更日志（增量同步）
+    """
+
+    def __init__(self, content, segments=None, file_name=GIST_FILE_NAME, hashes=None, changes=None):
+        self.content = content
+        self.icons = content.setdefault("icons", [])
+        self.file_name = file_name
+        # 分片：[[分片文件名, 条数], ...]，按顺序拼起来就是 icons；dirty 记录需要写回的分片
+        self.segments = [list(seg) for seg in segments] if segments else [[file_name, len(self.icons)]]
+        self.dirty = set()
+        self.manifest_dirty = False
+        self.hashes = dict(hashes or {})
+        self._hash_by_url = {url: h for h, url in self.hashes.items()}
+        self.hashes_dirty = False
+        changes = changes or {"seq": 0, "base": 0, "changes": []}
+        self.changes = {**changes, "changes": list(changes["changes"])}
+        self.changes_dirty = False
+        self.names = {}
+        self.by_url = {}
+        self._next_suffix = {}
+        for icon in self.icons:
+            self._index(icon)
+
+    def _index(self, icon):
+        name = icon.get("name")
+        self.names[name] = self.names.get(name, 0) + 1
+        url = icon.get("url")
+        if url and url not in self.by_url:
+            self.by_url[url] = icon
+
+    def copy(self):
+        """复制索引与列表（条目本身共享），用于在不影响快照的前提下修改"""
+        other = IconCatalog.__new__(IconCatalog)
+        other.content = {**self.content, "icons": list(self.icons)}
+        other.icons = other.content["icons"]
+        other.file_name = self.file_name
+        other.segments = [list(seg) for seg in self.segments]
+        other.dirty = set(self.dirty)
+        other.manifest_dirty = self.manifest_dirty
+        other.hashes = dict(self.hashes)
+        other._hash_by_url = dict(self._hash_by_url)
+        other.hashes_dirty = self.hashes_dirty
+        other.changes = {**self.changes, "changes": list(self.changes["changes"])}
+        other.changes_dirty = self.changes_dirty
+        other.names = dict(self.names)
+        other.by_url = dict(self.by_url)
+        other._next_suffix = dict(self._next_suffix)
+        return other
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def unique_name(self, name):
+        """与旧逻辑一致：name 未占用则原样返回，否则取最小的未占用序号 name1, name2..."""
+        if name not in self.names:
+            return name
+        counter = self._next_suffix.get(name, 1)
+        while f"{name}{counter}" in self.names:
+            counter += 1
+        self._next_suffix[name] = counter + 1
+        return f"{name}{counter}"
+
+    def reserve(self, name):
+        """只占用名称（不写入列表），用于上传前预分配"""
+        self.names[name] = self.names.get(name, 0) + 1
+
+    def append(self, name, url, backend=None):
+        """去重后追加一条（写入最后一个分片，满了就新开分片），返回最终条目"""
+        icon = {"name": self.unique_name(name), "url": url}
+        if backend:
+            icon["backend"] = backend
+        if GIST_SHARD_MAX_ICONS > 0 and self.segments[-1][1] >= GIST_SHARD_MAX_ICONS:
+            self.segments.append([_gist_shard_name(self.file_name, len(self.segments) + 1), 0])
+            self.manifest_dirty = True
+        self.segments[-1][1] += 1
+        self.dirty.add(self.segments[-1][0])
+        self.icons.append(icon)
+        self._index(icon)
+        return icon
+
+    def set_hash(self, sha256, url):
+        if sha256 and url and self.hashes.get(sha256) != url:
+            self.hashes[sha256] = url
+            self._hash_by_url[url] = sha256
+            self.hashes_dirty = True
+
+    def record_change(self, added, removed):
+        """记一条变更（added: 新条目列表，removed: 被删除的 URL 列表），超出上限时压缩最早的记录"""
+        if not added and not removed:
+            return
+        log = self.changes
+        log["seq"] += 1
+        log["changes"].append({
+            "seq": log["seq"],
+            "at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "added": [dict(icon) for icon in added],
+            "removed": list(removed),
+        })
+        overflow = len(log["changes"]) - max(1, ICONS_CHANGELOG_MAX)
+        if overflow > 0:
+            log["base"] = log["changes"][overflow - 1]["seq"]
+            del log["changes"][:overflow]
+        self.changes_dirty = True
+
+    def remove_urls(self, urls):
+        """移除 url 命中的全部条目，返回移除数量"""
+        urls = set(u for u in (urls or ()) if u)
+        if not urls or not any(u in self.by_url for u in urls):
+            return 0
+        kept = []
+        removed = 0
+        seg_idx = 0
+        seg_end = self.segments[0][1]
+        for pos, icon in enumerate(self.icons):
+            while pos >= seg_end and seg_idx + 1 < len(self.segments):
+                seg_idx += 1
+                seg_end += self.segments[seg_idx][1]
+            if icon.get("url") in urls:
+                removed += 1
+                self.segments[seg_idx][1] -= 1
+                self.dirty.add(self.segments[seg_idx][0])
+                name = icon.get("name")
+                left = self.names.get(name, 0) - 1
+                if left > 0:
+                    self.names[name] = left
+                else:
+                    self.names.pop(name, None)
+            else:
+                kept.append(icon)
+        self.icons[:] = kept
+        for url in urls:
+            self.by_url.pop(url, None)
+            sha256 = self._hash_by_url.pop(url, None)
+            if sha256 and self.hashes.get(sha256) == url:
+                del self.hashes[sha256]
+                self.hashes_dirty = True
+        # 删除可能空出更小的序号，清空提示以保持“取最小未占用序号”的语义
+        self._next_suffix.clear()
+        return removed
+
+    def pending_files(self):
+        """需要写回的 Gist 文件：{文件名: 文本内容}（只包含改动过的分片 + manifest）"""
+        files = {}
+        meta = {k: v for k, v in self.content.items() if k != "icons"}
+        offset = 0
+        for i, (name, count) in enumerate(self.segments):
+            if name in self.dirty:
+                doc = {**meta} if i == 0 else {}
+                doc["icons"] = self.icons[offset:offset + count]
+                files[name] = json.dumps(doc, ensure_ascii=False, indent=2)
+            offset += count
+        if self.manifest_dirty:
+            manifest = {"shards": [name for name, _ in self.segments]}
+            files[_gist_manifest_name(self.file_name)] = json.dumps(manifest, ensure_ascii=False, indent=2)
+        if self.hashes_dirty:
+            files[_gist_hashes_name(self.file_name)] = json.dumps({"sha256": self.hashes}, ensure_ascii=False, indent=2)
+        if self.changes_dirty:
+            files[_gist_changes_name(self.file_name)] = json.dumps(self.changes, ensure_ascii=False, indent=2)
+        return files
+
+class GistSnapshot:
+    """
+    一次 GET 得到的整个 Gist（icons.json / icons-square.json / ...）。
+    每个文件只解析一次，在同一请求内（flask.g）以及缓存窗口内复用。
+    """
+
+    def __init__(self, gist):
+        self.gist = gist
+        self._parsed = {}
+        self._segments = {}
+        self._catalogs = {}
+        self._changes = {}
+
+    @property
+    def version(self):
+        """Gist 当前 revision（history[0].version），用于检测并发覆盖"""
+        history = self.gist.get("history") or []
+        return (history[0] or {}).get("version") if history else None
+
+    def icons(self, file_name=GIST_FILE_NAME):
+        """返回可修改的副本：顶层 dict 与 icons 列表是新的，条目本身共享"""
+        file_name = (file_name or GIST_FILE_NAME or "icons.json").strip()
+        content = self._parsed.get(file_name)
+        if content is None:
+            content, self._segments[file_name] = _load_icons_catalog_doc(self.gist, file_name=file_name)
+            self._parsed[file_name] = content
+        return {**content, "icons": list(content["icons"])}
+
+    def catalog(self, file_name=GIST_FILE_NAME):
+        """返回共享的只读 IconCatalog；需要修改时请先 .copy()"""
+        file_name = (file_name or GIST_FILE_NAME or "icons.json").strip()
+        catalog = self._catalogs.get(file_name)
+        if catalog is None:
+            content = self.icons(file_name)
+            catalog = IconCatalog(
+                content,
+                segments=self._segments.get(file_name),
+                file_name=file_name,
+                hashes=_load_icons_hash_index(self.gist, file_name=file_name),
+                changes=self.changes(file_name),
+            )
+            self._catalogs[file_name] = catalog
+        return catalog
+
+    def changes(self, file_name=GIST_FILE_NAME):
+        """变更日志（只读，共享）"""
+        file_name = (file_name or GIST_FILE_NAME or "icons.json").strip()
+        catalog = self._catalogs.get(file_name)
+        if catalog is not None:
+            return catalog.changes
+        log = self._changes.get(file_name)
+        if log is None:
+            log = self._changes[file_name] = _load_icons_change_log(self.gist, file_name=file_name)
+        return log
+
+    def adopt_catalog(self, file_name, catalog):
+        """写入成功后，直接把调用方已更新好的索引作为该文件的最新状态，无需重新解析"""
+        file_name = (file_name or GIST_FILE_NAME or "icons.json").strip()
+        catalog.dirty.clear()
+        catalog.manifest_dirty = False
+        catalog.hashes_dirty = False
+        catalog.changes_dirty = False
+        self._parsed[file_name] = catalog.content
+        self._segments[file_name] = [list(seg) for seg in catalog.segments]
+        self._catalogs[file_name] = catalog
+
+def _set_gist_snapshot(snapshot, etag=None):
+    with _gist_lock:
+        _gist_state["data"] = snapshot.gist
+        _gist_state["snapshot"] = snapshot
+        if etag is not None:
+            _gist_state["etag"] = etag
+    if has_request_context():
+        g.gist_snapshot = snapshot
+
+def get_gist_snapshot(request_cache=True):
+    if request_cache and has_request_context():
+        snapshot = g.get("gist_snapshot")
+        if snapshot is not None:
+            return snapshot
+
+    gist = get_gist_data()
+    with _gist_lock:
+        snapshot = _gist_state["snapshot"]
+        if snapshot is None or snapshot.gist is not gist:
+            snapshot = GistSnapshot(gist)
+            _gist_state["snapshot"] = snapshot
+    if has_request_context():
+        g.gist_snapshot = snapshot
+    return snapshot
+
+def _read_icons_json_from_gist(file_name=GIST_FILE_NAME):
+    return catalog_store().icons(file_name)
+
+def _icons_json_cached(file_name=GIST_FILE_NAME):
+    """返回某个 Gist 文件序列化后的缓存条目（bytes + ETag + Last-Modified）"""
+    file_name = (file_name or GIST_FILE_NAME or "icons.json").strip()
+    now = time.time()
+    with _gist_lock:
+        entry = _icons_cache.get(file_name)
+    if entry and entry["expires_at"] > now:
+        return entry
+
+    store = catalog_store()
+    token, last_modified = store.document_version(file_name)
+
+    if entry and token and entry["token"] == token:
+        entry["expires_at"] = now + ICONS_CACHE_TTL
+        return entry
+
+    content = store.icons(file_name)
+    body = json.dumps(content, ensure_ascii=False, indent=2).encode("utf-8")
+    entry = {
+        "body": body,
+        "compact": json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+        "variants": {},  # (compact, encoding) -> 压缩后的 bytes，按需生成、同一版本只生成一次
+        "etag": hashlib.sha1(body).hexdigest(),
+        "cursor": store.changes(file_name)["seq"],
+        "last_modified": last_modified,
+        "token": token,  # 存储后端的版本标识（Gist ETag / SQLite 版本号），未变化时直接续期
+        "expires_at": now + ICONS_CACHE_TTL,
+    }
+    with _gist_lock:
+        _icons_cache[file_name] = entry
+    return entry
+
 def get_unique_name(name, json_content):
-    """名称去重逻辑"""
-    icons = json_content.get("icons", [])
-    if not any(icon["name"] == name for icon in icons):
-        return name
+    """名称去重逻辑（json_content 可以是 IconCatalog 或 icons.json 内容）"""
+    catalog = json_content if isinstance(json_content, IconCatalog) else IconCatalog(json_content)
+    return catalog.unique_name(name)
+
+# ===== Gist 写入层：乐观并发 + 冲突时合并 =====
+# Gist PATCH 不支持 If-Match，只能事后检测：PATCH 响应里 history[1] 应该就是我们写入所基于的版本。
+# 如果不是，说明中间有别人写过、被我们整份覆盖了：
+# - 重新 GET 当前最新版本作为底；
+# - 取回被覆盖的那几个版本，把它们变更日志里我们的底中没有的记录（别人的追加/删除）重新应用；
+# - 再应用本次的追加/删除，写入后检查 history[1] 是否就是刚取到的最新版本，不是则重复。
+# 同一进程内的写入用 _gist_write_lock 串行（Gist 的版本号是整个 Gist 共用的，不区分文件），冲突只可能来自其他实例。
+# 注意：多个实例持续高并发写入、重试次数用完时，最后一次被覆盖的内容无法再找回；
+# 这种部署请改用 CATALOG_JOURNAL（合并写入）或 CATALOG_BACKEND=sqlite。
+GIST_WRITE_MAX_ATTEMPTS = int((os.getenv("GIST_WRITE_MAX_ATTEMPTS", "4") or "4").strip())
+# 冲突时最多回溯多少个被覆盖的版本
+GIST_RECOVER_MAX_REVISIONS = 10
+_gist_write_lock = threading.Lock()
+
+def _get_gist_revision(version: str):
+    r = http_session("github").get(
+        f"https://api.github.com/gists/{GIST_ID}/{version}", headers=_gist_headers(), timeout=http_timeout("github")
+    )
+    r.raise_for_status()
+    return r.json()
 
-    base_name = name
-    counter = 1
-    while any(icon["name"] == f"{base_name}{counter}" for icon in icons):
-        counter += 1
-    return f"{base_name}{counter}"
+def _fetch_gist_head():
+    """不带 ETag 重新 GET 整个 Gist，作为新的进程内快照"""
+    with _gist_lock:
+        _gist_state["etag"] = None
+        _gist_state["data"] = None
+    snapshot = GistSnapshot(get_gist_data())
+    _set_gist_snapshot(snapshot)
+    return snapshot
+
+def _overwritten_changes(file_name, history, base_version, known):
+    """
+    history: PATCH 响应里的版本列表（最新在前，[0] 是我们刚写入的版本）
+    返回被本次 PATCH 覆盖的版本（history[1] 起、直到 base_version 之前）中，known 里没有的变更记录（按时间先后）
+    """
+    revisions = []  # 每个被覆盖版本各自新出现的记录（版本内保持原有先后）
+    seen = set(known)
+    for n, entry in enumerate(history[1:]):
+        version = (entry or {}).get("version")
+        if not version or version == base_version:
+            break
+        if n >= GIST_RECOVER_MAX_REVISIONS:
+            print(f"被覆盖的 Gist 版本超过 {GIST_RECOVER_MAX_REVISIONS} 个，更早的变更无法找回")
+            break
+        log = _load_icons_change_log(_get_gist_revision(version), file_name=file_name)
+        found = []
+        for change in log["changes"]:
+            key = json.dumps(change, ensure_ascii=False, sort_keys=True)
+            if key not in seen:
+                seen.add(key)
+                found.append(change)
+        revisions.append(found)
+    # history 是新的在前：只颠倒版本之间的顺序，同一版本内的记录已按先后排列（先加后删不能变成先删后加）
+    return [change for found in reversed(revisions) for change in found]
+
+def _apply_gist_ops(catalog, append_items, remove_urls, replay: bool):
+    """
+    在 catalog 上应用删除/追加；replay=True 时跳过 URL 已存在的追加（可能是自己之前写入的），
+    但仍记入变更日志（客户端可能只见过被覆盖的那一版，增量记录按 URL 合并，重复无害）
+    与变更日志的约定一致：先删后加。写入日志合并刷出时，已确认的名字在最终状态里不冲突，先删才不会被重新编号
+    """
+    removed_urls = [u for u in remove_urls if u in catalog.by_url] if remove_urls else []
+    removed = catalog.remove_urls(remove_urls) if removed_urls else 0
+    saved = []
+    added = []
+    for item in append_items:
+        existing = catalog.by_url.get(item["url"]) if replay else None
+        icon = existing or catalog.append(item["name"], item["url"], backend=item.get("backend"))
+        added.append(icon)
+        catalog.set_hash(item.get("sha256"), icon["url"])
+        saved.append({"name": icon["name"], "url": icon["url"]})
+    catalog.record_change(added, removed_urls)
+    return saved, removed
+
+def gist_write(file_name=GIST_FILE_NAME, append_items=(), remove_urls=()):
+    """
+    对某个 Gist 文件做一次“追加 + 删除”写入，检测并发覆盖后自动合并重试。
+    Return: {"saved": 追加后的最终条目, "before": 写前条数, "after": 写后条数, "removed": 删除条数}
+    """
+    file_name = (file_name or GIST_FILE_NAME or "icons.json").strip()
+    append_items = list(append_items or ())
+    remove_urls = set(u for u in (remove_urls or ()) if u)
+
+    with _gist_write_lock:
+        # 不用请求内缓存的快照：前面的写入可能已经更新了进程内快照
+        base = get_gist_snapshot(request_cache=False)
+        before = len(base.catalog(file_name).icons)
+        known = [json.dumps(c, ensure_ascii=False, sort_keys=True) for c in base.changes(file_name)["changes"]]
+        recovered = []
+
+        for attempt in range(GIST_WRITE_MAX_ATTEMPTS):
+            catalog = base.catalog(file_name).copy()
+            for change in recovered:
+                _apply_gist_ops(catalog, change.get("added") or [], set(change.get("removed") or ()), replay=True)
+            saved, removed = _apply_gist_ops(catalog, append_items, remove_urls, replay=attempt > 0)
+            if not recovered and not append_items and not removed and not catalog.hashes_dirty:
+                return {"saved": [], "before": before, "after": len(catalog.icons), "removed": 0}
+
+            gist = update_gist_files(catalog.pending_files(), file_name=file_name)
+            history = gist.get("history") or []
+            prev = (history[1] or {}).get("version") if len(history) > 1 else None
+
+            if base.version is None or prev is None or prev == base.version:
+                # 只能并入本次 PATCH 响应对应的快照：重新 GET 得到的可能已经是别人更新的版本
+                with _gist_lock:
+                    snapshot = _gist_state["snapshot"]
+                if snapshot is not None and snapshot.gist is gist:
+                    snapshot.adopt_catalog(file_name, catalog)
+                return {"saved": saved, "before": before, "after": len(catalog.icons), "removed": removed}
+
+            # 被并发覆盖：找回被覆盖版本里别人的变更，以当前最新版本为底重新应用
+            print(f"Gist 并发写冲突（期望 {base.version}，实际 {prev}），合并后重试")
+            recovered += _overwritten_changes(
+                file_name, history, base.version, known + [json.dumps(c, ensure_ascii=False, sort_keys=True) for c in recovered]
+            )
+            # 随机退避，避免几个实例每次都同时重写、互相覆盖
+            time.sleep(random.uniform(0, 0.2 * (2 ** attempt)))
+            base = _fetch_gist_head()
+
+    raise Exception("Gist 并发写冲突，重试次数已用完")
 
 def batch_append_to_gist(new_items, file_name=GIST_FILE_NAME):
     """
@@ -170,19 +1003,7 @@ def batch_append_to_gist(new_items, file_name=GIST_FILE_NAME):
     Return: 更新后的 items (包含去重后的最终名称)
     """
     try:
-        content = _read_icons_json_from_gist(file_name=file_name)
-        saved_chunk = []
-
-        for item in new_items:
-            final_name = get_unique_name(item["name"], content)
-            content.setdefault("icons", []).append({
-                "name": final_name,
-                "url": item["url"]
-            })
-            saved_chunk.append({"name": final_name, "url": item["url"]})
-
-        _update_gist_with_retry(content, file_name=file_name)
-        return saved_chunk
+        return catalog_store().write(file_name, append_items=new_items)["saved"]
     except Exception as e:
         print(f"Gist 批量更新失败: {e}")
         raise e
@@ -192,71 +1013,935 @@ def gist_remove_icons_by_urls(urls_to_remove: set):
     从 icons.json 中批量移除 url 命中的条目，并尽量合并为一次 PATCH。
     一致性保证：urls_to_remove 必须只包含“PICUI 删除成功”的 URL
     """
-    urls_to_remove = set([u for u in (urls_to_remove or set()) if u])
-    content = _read_icons_json_from_gist()
-    icons = content.get("icons", []) or []
-    before = len(icons)
+    result = catalog_store().write(GIST_FILE_NAME, remove_urls=urls_to_remove)
+    return {"before": result["before"], "after": result["after"], "removed": result["removed"]}
 
-    new_icons = [it for it in icons if it.get("url") not in urls_to_remove]
-    after = len(new_icons)
+def gist_raw_icons_url():
+    return f"https://gist.githubusercontent.com/{GITHUB_USER}/{GIST_ID}/raw/{GIST_FILE_NAME}"
 
-    content["icons"] = new_icons
-    if after != before:
-        _update_gist_with_retry(content)
+# ===== 目录存储后端：Gist（默认）或本地 SQLite =====
+# CATALOG_BACKEND=gist：目录存放在 Gist（见上文分片 / 乐观并发写入）
+# CATALOG_BACKEND=sqlite：目录存放在本地 SQLite（CATALOG_SQLITE_PATH），按行追加/删除、本地读取，
+#   /icons*.json 渲染出与 Gist 模式完全相同的文档；适合自托管（常驻进程 + 持久磁盘），不适合 Vercel。
+#   - 某个目录第一次访问且 SQLite 中没有时，若配置了 GIST_ID 会先从 Gist 导入（图标 + 哈希索引 + 变更日志）
+#   - CATALOG_GIST_MIRROR=1：后台每 CATALOG_MIRROR_INTERVAL 秒把有改动的目录整体同步回 Gist（只读镜像）
+CATALOG_BACKEND = (os.getenv("CATALOG_BACKEND", "gist") or "gist").strip().lower()
+CATALOG_SQLITE_PATH = (os.getenv("CATALOG_SQLITE_PATH", "") or "").strip() or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "data", "catalog.sqlite3"
+)
+CATALOG_GIST_MIRROR = (os.getenv("CATALOG_GIST_MIRROR", "0") or "0").strip() == "1"
+CATALOG_MIRROR_INTERVAL = float((os.getenv("CATALOG_MIRROR_INTERVAL", "30") or "30").strip())
+
+def _gist_http_date(updated_at):
+    """Gist 的 updated_at（ISO 8601）转成 HTTP-date；无法解析时返回 None（不发 Last-Modified）"""
+    try:
+        dt = datetime.fromisoformat(str(updated_at).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return format_datetime(dt.astimezone(timezone.utc), usegmt=True)
 
-    return {"before": before, "after": after, "removed": before - after}
+class GistCatalogStore:
+    """目录读写直接走 Gist（一次 GET 得到的快照 + gist_write）"""
 
-def gist_raw_icons_url():
-    return f"https://gist.githubusercontent.com/{GITHUB_USER}/{GIST_ID}/raw/{GIST_FILE_NAME}"
+    def catalog(self, file_name=GIST_FILE_NAME):
+        return get_gist_snapshot().catalog(file_name)
+
+    def icons(self, file_name=GIST_FILE_NAME):
+        return get_gist_snapshot().icons(file_name)
+
+    def changes(self, file_name=GIST_FILE_NAME):
+        return get_gist_snapshot().changes(file_name)
+
+    def document_version(self, file_name=GIST_FILE_NAME):
+        """(版本标识, Last-Modified)：Gist 整体的 ETag"""
+        snapshot = get_gist_snapshot()
+        with _gist_lock:
+            etag, last_modified = _gist_state["etag"], _gist_state["last_modified"]
+        return etag, last_modified or _gist_http_date(snapshot.gist.get("updated_at"))
+
+    def write(self, file_name=GIST_FILE_NAME, append_items=(), remove_urls=()):
+        return gist_write(file_name, append_items=append_items, remove_urls=remove_urls)
+
+class SqliteCatalogStore:
+    """
+    本地 SQLite 目录：
+    - icons：每个图标一行（按 id 保持追加顺序），(file, url) / (file, name) 有索引
+    - hashes：内容去重索引；changes：增量同步变更日志；catalogs：每个目录的元数据、版本号、游标
+    读取时按目录版本号缓存渲染好的文档与 IconCatalog，写入只改动涉及的行。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS catalogs (
+            file TEXT PRIMARY KEY,
+            meta TEXT NOT NULL DEFAULT '{}',
+            version INTEGER NOT NULL DEFAULT 0,
+            seq INTEGER NOT NULL DEFAULT 0,
+            base INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS icons (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file TEXT NOT NULL,
+            name TEXT,
+            url TEXT,
+            extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS icons_file_url ON icons (file, url);
+        CREATE INDEX IF NOT EXISTS icons_file_name ON icons (file, name);
+        CREATE TABLE IF NOT EXISTS hashes (
+            file TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            url TEXT NOT NULL,
+            PRIMARY KEY (file, sha256)
+        );
+        CREATE INDEX IF NOT EXISTS hashes_file_url ON hashes (file, url);
+        CREATE TABLE IF NOT EXISTS changes (
+            file TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            at TEXT,
+            added TEXT NOT NULL,
+            removed TEXT NOT NULL,
+            PRIMARY KEY (file, seq)
+        );
+        CREATE TABLE IF NOT EXISTS name_suffixes (
+            file TEXT NOT NULL,
+            base TEXT NOT NULL,
+            next INTEGER NOT NULL,
+            PRIMARY KEY (file, base)
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._cache_lock = threading.Lock()
+        self._cache = {}  # file -> (version, content, catalog)
+        self._ready = set()  # 已确认存在（或已导入）的目录
+        self._import_lock = threading.Lock()
+        self._mirror_lock = threading.Lock()
+        self._mirror_pending = set()
+        self._mirror_thread = None
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _norm(self, file_name):
+        return (file_name or GIST_FILE_NAME or "icons.json").strip()
+
+    # ----- 读 -----
+    def _ensure(self, file_name):
+        """目录不存在时创建（配置了 Gist 时先从 Gist 导入）"""
+        if file_name in self._ready:
+            return
+        with self._import_lock:
+            self._ensure_locked(file_name)
+
+    def _ensure_locked(self, file_name):
+        if file_name in self._ready:
+            return
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM catalogs WHERE file = ?", (file_name,)).fetchone() is None:
+            imported = None
+            if GIST_ID and not GIST_ID.startswith("YOUR_"):
+                try:
+                    snapshot = get_gist_snapshot()
+                    imported = (
+                        snapshot.icons(file_name),
+                        _load_icons_hash_index(snapshot.gist, file_name=file_name),
+                        snapshot.changes(file_name),
+                    )
+                except Exception as e:
+                    print(f"从 Gist 导入 {file_name} 失败，使用空目录: {e}")
+            self._import(file_name, *(imported or ({"icons": []}, {}, {"seq": 0, "base": 0, "changes": []})))
+        self._ready.add(file_name)
+
+    def _import(self, file_name, content, hashes, changes):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM catalogs WHERE file = ?", (file_name,)).fetchone() is not None:
+                conn.execute("ROLLBACK")
+                return
+            meta = {k: v for k, v in content.items() if k != "icons"}
+            conn.execute(
+                "INSERT INTO catalogs (file, meta, version, seq, base, updated_at) VALUES (?, ?, 1, ?, ?, ?)",
+                (file_name, json.dumps(meta, ensure_ascii=False), changes["seq"], changes["base"], time.time()),
+            )
+            conn.executemany(
+                "INSERT INTO icons (file, name, url, extra) VALUES (?, ?, ?, ?)",
+                [(file_name, icon.get("name"), icon.get("url"), self._extra(icon)) for icon in content["icons"]],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO hashes (file, sha256, url) VALUES (?, ?, ?)",
+                [(file_name, h, url) for h, url in hashes.items()],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO changes (file, seq, at, added, removed) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (file_name, int(c.get("seq") or 0), c.get("at"),
+                     json.dumps(c.get("added") or [], ensure_ascii=False), json.dumps(c.get("removed") or [], ensure_ascii=False))
+                    for c in changes["changes"]
+                ],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _extra(self, icon):
+        extra = {k: v for k, v in icon.items() if k not in ("name", "url")}
+        return json.dumps(extra, ensure_ascii=False) if extra else None
+
+    def _row(self, file_name):
+        self._ensure(file_name)
+        return self._conn().execute(
+            "SELECT meta, version, seq, base, updated_at FROM catalogs WHERE file = ?", (file_name,)
+        ).fetchone()
+
+    def _load(self, file_name):
+        """返回 (version, content, catalog)；同一版本只渲染一次"""
+        file_name = self._norm(file_name)
+        meta_raw, version, _, _, _ = self._row(file_name)
+        with self._cache_lock:
+            cached = self._cache.get(file_name)
+        if cached and cached[0] == version:
+            return cached
+
+        conn = self._conn()
+        icons = []
+        for name, url, extra in conn.execute("SELECT name, url, extra FROM icons WHERE file = ? ORDER BY id", (file_name,)):
+            icon = {"name": name, "url": url}
+            if extra:
+                icon.update(json.loads(extra))
+            icons.append(icon)
+        content = {**json.loads(meta_raw or "{}"), "icons": icons}
+        hashes = dict(conn.execute("SELECT sha256, url FROM hashes WHERE file = ?", (file_name,)).fetchall())
+        catalog = IconCatalog(
+            {**content, "icons": list(icons)}, file_name=file_name, hashes=hashes, changes=self._changes(file_name)
+        )
+        loaded = (version, content, catalog)
+        with self._cache_lock:
+            self._cache[file_name] = loaded
+        return loaded
+
+    def _changes(self, file_name):
+        _, _, seq, base, _ = self._row(file_name)
+        rows = self._conn().execute(
+            "SELECT seq, at, added, removed FROM changes WHERE file = ? ORDER BY seq", (file_name,)
+        ).fetchall()
+        return {
+            "seq": seq,
+            "base": base,
+            "changes": [
+                {"seq": q, "at": at, "added": json.loads(added), "removed": json.loads(removed)}
+                for q, at, added, removed in rows
+            ],
+        }
+
+    def catalog(self, file_name=GIST_FILE_NAME):
+        return self._load(file_name)[2]
+
+    def icons(self, file_name=GIST_FILE_NAME):
+        content = self._load(file_name)[1]
+        return {**content, "icons": list(content["icons"])}
+
+    def changes(self, file_name=GIST_FILE_NAME):
+        return self._load(file_name)[2].changes
+
+    def document_version(self, file_name=GIST_FILE_NAME):
+        _, version, _, _, updated_at = self._row(self._norm(file_name))
+        return f"sqlite-{version}", formatdate(updated_at, usegmt=True)
+
+    # ----- 写 -----
+    def _unique_name(self, conn, file_name, name):
+        """
+        与 IconCatalog.unique_name 一致：未占用原样返回，否则取最小的未占用序号 name1, name2...
+        name_suffixes 记录每个基础名的下一个候选序号（更小的都已被占用，删除时由 _release_name 回调），
+        同前缀的名字再多也只需一两次查询
+        """
+        taken = "SELECT 1 FROM icons WHERE file = ? AND name = ? LIMIT 1"
+        if conn.execute(taken, (file_name, name)).fetchone() is None:
+            return name
+        row = conn.execute("SELECT next FROM name_suffixes WHERE file = ? AND base = ?", (file_name, name)).fetchone()
+        counter = row[0] if row else 1
+        while conn.execute(taken, (file_name, f"{name}{counter}")).fetchone() is not None:
+            counter += 1
+        conn.execute(
+            "INSERT OR REPLACE INTO name_suffixes (file, base, next) VALUES (?, ?, ?)", (file_name, name, counter + 1)
+        )
+        return f"{name}{counter}"
+
+    def _release_name(self, conn, file_name, name):
+        """删除了名为 name 的条目：它可能是任一基础名 + 序号（icon12 = icon1 + 2 = icon + 12），把这些基础名的提示回调到该序号"""
+        if not name:
+            return
+        i = len(name)
+        while i > 0 and name[i - 1].isdigit():
+            i -= 1
+            if name[i] != "0":  # 序号不会有前导 0
+                conn.execute(
+                    "UPDATE name_suffixes SET next = MIN(next, ?) WHERE file = ? AND base = ?",
+                    (int(name[i:]), file_name, name[:i]),
+                )
+
+    def write(self, file_name=GIST_FILE_NAME, append_items=(), remove_urls=()):
+        file_name = self._norm(file_name)
+        self._ensure(file_name)
+        append_items = list(append_items or ())
+        remove_urls = [u for u in set(remove_urls or ()) if u]
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            count_sql = "SELECT COUNT(*) FROM icons WHERE file = ?"
+            before = conn.execute(count_sql, (file_name,)).fetchone()[0]
+            # 与 _apply_gist_ops 一致：先删后加
+            removed = 0
+            removed_urls = []
+            for url in remove_urls:
+                names = conn.execute("SELECT name FROM icons WHERE file = ? AND url = ?", (file_name, url)).fetchall()
+                n = conn.execute("DELETE FROM icons WHERE file = ? AND url = ?", (file_name, url)).rowcount
+                for (name,) in names:
+                    self._release_name(conn, file_name, name)
+                if n:
+                    removed += n
+                    removed_urls.append(url)
+                    conn.execute("DELETE FROM hashes WHERE file = ? AND url = ?", (file_name, url))
+
+            saved = []
+            for item in append_items:
+                icon = {"name": self._unique_name(conn, file_name, item["name"]), "url": item["url"]}
+                if item.get("backend"):
+                    icon["backend"] = item["backend"]
+                conn.execute(
+                    "INSERT INTO icons (file, name, url, extra) VALUES (?, ?, ?, ?)",
+                    (file_name, icon["name"], icon["url"], self._extra(icon)),
+                )
+                if item.get("sha256"):
+                    conn.execute(
+                        "INSERT OR REPLACE INTO hashes (file, sha256, url) VALUES (?, ?, ?)",
+                        (file_name, item["sha256"], icon["url"]),
+                    )
+                saved.append(icon)
+
+            if saved or removed:
+                _, _, seq, base, _ = conn.execute(
+                    "SELECT meta, version, seq, base, updated_at FROM catalogs WHERE file = ?", (file_name,)
+                ).fetchone()
+                seq += 1
+                conn.execute(
+                    "INSERT INTO changes (file, seq, at, added, removed) VALUES (?, ?, ?, ?, ?)",
+                    (file_name, seq, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                     json.dumps(saved, ensure_ascii=False), json.dumps(removed_urls, ensure_ascii=False)),
+                )
+                keep_from = seq - max(1, ICONS_CHANGELOG_MAX)
+                if keep_from > base:
+                    conn.execute("DELETE FROM changes WHERE file = ? AND seq <= ?", (file_name, keep_from))
+                    base = keep_from
+                conn.execute(
+                    "UPDATE catalogs SET version = version + 1, seq = ?, base = ?, updated_at = ? WHERE file = ?",
+                    (seq, base, time.time(), file_name),
+                )
+            after = conn.execute(count_sql, (file_name,)).fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        with _gist_lock:
+            _icons_cache.pop(file_name, None)
+        if saved or removed:
+            self._schedule_mirror(file_name)
+        return {
+            "saved": [{"name": icon["name"], "url": icon["url"]} for icon in saved],
+            "before": before,
+            "after": after,
+            "removed": removed,
+        }
+
+    # ----- 同步到 Gist（可选）-----
+    def _schedule_mirror(self, file_name):
+        if not CATALOG_GIST_MIRROR:
+            return
+        with self._mirror_lock:
+            self._mirror_pending.add(file_name)
+            if self._mirror_thread is None:
+                self._mirror_thread = threading.Thread(target=self._mirror_loop, daemon=True)
+                self._mirror_thread.start()
+
+    def _mirror_loop(self):
+        while True:
+            time.sleep(CATALOG_MIRROR_INTERVAL)
+            with self._mirror_lock:
+                pending, self._mirror_pending = self._mirror_pending, set()
+            for file_name in pending:
+                try:
+                    self.mirror_to_gist(file_name)
+                except Exception as e:
+                    print(f"同步 {file_name} 到 Gist 失败，稍后重试: {e}")
+                    with self._mirror_lock:
+                        self._mirror_pending.add(file_name)
+
+    def mirror_to_gist(self, file_name=GIST_FILE_NAME):
+        """把整个目录（按 GIST_SHARD_MAX_ICONS 分片）+ 哈希索引 + 变更日志一次 PATCH 写入 Gist"""
+        file_name = self._norm(file_name)
+        _, content, catalog = self._load(file_name)
+        meta = {k: v for k, v in content.items() if k != "icons"}
+        icons = content["icons"]
+        size = GIST_SHARD_MAX_ICONS if GIST_SHARD_MAX_ICONS > 0 else max(1, len(icons))
+        chunks = [icons[i:i + size] for i in range(0, len(icons), size)] or [[]]
+
+        previous = [name for name, _ in get_gist_snapshot().catalog(file_name).segments]
+        files = {}
+        shards = []
+        for n, chunk in enumerate(chunks, 1):
+            name = _gist_shard_name(file_name, n)
+            doc = {**meta} if n == 1 else {}
+            doc["icons"] = chunk
+            files[name] = json.dumps(doc, ensure_ascii=False, indent=2)
+            shards.append(name)
+        if len(shards) > 1 or len(previous) > 1:
+            files[_gist_manifest_name(file_name)] = json.dumps({"shards": shards}, ensure_ascii=False, indent=2)
+        for name in previous:
+            if name not in files:
+                files[name] = None
+        files[_gist_hashes_name(file_name)] = json.dumps({"sha256": catalog.hashes}, ensure_ascii=False, indent=2)
+        files[_gist_changes_name(file_name)] = json.dumps(catalog.changes, ensure_ascii=False, indent=2)
+        update_gist_files(files, file_name=file_name)
+
+
+# ===== 写入日志（write-behind）：先落本地日志立即返回，后台合并成一次写入 =====
+# CATALOG_JOURNAL=1 时，追加/删除先追加到 CATALOG_JOURNAL_DIR 下的日志文件（fsync）后立即确认；
+# 后台线程每 CATALOG_FLUSH_INTERVAL 秒、或某个目录积压达到 CATALOG_FLUSH_OPS 条时，把该目录的全部积压合并成一次 store.write。
+# 读取（/icons*.json、去重、起名、管理后台）会叠加尚未写入的操作；增量同步的游标只在真正写入后前进
+# （增量记录按 URL 合并、可重复应用，客户端提前拿到的条目在写入后再收到一次也不会出错）。
+# 仅适用于常驻进程 + 持久磁盘；Vercel 冻结函数后日志可能长期不刷出，请勿开启。
+CATALOG_JOURNAL = (os.getenv("CATALOG_JOURNAL", "0") or "0").strip() == "1"
+CATALOG_JOURNAL_DIR = (os.getenv("CATALOG_JOURNAL_DIR", "") or "").strip() or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "data", "journal"
+)
+CATALOG_FLUSH_INTERVAL = float((os.getenv("CATALOG_FLUSH_INTERVAL", "10") or "10").strip())
+CATALOG_FLUSH_OPS = int((os.getenv("CATALOG_FLUSH_OPS", "100") or "100").strip())
+
+class JournaledCatalogStore:
+    """
+    包装任意目录存储：write 只写本地日志，读取叠加未写入的操作，后台线程合并写入。
+    日志格式：每个目录一个 <目录名>.journal（JSON Lines），每行一个操作：
+        {"op": "append", "name", "url", "backend", "sha256"} / {"op": "remove", "url"}
+    启动时读取已有日志继续写入；写入成功后从日志中去掉已写入的前缀。
+    """
+
+    def __init__(self, inner, root):
+        self.inner = inner
+        self.root = root
+        self._lock = threading.Condition()
+        self._pending = {}  # file_name -> [op, ...]（与日志文件内容一致）
+        self._since = {}  # file_name -> 最早一条未写入操作的时间
+        self._generation = {}  # file_name -> 每次追加操作 +1，用于叠加结果的缓存与版本标识
+        self._overlay_cache = {}  # file_name -> (inner_token, generation, IconCatalog)
+        self._flush_lock = threading.Lock()
+        self._failures = 0
+        self._last_error = None
+        os.makedirs(root, exist_ok=True)
+        # 同一目录只允许一个进程持有（gunicorn 多 worker 时只有一个 worker 开启日志，其余直接写入）
+        self._lock_file = open(os.path.join(root, ".lock"), "w")
+        if fcntl is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        for entry in os.listdir(root):
+            if entry.endswith(".journal"):
+                self._load(entry)
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _path(self, file_name):
+        return os.path.join(self.root, quote(file_name, safe="") + ".journal")
+
+    def _load(self, entry):
+        file_name = unquote(entry[: -len(".journal")])
+        ops = []
+        with open(os.path.join(self.root, entry), "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    ops.append(json.loads(line))
+                except ValueError:
+                    # 只可能是崩溃时写了一半的最后一行（该操作未被确认），丢弃
+                    print(f"写入日志 {entry} 末尾有不完整记录，已忽略")
+        if ops:
+            self._pending[file_name] = ops
+            self._since[file_name] = time.time()
+            self._generation[file_name] = 1
+            print(f"从写入日志恢复 {file_name}：{len(ops)} 条待写入操作")
+
+    def _norm(self, file_name):
+        return (file_name or GIST_FILE_NAME or "icons.json").strip()
+
+    # ----- 读：底层目录 + 未写入的操作 -----
+    def _overlay(self, file_name):
+        return self._overlay_state(file_name)[2]
+
+    def _overlay_state(self, file_name):
+        """返回 (底层版本, generation, 叠加后的目录)；读取底层存储可能走网络，不能在 self._lock 内调用"""
+        token, _ = self.inner.document_version(file_name)
+        base = self.inner.catalog(file_name)
+        with self._lock:
+            ops = list(self._pending.get(file_name) or ())
+            generation = self._generation.get(file_name, 0)
+            cached = self._overlay_cache.get(file_name)
+        if not ops:
+            return token, generation, base
+        if cached and token and cached[0] == token and cached[1] == generation:
+            return token, generation, cached[2]
+        catalog = base.copy()
+        for op in ops:
+            if op["op"] == "append":
+                if op["url"] not in catalog.by_url:
+                    catalog.append(op["name"], op["url"], backend=op.get("backend"))
+                catalog.set_hash(op.get("sha256"), op["url"])
+            else:
+                catalog.remove_urls({op["url"]})
+        with self._lock:
+            if self._generation.get(file_name, 0) == generation:
+                self._overlay_cache[file_name] = (token, generation, catalog)
+        return token, generation, catalog
+
+    def catalog(self, file_name=GIST_FILE_NAME):
+        return self._overlay(self._norm(file_name))
+
+    def icons(self, file_name=GIST_FILE_NAME):
+        file_name = self._norm(file_name)
+        with self._lock:
+            pending = bool(self._pending.get(file_name))
+        if not pending:
+            return self.inner.icons(file_name)
+        catalog = self._overlay(file_name)
+        return {**catalog.content, "icons": list(catalog.icons)}
+
+    def changes(self, file_name=GIST_FILE_NAME):
+        return self.inner.changes(file_name)
+
+    def document_version(self, file_name=GIST_FILE_NAME):
+        file_name = self._norm(file_name)
+        token, last_modified = self.inner.document_version(file_name)
+        with self._lock:
+            generation = self._generation.get(file_name, 0)
+            since = self._since.get(file_name)
+        if not since:
+            return token, last_modified
+        return f"{token}+j{generation}", formatdate(since, usegmt=True)
+
+    # ----- 写：落日志后立即返回 -----
+    def write(self, file_name=GIST_FILE_NAME, append_items=(), remove_urls=()):
+        file_name = self._norm(file_name)
+        append_items = list(append_items or ())
+        while True:
+            # 底层目录在锁外读取（Gist 可能很慢），锁内只做内存计算和追加日志
+            token, generation, overlay = self._overlay_state(file_name)
+            with self._lock:
+                current = self._generation.get(file_name, 0)
+                if current != generation:
+                    # 期间有其他写入：它留下的叠加缓存就是最新状态；被刷出清掉缓存时重新读取
+                    cached = self._overlay_cache.get(file_name)
+                    if not cached or cached[1] != current:
+                        continue
+                    token, overlay = cached[0], cached[2]
+                catalog = overlay.copy()
+                before = len(catalog.icons)
+                remove_urls = set(u for u in (remove_urls or ()) if u in catalog.by_url)
+                saved, removed = _apply_gist_ops(catalog, append_items, remove_urls, replay=False)
+                ops = [
+                    {"op": "append", "name": icon["name"], "url": icon["url"],
+                     "backend": item.get("backend"), "sha256": item.get("sha256")}
+                    for item, icon in zip(append_items, saved)
+                ]
+                ops += [{"op": "remove", "url": url} for url in sorted(remove_urls)]
+                if ops:
+                    with open(self._path(file_name), "a", encoding="utf-8") as f:
+                        f.write("".join(json.dumps(op, ensure_ascii=False) + "\n" for op in ops))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    self._pending.setdefault(file_name, []).extend(ops)
+                    self._since.setdefault(file_name, time.time())
+                    self._generation[file_name] = current + 1
+                    self._overlay_cache[file_name] = (token, current + 1, catalog)
+                    if len(self._pending[file_name]) >= CATALOG_FLUSH_OPS:
+                        self._lock.notify_all()
+                break
+        with _gist_lock:
+            _icons_cache.pop(file_name, None)
+        return {"saved": saved, "before": before, "after": len(catalog.icons), "removed": removed}
+
+    # ----- 后台合并写入 -----
+    @staticmethod
+    def _coalesce(ops):
+        """
+        合并成一次“先删后加”的写入：同一 URL 先追加后删除 = 删除；先删除后追加 = 删除 + 追加。
+        追加沿用已确认的名字，按日志先后排列；这些名字在最终状态里互不冲突，底层先删后加时不会被重新编号
+        """
+        last = {}
+        removed = set()
+        for op in ops:
+            last.pop(op["url"], None)
+            last[op["url"]] = op
+            if op["op"] == "remove":
+                removed.add(op["url"])
+        append_items = [
+            {k: op[k] for k in ("name", "url", "backend", "sha256") if op.get(k)}
+            for op in last.values() if op["op"] == "append"
+        ]
+        remove_urls = [url for url in last if url in removed]
+        return append_items, remove_urls
+
+    def _due(self, now):
+        return [
+            file_name for file_name, ops in self._pending.items()
+            if ops and (len(ops) >= CATALOG_FLUSH_OPS or now - self._since.get(file_name, now) >= CATALOG_FLUSH_INTERVAL)
+        ]
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                # 连续失败时退避，避免在限流期间反复撞墙
+                self._lock.wait(timeout=CATALOG_FLUSH_INTERVAL * min(2 ** self._failures, 32))
+                due = self._due(time.time())
+            for file_name in due:
+                try:
+                    self.flush_file(file_name)
+                    self._failures = 0
+                except Exception as e:
+                    self._failures += 1
+                    self._last_error = str(e)
+                    print(f"写入日志刷出 {file_name} 失败，稍后重试: {e}")
+
+    def flush_file(self, file_name):
+        """把某个目录当前的全部积压合并成一次写入，成功后从日志中去掉这些操作"""
+        with self._flush_lock:
+            with self._lock:
+                ops = list(self._pending.get(file_name) or ())
+            if not ops:
+                return None
+            append_items, remove_urls = self._coalesce(ops)
+            result = self.inner.write(file_name, append_items=append_items, remove_urls=remove_urls)
+            with self._lock:
+                rest = self._pending.get(file_name, [])[len(ops):]
+                path = self._path(file_name)
+                if rest:
+                    tmp = path + ".tmp"
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        f.write("".join(json.dumps(op, ensure_ascii=False) + "\n" for op in rest))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp, path)
+                    self._pending[file_name] = rest
+                    self._since[file_name] = time.time()
+                else:
+                    os.remove(path)
+                    self._pending.pop(file_name, None)
+                    self._since.pop(file_name, None)
+                self._generation[file_name] = self._generation.get(file_name, 0) + 1
+                self._overlay_cache.pop(file_name, None)
+            with _gist_lock:
+                _icons_cache.pop(file_name, None)
+            return result
+
+    def flush(self):
+        """立即刷出全部目录（进程退出时调用）"""
+        with self._lock:
+            files = [f for f, ops in self._pending.items() if ops]
+        for file_name in files:
+            try:
+                self.flush_file(file_name)
+            except Exception as e:
+                print(f"写入日志刷出 {file_name} 失败（日志保留，下次启动继续）: {e}")
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            return {
+                "pending": {f: len(ops) for f, ops in self._pending.items() if ops},
+                "oldest_age": max((now - t for t in self._since.values()), default=0.0),
+                "failures": self._failures,
+                "last_error": self._last_error,
+            }
+
+    def render_metrics(self):
+        st = self.stats()
+        lines = [
+            "# HELP tubiaoku_catalog_journal_pending Catalog operations acknowledged but not yet written.",
+            "# TYPE tubiaoku_catalog_journal_pending gauge",
+        ]
+        for file_name, count in sorted(st["pending"].items()):
+            lines.append(f'tubiaoku_catalog_journal_pending{{file="{file_name}"}} {count}')
+        lines += [
+            "# HELP tubiaoku_catalog_journal_oldest_seconds Age of the oldest unflushed operation.",
+            "# TYPE tubiaoku_catalog_journal_oldest_seconds gauge",
+            f"tubiaoku_catalog_journal_oldest_seconds {st['oldest_age']:.3f}",
+        ]
+        return "\n".join(lines) + "\n"
+
+CATALOG_STORES = {
+    "gist": GistCatalogStore,
+    "sqlite": lambda: SqliteCatalogStore(CATALOG_SQLITE_PATH),
+}
+_catalog_store = None
+_catalog_store_lock = threading.Lock()
+
+def catalog_store():
+    global _catalog_store
+    with _catalog_store_lock:
+        if _catalog_store is None:
+            if CATALOG_BACKEND not in CATALOG_STORES:
+                raise Exception(f"未知的 CATALOG_BACKEND: {CATALOG_BACKEND}")
+            store = CATALOG_STORES[CATALOG_BACKEND]()
+            if CATALOG_JOURNAL:
+                try:
+                    store = JournaledCatalogStore(store, CATALOG_JOURNAL_DIR)
+                except OSError as e:
+                    # 日志目录已被其他 worker 持有（或不可写）：本进程直接写入底层存储
+                    print(f"写入日志不可用，直接写入 {CATALOG_BACKEND}: {e}")
+            _catalog_store = store
+        return _catalog_store
 
 # ===== 对外暴露带 .json 后缀的订阅地址（同域名，便于客户端识别）=====
+def _icons_json_encoding():
+    """按 Accept-Encoding 选择压缩方式：br > gzip > 不压缩"""
+    accept = request.accept_encodings
+    if brotli is not None and accept.quality("br") > 0:
+        return "br"
+    if accept.quality("gzip") > 0:
+        return "gzip"
+    return ""
+
+def _icons_json_variant(entry, compact: bool, encoding: str):
+    key = (compact, encoding)
+    data = entry["variants"].get(key)
+    if data is None:
+        raw = entry["compact"] if compact else entry["body"]
+        if encoding == "br":
+            data = brotli.compress(raw, quality=9)
+        elif encoding == "gzip":
+            data = gzip.compress(raw, compresslevel=9, mtime=0)
+        else:
+            data = raw
+        entry["variants"][key] = data
+    return data
+
+def _icons_json_changes_response(file_name, since_raw):
+    """?since=<游标>：只返回该版本之后的新增/删除条目"""
+    try:
+        since = int(since_raw)
+    except (TypeError, ValueError):
+        return jsonify({"error": "since 必须是整数游标"}), 400
+    result = icons_changes_since(catalog_store().changes(file_name), since)
+    resp = jsonify(result)
+    resp.headers["X-Icons-Cursor"] = str(result["cursor"])
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+def _icons_json_response(file_name=GIST_FILE_NAME):
+    since_raw = request.args.get("since")
+    if since_raw is not None:
+        return _icons_json_changes_response(file_name, since_raw)
+
+    entry = _icons_json_cached(file_name)
+    compact = (request.args.get("compact") or "").strip().lower() in ("1", "true", "yes")
+    encoding = _icons_json_encoding()
+
+    # 使用 Response 而不是 jsonify，保证缩进 & Content-Type=application/json（?compact=1 返回紧凑格式）
+    resp = Response(_icons_json_variant(entry, compact, encoding), mimetype="application/json")
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.headers["Vary"] = "Accept-Encoding"
+    # 强 ETag：每种格式/编码各不相同
+    resp.set_etag(f"{entry['etag']}-{'c' if compact else 'p'}{('-' + encoding) if encoding else ''}")
+    if entry["last_modified"]:
+        resp.headers["Last-Modified"] = entry["last_modified"]
+    resp.headers["Cache-Control"] = "no-cache"
+    # 当前版本游标：之后可用 ?since=<游标> 增量同步
+    resp.headers["X-Icons-Cursor"] = str(entry["cursor"])
+    return resp.make_conditional(request)
+
 @app.get("/icons.json")
 def icons_json():
     try:
-        content = _read_icons_json_from_gist()
-        # 使用 Response 而不是 jsonify，保证缩进 & Content-Type=application/json
-        return Response(json.dumps(content, ensure_ascii=False, indent=2), mimetype="application/json")
+        return _icons_json_response()
     except Exception as e:
         return jsonify({"error": "无法读取 icons.json", "details": str(e)}), 500
 
 @app.get("/icons-square.json")
 def icons_square_json():
     try:
-        content = _read_icons_json_from_gist(file_name=_github_gist_file_for_folder("square"))
-        return Response(json.dumps(content, ensure_ascii=False, indent=2), mimetype="application/json")
+        return _icons_json_response(file_name=_github_gist_file_for_folder("square"))
     except Exception as e:
         return jsonify({"error": "无法读取 icons-square.json", "details": str(e)}), 500
 
 @app.get("/icons-circle.json")
 def icons_circle_json():
     try:
-        content = _read_icons_json_from_gist(file_name=_github_gist_file_for_folder("circle"))
-        return Response(json.dumps(content, ensure_ascii=False, indent=2), mimetype="application/json")
+        return _icons_json_response(file_name=_github_gist_file_for_folder("circle"))
     except Exception as e:
         return jsonify({"error": "无法读取 icons-circle.json", "details": str(e)}), 500
 
 @app.get("/icons-transparent.json")
 def icons_transparent_json():
     try:
-        content = _read_icons_json_from_gist(file_name=_github_gist_file_for_folder("transparent"))
-        return Response(json.dumps(content, ensure_ascii=False, indent=2), mimetype="application/json")
+        return _icons_json_response(file_name=_github_gist_file_for_folder("transparent"))
     except Exception as e:
         return jsonify({"error": "无法读取 icons-transparent.json", "details": str(e)}), 500
 
+# ===== 流式请求体：按块读取上传文件，避免整张图片 + base64 副本常驻内存 =====
+# 每个在途上传的峰值内存约为一个块（base64 后约 4/3 倍）
+UPLOAD_STREAM_CHUNK_SIZE = int((os.getenv("UPLOAD_STREAM_CHUNK_SIZE", "65536") or "65536").strip())
+
+def _stream_size(stream):
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+def _iter_stream(stream, chunk_size=None):
+    chunk_size = chunk_size or UPLOAD_STREAM_CHUNK_SIZE
+    stream.seek(0)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def _stream_sha256(stream):
+    """分块计算上传文件的 sha256（不把整张图读进内存）"""
+    h = hashlib.sha256()
+    for chunk in _iter_stream(stream):
+        h.update(chunk)
+    stream.seek(0)
+    return h.hexdigest()
+
+def _iter_stream_b64(stream, chunk_size=None):
+    """分块 base64：每块按 3 字节对齐，拼接结果与整体编码一致"""
+    chunk_size = chunk_size or UPLOAD_STREAM_CHUNK_SIZE
+    chunk_size = max(3, chunk_size - chunk_size % 3)
+    carry = b""
+    for chunk in _iter_stream(stream, chunk_size):
+        data = carry + chunk
+        cut = len(data) - len(data) % 3
+        carry = data[cut:]
+        if cut:
+            yield base64.b64encode(data[:cut])
+    if carry:
+        yield base64.b64encode(carry)
+
+class StreamingBody:
+    """
+    由若干段拼成的只读文件对象，作为 requests 的 data 发送：
+    - 段可以是 bytes，或 (返回 bytes 迭代器的工厂, 长度)
+    - 长度预先算好，发送 Content-Length 而不是 chunked
+    - 支持 seek(0)，连接池重试时可以重放
+    """
+
+    def __init__(self, parts):
+        self._parts = parts
+        self._len = sum(len(p) if isinstance(p, bytes) else p[1] for p in parts)
+        self.seek(0)
+
+    def __len__(self):
+        return self._len
+
+    def _iter_parts(self):
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                yield from part[0]()
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset != 0 or whence != os.SEEK_SET:
+            raise OSError("StreamingBody 只支持 seek(0)")
+        self._chunks = self._iter_parts()
+        self._buf = b""
+        self._off = 0
+        self._pos = 0
+        return 0
+
+    def read(self, size=-1):
+        out = []
+        need = size if size is not None and size >= 0 else None
+        while need is None or need > 0:
+            if self._off >= len(self._buf):
+                self._buf = next(self._chunks, b"")
+                self._off = 0
+                if not self._buf:
+                    break
+            end = len(self._buf) if need is None else min(len(self._buf), self._off + need)
+            piece = self._buf[self._off:end]
+            self._off = end
+            out.append(piece)
+            if need is not None:
+                need -= len(piece)
+        data = b"".join(out)
+        self._pos += len(data)
+        return data
+
+def _multipart_quote(value):
+    return str(value).replace("\\", "\\\\").replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+def _multipart_body(fields, file_field, image):
+    """构造流式 multipart/form-data 请求体，返回 (body, content_type)"""
+    boundary = os.urandom(16).hex()
+    stream = image.stream
+    size = _stream_size(stream)
+    parts = []
+    for k, v in (fields or {}).items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{_multipart_quote(k)}"\r\n\r\n{v}\r\n'.encode("utf-8")
+        )
+    parts.append(
+        (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{_multipart_quote(file_field)}"; '
+            f'filename="{_multipart_quote(image.filename or file_field)}"\r\n'
+            f'Content-Type: {image.mimetype or "application/octet-stream"}\r\n\r\n'
+        ).encode("utf-8")
+    )
+    parts.append((lambda: _iter_stream(stream), size))
+    parts.append(f"\r\n--{boundary}--\r\n".encode("utf-8"))
+    return StreamingBody(parts), f"multipart/form-data; boundary={boundary}"
+
+def _json_b64_body(fields, b64_field, stream):
+    """构造 {...fields, b64_field: "<base64>"} 形式的流式 JSON 请求体"""
+    size = _stream_size(stream)
+    head = json.dumps(fields, ensure_ascii=False)[:-1]
+    head += (", " if fields else "") + json.dumps(b64_field) + ': "'
+    b64_len = 4 * ((size + 2) // 3)
+    parts = [head.encode("utf-8"), (lambda: _iter_stream_b64(stream), b64_len), b'"}']
+    return StreamingBody(parts)
+
 # ===== 图片上传实现 =====
 
 def upload_to_picgo(img):
-    headers = {"X-API-Key": PICGO_API_KEY}
-    files = {"source": (img.filename, img.stream, img.mimetype)}
-    r = requests.post(PICGO_API_URL, files=files, headers=headers, timeout=30)
+    body, content_type = _multipart_body({}, "source", img)
+    headers = {"X-API-Key": PICGO_API_KEY, "Content-Type": content_type}
+    r = http_session("picgo").post(PICGO_API_URL, data=body, headers=headers, timeout=http_timeout("picgo"))
     r.raise_for_status()
     j = r.json()
     return (j.get("image") or {}).get("url", None)
 
 def upload_to_imgurl(img):
     form = {"uid": IMGURL_API_UID, "token": IMGURL_API_TOKEN}
-    files = {"file": (img.filename, img.stream, img.mimetype)}
-    r = requests.post(IMGURL_API_URL, data=form, files=files, timeout=30)
+    body, content_type = _multipart_body(form, "file", img)
+    headers = {"Content-Type": content_type}
+    r = http_session("imgurl").post(IMGURL_API_URL, data=body, headers=headers, timeout=http_timeout("imgurl"))
     r.raise_for_status()
     j = r.json()
     if "data" in j and "url" in j["data"]:
@@ -274,7 +1959,6 @@ def upload_to_picui(image):
         "Accept": "application/json",
         "Authorization": f"Bearer {token}",
     }
-    files = {"file": (image.filename, image.stream, image.mimetype)}
     data = {}
 
     permission = os.getenv("PICUI_PERMISSION", "0").strip()
@@ -290,14 +1974,17 @@ def upload_to_picui(image):
     if expired_at:
         data["expired_at"] = expired_at
 
+    body, headers["Content-Type"] = _multipart_body(data, "file", image)
+
     try:
-        r = requests.post(PICUI_UPLOAD_URL, headers=headers, data=data, files=files, timeout=30)
+        r = http_session("picui").post(PICUI_UPLOAD_URL, headers=headers, data=body, timeout=http_timeout("picui"))
         if r.status_code != 200:
             print("PICUI 上传失败：", r.status_code, r.text)
             return None
         j = r.json()
         if not j.get("status"):
             return None
+        picui_mirror.add(j["data"])
         return j["data"]["links"]["url"]
     except Exception as e:
         print("PICUI 异常：", e)
@@ -398,12 +2085,14 @@ def _github_repo_build_file_url(owner: str, repo: str, branch: str, rel_path: st
     return f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{rel_path_q}"
 
 
-def _github_repo_put_new_file(owner: str, repo: str, branch: str, rel_path: str, content_b64: str, message: str):
+def _github_repo_put_new_file(owner: str, repo: str, branch: str, rel_path: str, stream, message: str):
     api_path = quote((rel_path or "").lstrip("/"), safe="/")
     url = f"https://api.github.com/repos/{owner}/{repo}/contents/{api_path}"
-    payload = {"message": message, "content": content_b64, "branch": branch}
+    # 请求体边读文件边 base64，不在内存中保留整份编码结果
+    body = _json_b64_body({"message": message, "branch": branch}, "content", stream)
+    headers = {**_github_repo_headers(), "Content-Type": "application/json"}
 
-    r = requests.put(url, headers=_github_repo_headers(), json=payload, timeout=30)
+    r = http_session("github").put(url, headers=headers, data=body, timeout=http_timeout("github"))
     if r.status_code in (200, 201):
         return True, None
 
@@ -450,29 +2139,143 @@ def _github_gist_file_for_folder(folder: str):
         return (GITHUB_GIST_FILE_TRANSPARENT or "").strip() or GIST_FILE_NAME
     return GIST_FILE_NAME
 
-def upload_to_github_repo(image, icon_name: str, folder: str = ""):
-    owner, repo = _github_repo_owner_and_name()
-    branch = (GITHUB_REPO_BRANCH or "main").strip() or "main"
+def _github_repo_target_dir(folder: str = ""):
     repo_dir = (GITHUB_REPO_DIR or "").strip().strip("/")
     folder = _normalize_github_folder(folder)
     if folder:
         repo_dir = f"{repo_dir}/{folder}" if repo_dir else folder
+    return repo_dir
 
+def _github_repo_file_parts(image, icon_name: str):
+    """返回 (文件名主体, 扩展名)"""
     base = _sanitize_repo_filename_base(icon_name or os.path.splitext(getattr(image, "filename", "") or "")[0] or "image")
     ext = _guess_image_ext(getattr(image, "filename", "") or "", getattr(image, "mimetype", "") or "")
+    return base, ext
 
-    try:
-        image.stream.seek(0)
-    except Exception:
-        pass
-    raw_bytes = image.read()
-    if not raw_bytes:
+def _github_repo_request(method: str, owner: str, repo: str, path: str, **kwargs):
+    url = f"https://api.github.com/repos/{owner}/{repo}/{path.lstrip('/')}"
+    headers = {**_github_repo_headers(), **(kwargs.pop("headers", None) or {})}
+    return http_session("github").request(method, url, headers=headers, timeout=http_timeout("github"), **kwargs)
+
+def _github_repo_json(r, what: str):
+    if r.status_code not in (200, 201):
+        raise Exception(f"GitHub {what} 失败：HTTP {r.status_code} {r.text}")
+    return r.json()
+
+def _github_repo_list_dir(owner: str, repo: str, ref: str, repo_dir: str):
+    """
+    列出 ref 下某个目录中已有的文件名；ref 存在、只是目录不存在时返回空集合。
+    仓库 / ref 不存在（或 token 无权访问）、清单被截断时抛异常，不能当成空目录（对账会据此删除条目）
+    """
+    tree_ish = quote(f"{ref}:{repo_dir}" if repo_dir else ref, safe="/:")
+    r = _github_repo_request("GET", owner, repo, f"git/trees/{tree_ish}")
+    if r.status_code == 404 and repo_dir:
+        root = _github_repo_request("GET", owner, repo, f"git/trees/{quote(ref, safe='/')}")
+        if root.status_code != 404:
+            _github_repo_json(root, "读取分支")
+            return set()
+    if r.status_code == 404:
+        raise Exception(f"GitHub 读取目录失败：{owner}/{repo} 不存在 {ref}，或 token 无权访问")
+    j = _github_repo_json(r, "读取目录")
+    if j.get("truncated"):
+        raise Exception(f"GitHub 目录 {repo_dir or '/'} 的清单被截断，无法得到完整文件列表")
+    return {it.get("path") for it in (j.get("tree") or []) if it.get("type") == "blob" and it.get("path")}
+
+# 目标目录文件名缓存：先列一次目录，在本地挑好不冲突的文件名，只发一次 PUT
+GITHUB_REPO_DIR_CACHE_TTL = float((os.getenv("GITHUB_REPO_DIR_CACHE_TTL", "300") or "300").strip())
+GITHUB_REPO_PUT_ATTEMPTS = 3
+# 重建索引时沿用多久以内的占位（PUT 可能还在进行中，目录清单里还看不到）
+GITHUB_REPO_RESERVE_SECONDS = 120
+
+class RepoDirIndex:
+    """仓库某个目录下的文件名集合 + 每个 (主体, 扩展名) 的下一个候选序号"""
+
+    def __init__(self, names, reserved=None):
+        self._reserved = dict(reserved or {})  # 本进程挑出的文件名 -> 占位时间
+        self.names = set(names or ()) | self._reserved.keys()
+        self._next_suffix = {}
+        self._lock = threading.Lock()
+
+    def recent_reservations(self, max_age: float):
+        now = time.time()
+        with self._lock:
+            return {name: at for name, at in self._reserved.items() if now - at < max_age}
+
+    def pick(self, base: str, ext: str):
+        """挑一个未占用的文件名并立即占位：base.ext, base1.ext, base2.ext..."""
+        with self._lock:
+            filename = f"{base}{ext}"
+            if filename in self.names:
+                counter = self._next_suffix.get((base, ext), 1)
+                while f"{base}{counter}{ext}" in self.names:
+                    counter += 1
+                self._next_suffix[(base, ext)] = counter + 1
+                filename = f"{base}{counter}{ext}"
+            self.names.add(filename)
+            self._reserved[filename] = time.time()
+            return filename
+
+_github_repo_dir_cache = {}  # (owner, repo, branch, repo_dir) -> {"index", "expires_at"}
+_github_repo_dir_lock = threading.Lock()
+_github_repo_dir_fill_locks = {}  # 同一目录同时只重建一次：并发请求必须共用同一个索引，各建一个就会挑出同名文件
+
+def _github_repo_dir_index(owner: str, repo: str, branch: str, repo_dir: str, stale=None):
+    """
+    取某个目录的共享文件名索引（所有上传入口都从这里挑文件名）。
+    stale：调用方手里已失效的索引（PUT 遇到同名文件）；缓存仍是它时才重新列目录
+    """
+    key = (owner, repo, branch, repo_dir)
+
+    def cached():
+        entry = _github_repo_dir_cache.get(key)
+        if entry and entry["index"] is not stale and entry["expires_at"] > time.time():
+            return entry["index"]
+        return None
+
+    with _github_repo_dir_lock:
+        index = cached()
+        if index is not None:
+            return index
+        fill_lock = _github_repo_dir_fill_locks.setdefault(key, threading.Lock())
+
+    with fill_lock:
+        with _github_repo_dir_lock:
+            index = cached()  # 等锁期间别的请求已经重建过
+            entry = _github_repo_dir_cache.get(key)
+        if index is not None:
+            return index
+        try:
+            names = _github_repo_list_dir(owner, repo, branch, repo_dir)
+        except Exception as e:
+            # 列目录失败：沿用旧索引（已占位的名字仍有效），没有则退化为空索引，冲突由 PUT 的 422 兜底
+            print("GitHub Repo 列目录失败：", e)
+            if entry:
+                return entry["index"]
+            names = set()
+
+        # 新清单里还看不到正在上传的文件：保留旧索引中最近的占位
+        reserved = entry["index"].recent_reservations(GITHUB_REPO_RESERVE_SECONDS) if entry else None
+        index = RepoDirIndex(names, reserved)
+        with _github_repo_dir_lock:
+            _github_repo_dir_cache[key] = {"index": index, "expires_at": time.time() + GITHUB_REPO_DIR_CACHE_TTL}
+        return index
+
+def _invalidate_github_repo_dir(owner: str, repo: str, branch: str, repo_dir: str):
+    with _github_repo_dir_lock:
+        _github_repo_dir_cache.pop((owner, repo, branch, repo_dir), None)
+
+def upload_to_github_repo(image, icon_name: str, folder: str = ""):
+    owner, repo = _github_repo_owner_and_name()
+    branch = (GITHUB_REPO_BRANCH or "main").strip() or "main"
+    repo_dir = _github_repo_target_dir(folder)
+    base, ext = _github_repo_file_parts(image, icon_name)
+
+    if not _stream_size(image.stream):
         raise Exception("空文件")
-    content_b64 = base64.b64encode(raw_bytes).decode("utf-8")
 
-    for i in range(0, 100):
-        suffix = "" if i == 0 else str(i)
-        filename = f"{base}{suffix}{ext}"
+    dir_index = _github_repo_dir_index(owner, repo, branch, repo_dir)
+    for _ in range(GITHUB_REPO_PUT_ATTEMPTS):
+        filename = dir_index.pick(base, ext)
         rel_path = f"{repo_dir}/{filename}" if repo_dir else filename
 
         ok, reason = _github_repo_put_new_file(
@@ -480,15 +2283,115 @@ def upload_to_github_repo(image, icon_name: str, folder: str = ""):
             repo=repo,
             branch=branch,
             rel_path=rel_path,
-            content_b64=content_b64,
+            stream=image.stream,
             message=_github_repo_commit_message(filename),
         )
         if ok:
             return _github_repo_build_file_url(owner, repo, branch, rel_path)
         if reason == "exists":
+            # 缓存过期（别的实例/手动提交），重新列目录
+            dir_index = _github_repo_dir_index(owner, repo, branch, repo_dir, stale=dir_index)
             continue
 
-    raise Exception("GitHub Repo 重名过多，无法生成唯一文件名")
+    raise Exception("GitHub Repo 文件名冲突，请稍后重试")
+
+# ===== GitHub Repo 批量提交（Git Data API）=====
+# GITHUB_REPO_BATCH_COMMIT=1 时，一次上传请求：并发创建 blob -> 一个 tree -> 一个 commit -> 更新一次分支
+GITHUB_REPO_BATCH_COMMIT = (os.getenv("GITHUB_REPO_BATCH_COMMIT", "0") or "0").strip() == "1"
+GITHUB_REPO_BLOB_CONCURRENCY = int((os.getenv("GITHUB_REPO_BLOB_CONCURRENCY", "4") or "4").strip())
+GITHUB_REPO_REF_RETRY = 3
+# 本进程内的分支更新串行执行：并发上传各自基于同一个 head 提交只会互相顶成非快进，重试耗尽后整批失败
+_github_repo_ref_lock = threading.Lock()
+
+def _github_repo_create_blob(owner: str, repo: str, stream):
+    body = _json_b64_body({"encoding": "base64"}, "content", stream)
+    r = _github_repo_request("POST", owner, repo, "git/blobs", data=body, headers={"Content-Type": "application/json"})
+    return _github_repo_json(r, "创建 blob")["sha"]
+
+def _github_repo_batch_message(filenames):
+    if len(filenames) == 1:
+        return _github_repo_commit_message(filenames[0])
+    if len(filenames) <= 3:
+        return _github_repo_commit_message(", ".join(filenames))
+    return _github_repo_commit_message(f"{filenames[0]} 等 {len(filenames)} 个文件")
+
+def upload_batch_to_github_repo(items, folder: str = ""):
+    """
+    items: [(image, icon_name)]
+    Return: 与 items 对齐的 [(image_url, upload_err)]
+    """
+    outcomes = [(None, None)] * len(items)
+    owner, repo = _github_repo_owner_and_name()
+    branch = (GITHUB_REPO_BRANCH or "main").strip() or "main"
+    repo_dir = _github_repo_target_dir(folder)
+
+    # 1) 并发创建 blob（blob 与分支无关，可以安全并行）
+    blobs = {}  # idx -> sha
+    pending = {}
+    workers = max(1, min(GITHUB_REPO_BLOB_CONCURRENCY, len(items) or 1))
+    with ContextThreadPoolExecutor(max_workers=workers) as pool:
+        for idx, (image, _) in enumerate(items):
+            if not _stream_size(image.stream):
+                outcomes[idx] = (None, "空文件")
+                continue
+            pending[pool.submit(_github_repo_create_blob, owner, repo, image.stream)] = idx
+        for fut in as_completed(pending):
+            idx = pending[fut]
+            try:
+                blobs[idx] = fut.result()
+            except Exception as e:
+                outcomes[idx] = (None, str(e))
+
+    if not blobs:
+        return outcomes
+
+    # 2) 一个 tree + 一个 commit + 更新一次分支；分支被其他实例推进时基于新 head 重试
+    try:
+        with _github_repo_ref_lock:
+            for _ in range(GITHUB_REPO_REF_RETRY):
+                ref = _github_repo_json(_github_repo_request("GET", owner, repo, f"git/ref/heads/{quote(branch, safe='/')}"), "读取分支")
+                head_sha = ref["object"]["sha"]
+                commit = _github_repo_json(_github_repo_request("GET", owner, repo, f"git/commits/{head_sha}"), "读取 commit")
+
+                dir_index = RepoDirIndex(_github_repo_list_dir(owner, repo, head_sha, repo_dir))
+                paths = {}
+                tree = []
+                for idx in sorted(blobs):
+                    base, ext = _github_repo_file_parts(items[idx][0], items[idx][1])
+                    filename = dir_index.pick(base, ext)
+                    rel_path = f"{repo_dir}/{filename}" if repo_dir else filename
+                    paths[idx] = rel_path
+                    tree.append({"path": rel_path, "mode": "100644", "type": "blob", "sha": blobs[idx]})
+
+                new_tree = _github_repo_json(
+                    _github_repo_request("POST", owner, repo, "git/trees", json={"base_tree": commit["tree"]["sha"], "tree": tree}),
+                    "创建 tree",
+                )
+                message = _github_repo_batch_message([p.rsplit("/", 1)[-1] for p in paths.values()])
+                new_commit = _github_repo_json(
+                    _github_repo_request("POST", owner, repo, "git/commits", json={"message": message, "tree": new_tree["sha"], "parents": [head_sha]}),
+                    "创建 commit",
+                )
+                r = _github_repo_request(
+                    "PATCH", owner, repo, f"git/refs/heads/{quote(branch, safe='/')}",
+                    json={"sha": new_commit["sha"], "force": False},
+                )
+                if r.status_code == 200:
+                    break
+                if r.status_code == 422:
+                    continue  # 非快进：分支已被别人推进
+                _github_repo_json(r, "更新分支")
+            else:
+                raise Exception("GitHub 分支并发更新冲突，请稍后重试")
+    except Exception as e:
+        for idx in blobs:
+            outcomes[idx] = (None, str(e))
+        return outcomes
+
+    _invalidate_github_repo_dir(owner, repo, branch, repo_dir)
+    for idx, rel_path in paths.items():
+        outcomes[idx] = (_github_repo_build_file_url(owner, repo, branch, rel_path), None)
+    return outcomes
 
 # ===== Admin åŽå°ï¼šPICUI åˆ—è¡¨/åˆ é™¤æŽ¥å£å°è£… =====
 PICUI_API_BASE = "https://picui.cn/api/v1"
@@ -503,15 +2406,282 @@ def picui_list_images(page=1, q=None):
     params = {"page": page}
     if q:
         params["q"] = q
-    r = requests.get(f"{PICUI_API_BASE}/images", headers=_picui_headers(), params=params, timeout=30)
+    r = http_session("picui").get(f"{PICUI_API_BASE}/images", headers=_picui_headers(), params=params, timeout=http_timeout("picui"))
     r.raise_for_status()
     return r.json()
 
-def picui_delete_by_key(key: str):
-    r = requests.delete(f"{PICUI_API_BASE}/images/{key}", headers=_picui_headers(), timeout=30)
+def picui_delete_by_key(key: str, timeout=None):
+    timeout = http_timeout("picui") if timeout is None else timeout
+    r = http_session("picui").delete(f"{PICUI_API_BASE}/images/{key}", headers=_picui_headers(), timeout=timeout)
     r.raise_for_status()
     return r.json()
 
+# ===== PICUI 图库本地镜像：管理后台的排序 / 筛选 / 搜索 / 分页都在本地完成 =====
+# 首次访问（或超过 PICUI_MIRROR_FULL_TTL）时并发拉取全部页；之后超过 PICUI_MIRROR_TTL 只从第 1 页往后拉到已知的图片为止。
+# 总数对不上（在 PICUI 网页端删过图等）时自动退回全量拉取。镜像同时保存到 PICUI_MIRROR_PATH，冷启动后直接复用。
+# PICUI_MIRROR=0 时管理后台退回“1 页 = PICUI 的 1 页”的旧模式。
+PICUI_MIRROR = (os.getenv("PICUI_MIRROR", "1") or "1").strip() == "1"
+PICUI_MIRROR_TTL = float((os.getenv("PICUI_MIRROR_TTL", "60") or "60").strip())
+PICUI_MIRROR_FULL_TTL = float((os.getenv("PICUI_MIRROR_FULL_TTL", "3600") or "3600").strip())
+PICUI_MIRROR_CONCURRENCY = int((os.getenv("PICUI_MIRROR_CONCURRENCY", "6") or "6").strip())
+PICUI_MIRROR_INCREMENTAL_PAGES = int((os.getenv("PICUI_MIRROR_INCREMENTAL_PAGES", "5") or "5").strip())
+PICUI_MIRROR_PATH = (os.getenv("PICUI_MIRROR_PATH", "") or "").strip() or os.path.join(
+    tempfile.gettempdir(), "tubiaoku-picui-mirror.json"
+)
+ADMIN_PAGE_SIZES = (20, 40, 100, 200, 500)
+ADMIN_SORTS = ("date", "name", "key", "size", "icon_name")
+
+def _picui_image_row(img):
+    """PICUI 图片对象 -> 镜像中保存的精简字段"""
+    links = img.get("links") or {}
+    return {
+        "key": str(img.get("key") or img.get("id") or ""),
+        "url": links.get("url") or img.get("url") or "",
+        "name": img.get("origin_name") or img.get("name") or "",
+        "size": img.get("size") or 0,
+        "width": img.get("width"),
+        "height": img.get("height"),
+        "date": img.get("date") or img.get("human_date") or "",
+    }
+
+class PicuiMirror:
+    """
+    PICUI 图库的内存镜像（PICUI 默认按上传时间倒序列出，rows 保持同样的顺序）。
+    generation 在内容变化时 +1，与目录版本一起作为联表 / 排序 / 搜索索引的缓存键。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self.rows = []
+        self.by_key = {}
+        self.generation = 0
+        self.checked_at = 0.0  # 最近一次（增量或全量）同步时间
+        self.full_at = 0.0  # 最近一次全量同步时间
+        self.total = 0
+        self._view = None  # (generation, 目录版本, 联表结果)
+        self._load_file()
+
+    def _load_file(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._replace(data.get("rows") or [], data.get("full_at") or 0.0)
+            self.checked_at = data.get("checked_at") or 0.0
+        except (OSError, ValueError):
+            pass
+
+    def _save_file(self):
+        with self._lock:
+            data = {"rows": self.rows, "full_at": self.full_at, "checked_at": self.checked_at}
+        try:
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"保存 PICUI 镜像失败（不影响使用）: {e}")
+
+    def _replace(self, rows, full_at=None):
+        with self._lock:
+            self.rows = rows
+            self.by_key = {row["key"]: row for row in rows}
+            self.total = len(rows)
+            self.generation += 1
+            if full_at is not None:
+                self.full_at = full_at
+
+    def clear(self):
+        """丢弃镜像，下次访问重新全量同步"""
+        self._replace([], full_at=0.0)
+        self.checked_at = 0.0
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    # ----- 本地增删（上传 / 管理后台删除后立即反映，不必等下一次同步）-----
+    def add(self, img):
+        row = _picui_image_row(img)
+        with self._lock:
+            if not self.full_at or not row["key"] or row["key"] in self.by_key:
+                return
+            self.rows = [row] + self.rows
+            self.by_key[row["key"]] = row
+            self.total += 1
+            self.generation += 1
+
+    def remove_keys(self, keys):
+        keys = set(k for k in keys if k)
+        with self._lock:
+            if not keys & self.by_key.keys():
+                return
+            self.rows = [row for row in self.rows if row["key"] not in keys]
+            for key in keys:
+                self.by_key.pop(key, None)
+            self.total = len(self.rows)
+            self.generation += 1
+
+    # ----- 同步 -----
+    @staticmethod
+    def _page(page):
+        data = (picui_list_images(page=page) or {}).get("data") or {}
+        rows = [_picui_image_row(img) for img in (data.get("data") or [])]
+        return rows, int(data.get("last_page") or 1), int(data.get("total") or 0)
+
+    def refresh_full(self):
+        first, last_page, _ = self._page(1)
+        pages = {1: first}
+        if last_page > 1:
+            pool = ContextThreadPoolExecutor(max_workers=max(1, min(PICUI_MIRROR_CONCURRENCY, last_page - 1)))
+            try:
+                futures = {pool.submit(self._page, n): n for n in range(2, last_page + 1)}
+                for fut in as_completed(futures):
+                    pages[futures[fut]] = fut.result()[0]
+            finally:
+                pool.shutdown(wait=False, cancel_futures=True)
+        rows = []
+        seen = set()
+        for n in sorted(pages):
+            # 拉取期间有新上传会让后面的页整体后移，同一张图可能出现两次
+            for row in pages[n]:
+                if row["key"] and row["key"] not in seen:
+                    seen.add(row["key"])
+                    rows.append(row)
+        now = time.time()
+        self._replace(rows, full_at=now)
+        self.checked_at = now
+
+    def refresh_incremental(self):
+        """从第 1 页往后拉，直到遇到已知图片；返回 False 表示需要全量同步"""
+        with self._lock:
+            known = set(self.by_key)
+        fresh = []
+        page, total = 1, None
+        while True:
+            rows, last_page, page_total = self._page(page)
+            total = page_total if total is None else total
+            new_rows = [row for row in rows if row["key"] and row["key"] not in known]
+            fresh.extend(new_rows)
+            if len(new_rows) < len(rows) or page >= last_page:
+                break
+            page += 1
+            if page > PICUI_MIRROR_INCREMENTAL_PAGES:
+                return False
+        fresh_keys = {row["key"] for row in fresh}
+        with self._lock:
+            rows = fresh + [row for row in self.rows if row["key"] not in fresh_keys]
+        if total is not None and total != len(rows):
+            return False
+        if fresh:
+            self._replace(rows)
+        self.checked_at = time.time()
+        return True
+
+    def ensure_fresh(self, force=False):
+        """按 TTL 同步；已有数据且另一个请求正在同步时直接用现有数据"""
+        def due():
+            now = time.time()
+            need_full = not self.full_at or now - self.full_at >= PICUI_MIRROR_FULL_TTL
+            return need_full, need_full or force or now - self.checked_at >= PICUI_MIRROR_TTL
+
+        need_full, stale = due()
+        if not stale:
+            return
+        if not self._refresh_lock.acquire(blocking=not self.full_at):
+            return
+        try:
+            need_full, stale = due()
+            if not stale:  # 等锁期间别的请求已经同步过了
+                return
+            if need_full or not self.refresh_incremental():
+                self.refresh_full()
+            self._save_file()
+        finally:
+            self._refresh_lock.release()
+
+    def sync_full(self):
+        """等待正在进行的同步结束后做一次全量同步（对账需要完整列表）"""
+        with self._refresh_lock:
+            self.refresh_full()
+            self._save_file()
+
+    # ----- 查询 -----
+    def _joined(self):
+        """镜像 × 目录 URL 索引：每行加上 in_gist / icon_name，并预建排序与前缀搜索索引"""
+        store = catalog_store()
+        token = store.document_version()[0]
+        with self._lock:
+            rows, generation = self.rows, self.generation
+            view = self._view
+        if view and view[0] == generation and token and view[1] == token:
+            return view[2]
+        by_url = store.catalog().by_url
+        joined = []
+        terms = []
+        for idx, row in enumerate(rows):
+            icon = by_url.get(row["url"])
+            icon_name = icon.get("name") if icon else None
+            joined.append({**row, "in_gist": bool(icon), "icon_name": icon_name})
+            basename = row["url"].rsplit("/", 1)[-1]
+            for term in {row["key"], row["name"], basename, icon_name or ""}:
+                if term:
+                    terms.append((term.lower(), idx))
+        terms.sort()
+        view = {"rows": joined, "terms": terms, "orders": {}, "in_gist": sum(1 for r in joined if r["in_gist"])}
+        with self._lock:
+            self._view = (generation, token, view)
+        return view
+
+    def query(self, q=None, filter_by="all", sort="", page=1, per_page=40):
+        view = self._joined()
+        rows = view["rows"]
+        if q:
+            # 前缀搜索：key / 原始文件名 / URL 文件名 / 图标名，二分定位后顺序扫描命中区间
+            q = q.lower()
+            terms = view["terms"]
+            start = bisect.bisect_left(terms, (q, -1))
+            hits = set()
+            for term, idx in terms[start:]:
+                if not term.startswith(q):
+                    break
+                hits.add(idx)
+            indices = sorted(hits)
+        else:
+            indices = range(len(rows))
+
+        field = sort.lstrip("-")
+        if field in ADMIN_SORTS:
+            order = view["orders"].get(field)
+            if order is None:
+                def sort_key(i):
+                    value = rows[i].get(field)
+                    return (value is None, value.lower() if isinstance(value, str) else (value if value is not None else 0))
+
+                order = sorted(range(len(rows)), key=sort_key)
+                rank = [0] * len(rows)
+                for pos, i in enumerate(order):
+                    rank[i] = pos
+                order = view["orders"][field] = rank
+            indices = sorted(indices, key=order.__getitem__, reverse=sort.startswith("-"))
+
+        if filter_by == "in_gist":
+            indices = [i for i in indices if rows[i]["in_gist"]]
+        elif filter_by == "orphan":
+            indices = [i for i in indices if not rows[i]["in_gist"]]
+        else:
+            indices = list(indices)
+
+        total = len(indices)
+        last_page = max(1, (total + per_page - 1) // per_page)
+        page = min(max(1, page), last_page)
+        items = [rows[i] for i in indices[(page - 1) * per_page: page * per_page]]
+        return {"items": items, "page": page, "per_page": per_page, "last_page": last_page, "total": total,
+                "library_total": len(rows), "in_gist": view["in_gist"]}
+
+picui_mirror = PicuiMirror(PICUI_MIRROR_PATH)
+
 # ===================== 路由逻辑 =====================
 
 @app.route("/")
@@ -581,19 +2751,57 @@ def api_admin_logout():
 @require_admin
 def api_admin_images():
     """
-    方案 A：管理页 1 页 = PICUI 的 1 页
-    - page: PICUI 页码
-    - q: 可选搜索
+    默认走 PICUI 本地镜像（PICUI_MIRROR=1）：
+    - page / per_page: 页码与每页条数（ADMIN_PAGE_SIZES）
+    - q: 前缀搜索（key / 原始文件名 / URL 文件名 / 图标名）
+    - filter: all / in_gist / orphan（未收录）
+    - sort: date / name / key / size / icon_name，前缀 - 表示倒序；不传则按 PICUI 顺序（最新在前）
+    - refresh=1: 先做一次增量同步
+    镜像不可用时退回方案 A：管理页 1 页 = PICUI 的 1 页（q 交给 PICUI 搜索）
     """
-    page = int(request.args.get("page", "1"))
+    try:
+        page = int(request.args.get("page", "1"))
+        per_page = int(request.args.get("per_page", "40"))
+    except ValueError:
+        return jsonify({"ok": False, "message": "page / per_page 必须是整数"}), 400
     q = (request.args.get("q") or "").strip() or None
 
+    if PICUI_MIRROR:
+        filter_by = (request.args.get("filter") or "all").strip()
+        sort = (request.args.get("sort") or "").strip()
+        if per_page not in ADMIN_PAGE_SIZES:
+            return jsonify({"ok": False, "message": f"per_page 可选：{', '.join(map(str, ADMIN_PAGE_SIZES))}"}), 400
+        if filter_by not in ("all", "in_gist", "orphan"):
+            return jsonify({"ok": False, "message": "filter 可选：all / in_gist / orphan"}), 400
+        if sort and sort.lstrip("-") not in ADMIN_SORTS:
+            return jsonify({"ok": False, "message": f"sort 可选：{' / '.join(ADMIN_SORTS)}（前缀 - 倒序）"}), 400
+        try:
+            picui_mirror.ensure_fresh(force=request.args.get("refresh") == "1")
+        except Exception as e:
+            print(f"PICUI 镜像同步失败，{'使用旧数据' if picui_mirror.rows else '退回逐页模式'}: {e}")
+        if picui_mirror.full_at:
+            result = picui_mirror.query(q=q, filter_by=filter_by, sort=sort, page=page, per_page=per_page)
+            return jsonify({
+                "ok": True,
+                "page": result["page"],
+                "items": result["items"],
+                "picui": {
+                    "per_page": result["per_page"],
+                    "last_page": result["last_page"],
+                    "total": result["total"],
+                    "library_total": result["library_total"],
+                    "synced_at": picui_mirror.checked_at,
+                },
+                "raw_icons_json": url_for("icons_json", _external=True),
+                "gist_stats": {"count": len(catalog_store().catalog().icons), "in_picui": result["in_gist"]},
+            })
+
     pj = picui_list_images(page=page, q=q)
 
     # 读一次 Gist（只读，不写）
-    content = _read_icons_json_from_gist()
-    icons = content.get("icons", []) or []
-    by_url = {it.get("url"): it for it in icons if it.get("url")}
+    catalog = catalog_store().catalog()
+    icons = catalog.icons
+    by_url = catalog.by_url
     raw_url = url_for("icons_json", _external=True)
 
     data_obj = (pj.get("data", {}) or {})
@@ -628,13 +2836,29 @@ def api_admin_images():
         "gist_stats": {"count": len(icons)}
     })
 
+# 批量删除：PICUI 并发数 + 整体截止时间（秒，需小于函数超时）
+ADMIN_DELETE_CONCURRENCY = int((os.getenv("ADMIN_DELETE_CONCURRENCY", "8") or "8").strip())
+ADMIN_DELETE_DEADLINE = float((os.getenv("ADMIN_DELETE_DEADLINE", "25") or "25").strip())
+
+def _picui_delete_timed(key: str, deadline: float):
+    """在截止时间内删除单个 key，返回 (error, latency_ms)"""
+    started = time.time()
+    remaining = deadline - started
+    if remaining <= 0:
+        return "deadline exceeded", 0
+    try:
+        picui_delete_by_key(key, timeout=min(http_timeout("picui"), remaining))
+        return None, int((time.time() - started) * 1000)
+    except Exception as e:
+        return str(e), int((time.time() - started) * 1000)
+
 @app.post("/api/admin/delete")
 @require_admin
 def api_admin_delete():
     """
     一致性保证（你要求的）：
-    - 先删 PICUI
-    - 只有 PICUI 删除成功的，才从 icons.json 移除
+    - 先删 PICUI（并发，受 ADMIN_DELETE_CONCURRENCY / ADMIN_DELETE_DEADLINE 限制）
+    - 只有 PICUI 删除成功的，才从 icons.json 移除（超时未完成的一律视为失败）
     - 批量删除：Gist 更新合并为一次 PATCH
     """
     data = request.get_json(silent=True) or {}
@@ -642,39 +2866,756 @@ def api_admin_delete():
     if not isinstance(items, list) or not items:
         return jsonify({"ok": False, "message": "items 不能为空"}), 400
 
-    picui_results = []
+    deadline = time.time() + ADMIN_DELETE_DEADLINE
+    picui_results = [None] * len(items)
     urls_to_remove = set()
+    futures = {}
 
-    for it in items:
-        key = (it.get("key") or "").strip()
-        url = (it.get("url") or "").strip()
+    pool = ContextThreadPoolExecutor(max_workers=max(1, min(ADMIN_DELETE_CONCURRENCY, len(items))))
+    try:
+        for idx, it in enumerate(items):
+            key = (it.get("key") or "").strip()
+            url = (it.get("url") or "").strip()
+
+            if not key:
+                picui_results[idx] = {"ok": False, "key": key, "url": url, "error": "missing key"}
+                continue
+            futures[pool.submit(_picui_delete_timed, key, deadline)] = (idx, key, url)
 
-        if not key:
-            picui_results.append({"ok": False, "key": key, "url": url, "error": "missing key"})
+        wait(futures, timeout=max(0, deadline - time.time()))
+    finally:
+        # 超时未开始的直接取消，已在途的让它在后台结束，不再等待
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    for fut, (idx, key, url) in futures.items():
+        if not fut.done() or fut.cancelled():
+            picui_results[idx] = {"ok": False, "key": key, "url": url, "error": "deadline exceeded", "latency_ms": None}
+            continue
+        err, latency_ms = fut.result()
+        if err:
+            picui_results[idx] = {"ok": False, "key": key, "url": url, "error": err, "latency_ms": latency_ms}
             continue
+        picui_results[idx] = {"ok": True, "key": key, "url": url, "latency_ms": latency_ms}
+        if url:
+            urls_to_remove.add(url)  # 关键：只收集成功的
 
-        try:
-            picui_delete_by_key(key)
-            picui_results.append({"ok": True, "key": key, "url": url})
-            if url:
-                urls_to_remove.add(url)  # 关键：只收集成功的
-        except Exception as e:
-            picui_results.append({"ok": False, "key": key, "url": url, "error": str(e)})
+    picui_mirror.remove_keys(r["key"] for r in picui_results if r and r["ok"])
 
     gist_summary = {"before": None, "after": None, "removed": 0}
     if urls_to_remove:
-        gist_summary = gist_remove_icons_by_urls(urls_to_remove)
+        try:
+            gist_summary = gist_remove_icons_by_urls(urls_to_remove)
+        except Exception as e:
+            # PICUI 已删除成功，Gist 未能同步：逐项告知哪些 URL 仍留在 icons.json 中
+            warning = f"图片已从 PICUI 删除但 Gist 同步失败: {str(e)}"
+            for r in picui_results:
+                if r and r["ok"] and r["url"] in urls_to_remove:
+                    r["warning"] = warning
+            gist_summary = {"before": None, "after": None, "removed": 0, "error": str(e), "pending_urls": sorted(urls_to_remove)}
 
     return jsonify({"ok": True, "picui": picui_results, "gist": gist_summary})
 
+# ===== 对账：后端实际存在的图片 vs 各目录（icons*.json）=====
+# - orphan（孤儿）：后端有、但所有目录里都没有（例如“图片已上传但 Gist 阶段同步失败”）
+# - dangling（悬空）：目录里有、但后端已经没有（在 PICUI 网页端删过图等）
+# 后端清单并发拉取：PICUI 全部页（同时刷新管理后台镜像）+ GitHub 仓库各分类目录的 git tree。
+# 某个后端清单拉取失败时，它的悬空条目一律不报告（清单不完整时不能据此删除）。
+RECONCILE_GITHUB_FOLDERS = ("", "square", "circle", "transparent")
+
+def _reconcile_list_picui():
+    """返回 {url: 建议的图标名}，以及 PICUI 图片所在的域名集合（用于判断目录条目是否属于 PICUI）"""
+    picui_mirror.sync_full()
+    urls = {}
+    for row in picui_mirror.rows:
+        if row["url"]:
+            urls[row["url"]] = os.path.splitext(row["name"])[0] or row["key"]
+    return urls, {urlsplit(url).netloc for url in urls}
+
+def _reconcile_list_github(folder: str):
+    """返回 ({url: 建议的图标名}, 该目录的 URL 前缀)"""
+    owner, repo = _github_repo_owner_and_name()
+    branch = (GITHUB_REPO_BRANCH or "main").strip() or "main"
+    repo_dir = _github_repo_target_dir(folder)
+    names = _github_repo_list_dir(owner, repo, branch, repo_dir)
+    prefix = _github_repo_build_file_url(owner, repo, branch, f"{repo_dir}/" if repo_dir else "")
+    urls = {
+        _github_repo_build_file_url(owner, repo, branch, f"{repo_dir}/{name}" if repo_dir else name): os.path.splitext(name)[0]
+        for name in names
+    }
+    return urls, prefix
+
+def _reconcile_sources():
+    """当前配置下需要对账的后端：[(来源名, 目录文件, 拉取函数, 参数)]"""
+    sources = []
+    if os.getenv("PICUI_TOKEN", "").strip():
+        sources.append(("PICUI", GIST_FILE_NAME, _reconcile_list_picui, ()))
+    try:
+        _github_repo_owner_and_name()
+        github_configured = True
+    except Exception:
+        github_configured = False
+    if github_configured:
+        for folder in RECONCILE_GITHUB_FOLDERS:
+            file_name = _github_gist_file_for_folder(folder) if folder else GIST_FILE_NAME
+            sources.append((f"GITHUB:{folder or '/'}", file_name, _reconcile_list_github, (folder,)))
+    return sources
+
+def reconcile_scan():
+    """
+    拉取全部后端清单并与所有目录做集合比对。
+    Return: {"sources": {来源: {"count"} 或 {"error"}},
+             "catalogs": {目录文件: {"count", "orphans": [...], "dangling": [...]}},
+             "summary": {"orphans", "dangling"}}
+    """
+    sources = _reconcile_sources()
+    listed = {}
+    errors = {}
+    pool = ContextThreadPoolExecutor(max_workers=max(1, len(sources)))
+    try:
+        futures = {pool.submit(fn, *args): name for name, _, fn, args in sources}
+        for fut in as_completed(futures):
+            try:
+                listed[futures[fut]] = fut.result()
+            except Exception as e:
+                errors[futures[fut]] = str(e)
+    finally:
+        pool.shutdown(wait=False)
+
+    store = catalog_store()
+    file_names = sorted({GIST_FILE_NAME} | {file_name for _, file_name, _, _ in sources})
+    catalogs = {file_name: store.catalog(file_name) for file_name in file_names}
+    all_catalog_urls = set()
+    for catalog in catalogs.values():
+        all_catalog_urls |= catalog.by_url.keys()
+
+    report = {
+        file_name: {"count": len(catalog.icons), "orphans": [], "dangling": []}
+        for file_name, catalog in catalogs.items()
+    }
+    for name, file_name, _, _ in sources:
+        if name not in listed:
+            continue
+        urls, owner = listed[name]
+        backend = name.split(":", 1)[0]
+        if backend == "PICUI":
+            # PICUI 图片可能被收录进任意目录；域名命中或条目标记为 PICUI 即视为归属 PICUI
+            orphans = urls.keys() - all_catalog_urls
+            owns = lambda icon, url: icon.get("backend") == "PICUI" or urlsplit(url).netloc in owner
+            scope = catalogs
+        else:
+            # GitHub 目录只对应一个目录文件，且只看该目录下的直接子文件
+            orphans = urls.keys() - catalogs[file_name].by_url.keys()
+            owns = lambda icon, url: url.startswith(owner) and "/" not in url[len(owner):]
+            scope = {file_name: catalogs[file_name]}
+        report[file_name]["orphans"] += [
+            {"url": url, "name": urls[url], "backend": backend, "source": name} for url in sorted(orphans)
+        ]
+        for scope_file, catalog in scope.items():
+            dangling = {url for url, icon in catalog.by_url.items() if owns(icon, url)} - urls.keys()
+            report[scope_file]["dangling"] += [
+                {"url": url, "name": catalog.by_url[url].get("name"), "source": name} for url in sorted(dangling)
+            ]
+
+    return {
+        "sources": {
+            name: ({"count": len(listed[name][0])} if name in listed else {"error": errors.get(name)})
+            for name, _, _, _ in sources
+        },
+        "catalogs": report,
+        "summary": {
+            "orphans": sum(len(r["orphans"]) for r in report.values()),
+            "dangling": sum(len(r["dangling"]) for r in report.values()),
+        },
+    }
+
+RECONCILE_ACTIONS = ("readd_orphans", "prune_dangling")
+
+def reconcile_repair(action: str, files=None, urls=None):
+    """
+    重新对账后执行修复，每个目录文件只写一次：
+    - readd_orphans：把孤儿图片追加回对应目录
+    - prune_dangling：从目录中移除悬空条目
+    files / urls：可选，只处理指定的目录文件 / URL（都必须出现在本次对账结果里）
+    """
+    if action not in RECONCILE_ACTIONS:
+        raise ValueError(f"action 可选：{' / '.join(RECONCILE_ACTIONS)}")
+    scan = reconcile_scan()
+    failed = {name: st["error"] for name, st in scan["sources"].items() if "error" in st}
+    if action == "prune_dangling" and failed:
+        # 清单不完整时无法区分“真的悬空”和“没列出来”，宁可不删
+        raise ValueError(f"以下来源清单拉取失败，拒绝删除悬空条目：{json.dumps(failed, ensure_ascii=False)}")
+    files = set(files) if files else None
+    urls = set(urls) if urls else None
+    results = {}
+    for file_name, entry in scan["catalogs"].items():
+        if files is not None and file_name not in files:
+            continue
+        if action == "readd_orphans":
+            items = [
+                {"name": o["name"], "url": o["url"], "backend": o["backend"]}
+                for o in entry["orphans"] if urls is None or o["url"] in urls
+            ]
+            if items:
+                results[file_name] = catalog_store().write(file_name, append_items=items)
+        else:
+            remove = {d["url"] for d in entry["dangling"] if urls is None or d["url"] in urls}
+            if remove:
+                results[file_name] = catalog_store().write(file_name, remove_urls=remove)
+    return {"action": action, "sources": scan["sources"], "results": results}
+
+@app.route("/api/admin/reconcile", methods=["GET", "POST"])
+@require_admin
+def api_admin_reconcile():
+    """
+    GET：只出报告（孤儿 / 悬空条目）
+    POST {"action": "readd_orphans" | "prune_dangling", "files"?: [...], "urls"?: [...]}：重新对账后批量修复
+    """
+    if request.method == "GET":
+        return jsonify({"ok": True, **reconcile_scan()})
+    data = request.get_json(silent=True) or {}
+    for key in ("files", "urls"):
+        if data.get(key) is not None and not isinstance(data[key], list):
+            return jsonify({"ok": False, "message": f"{key} 必须是数组"}), 400
+    try:
+        result = reconcile_repair(data.get("action"), files=data.get("files"), urls=data.get("urls"))
+    except ValueError as e:
+        return jsonify({"ok": False, "message": str(e)}), 400
+    return jsonify({"ok": True, **result})
+
+@app.cli.command("reconcile")
+@click.option("--repair", type=click.Choice(RECONCILE_ACTIONS), default=None, help="对账后执行的修复动作")
+@click.option("--file", "files", multiple=True, help="只处理指定的目录文件（可重复）")
+def reconcile_command(repair, files):
+    """对账 PICUI / GitHub 仓库与各目录：flask --app api/index.py reconcile [--repair readd_orphans]"""
+    if repair:
+        result = reconcile_repair(repair, files=files or None)
+    else:
+        result = reconcile_scan()
+    click.echo(json.dumps(result, ensure_ascii=False, indent=2))
+
 # ===== 上传接口（保持你的逻辑不变）=====
 
-@app.route("/api/upload", methods=["POST"])
-def upload_image():
+# ===== 上传前图片优化（可选，需要 Pillow）=====
+# 缩放到最长边 IMAGE_MAX_EDGE、去掉 EXIF/ICC 等元数据、PNG 无损压缩，可选输出 WebP。
+# GitHub transparent 目录始终保留 alpha 通道；其他情况下完全不透明的 alpha 通道会被去掉。
+# 只在结果更小（或发生缩放）时替换原图；处理在进程池中进行，不占用请求线程的 GIL。
+# 去重用的 sha256 仍按原始文件计算，同一张原图重复上传依然能命中。
+IMAGE_OPTIMIZE = (os.getenv("IMAGE_OPTIMIZE", "0") or "0").strip() == "1"
+IMAGE_MAX_EDGE = int((os.getenv("IMAGE_MAX_EDGE", "1024") or "1024").strip())
+IMAGE_WEBP = (os.getenv("IMAGE_WEBP", "0") or "0").strip() == "1"
+IMAGE_WEBP_QUALITY = int((os.getenv("IMAGE_WEBP_QUALITY", "90") or "90").strip())
+IMAGE_OPTIMIZE_WORKERS = int((os.getenv("IMAGE_OPTIMIZE_WORKERS", "2") or "2").strip())
+
+_image_pool_lock = threading.Lock()
+_image_pool = None
+
+def optimize_image_bytes(data: bytes, filename: str, keep_alpha: bool = False):
+    """
+    优化单张图片，返回 (bytes, 文件名, mimetype)；不支持的格式或没有收益时返回 None。
+    在子进程中执行，所以只接收/返回可 pickle 的简单类型。
+    """
+    try:
+        img = Image.open(io.BytesIO(data))
+    except Image.UnidentifiedImageError:
+        return None
+    fmt = (img.format or "").upper()
+    if fmt not in ("PNG", "JPEG", "WEBP", "BMP", "TIFF") or getattr(img, "is_animated", False):
+        return None
+
+    img = ImageOps.exif_transpose(img)
+    resized = False
+    if IMAGE_MAX_EDGE > 0 and max(img.size) > IMAGE_MAX_EDGE:
+        img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+        resized = True
+
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+    if has_alpha:
+        img = img.convert("RGBA")
+        if not keep_alpha and img.getchannel("A").getextrema()[0] == 255:
+            img = img.convert("RGB")
+            has_alpha = False
+    elif img.mode not in ("RGB", "L", "P"):
+        img = img.convert("RGB")
+    img.info = {}  # 丢弃 EXIF / ICC / 文本块等元数据
+
+    stem = os.path.splitext(filename or "")[0] or "image"
+    out = io.BytesIO()
+    if IMAGE_WEBP:
+        img.save(out, "WEBP", quality=IMAGE_WEBP_QUALITY, method=6, exact=has_alpha)
+        result = (out.getvalue(), f"{stem}.webp", "image/webp")
+    elif fmt == "JPEG" and not has_alpha:
+        img.convert("RGB").save(out, "JPEG", quality=90, optimize=True, progressive=True)
+        result = (out.getvalue(), filename, "image/jpeg")
+    else:
+        img.save(out, "PNG", optimize=True)
+        result = (out.getvalue(), f"{stem}.png", "image/png")
+
+    if not resized and len(result[0]) >= len(data):
+        return None
+    return result
+
+def _image_optimize_pool():
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is None:
+            _image_pool = ProcessPoolExecutor(max_workers=max(1, IMAGE_OPTIMIZE_WORKERS))
+        return _image_pool
+
+def _image_keep_alpha(upload_service: str, github_folder: str = ""):
+    return upload_service == "GITHUB" and _normalize_github_folder(github_folder) == "transparent"
+
+def _optimize_upload_jobs(jobs, keep_alpha: bool = False):
+    """jobs: [(idx, image, name)]，返回同结构的列表，图片替换为优化后的版本（失败时保留原图）"""
+    if not IMAGE_OPTIMIZE or Image is None or not jobs:
+        return jobs
+
+    datas = [b"".join(_iter_stream(image.stream)) for _, image, _ in jobs]
+    for _, image, _ in jobs:
+        image.stream.seek(0)
+    try:
+        pool = _image_optimize_pool()
+        futures = [pool.submit(optimize_image_bytes, data, image.filename, keep_alpha) for data, (_, image, _) in zip(datas, jobs)]
+    except Exception as e:
+        # 某些运行环境不支持多进程：退回到当前线程处理
+        print(f"图片优化进程池不可用，改为当前线程处理: {e}")
+        futures = None
+
+    optimized = []
+    for pos, (data, (idx, image, name)) in enumerate(zip(datas, jobs)):
+        try:
+            result = futures[pos].result() if futures else optimize_image_bytes(data, image.filename, keep_alpha)
+        except Exception as e:
+            print(f"图片优化失败（{image.filename}），使用原图: {e}")
+            result = None
+        if result is None:
+            optimized.append((idx, image, name))
+            continue
+        out, filename, mimetype = result
+        optimized.append((idx, FileStorage(stream=io.BytesIO(out), filename=filename, content_type=mimetype), name))
+    return optimized
+
+# 内容去重：上传前先算 sha256，命中索引（<目录>.hashes.json）则跳过图床上传、直接复用已有 URL
+UPLOAD_DEDUP = (os.getenv("UPLOAD_DEDUP", "1") or "1").strip() == "1"
+
+# 批量上传并发数：UPLOAD_CONCURRENCY 为默认值，可用 UPLOAD_CONCURRENCY_<SERVICE> 单独覆盖
+# GitHub Contents API 对同一分支并发提交容易冲突，默认串行
+UPLOAD_CONCURRENCY_DEFAULTS = {"PICUI": 4, "PICGO": 4, "IMGURL": 4, "GITHUB": 1}
+
+def _upload_concurrency(upload_service: str):
+    default = UPLOAD_CONCURRENCY_DEFAULTS.get(upload_service, 4)
+    raw = (os.getenv(f"UPLOAD_CONCURRENCY_{upload_service}", "") or os.getenv("UPLOAD_CONCURRENCY", "") or "").strip()
+    try:
+        return max(1, int(raw)) if raw else default
+    except ValueError:
+        return default
+
+def _upload_one(upload_service: str, image, name: str, github_folder: str = ""):
+    """按 UPLOAD_SERVICE 上传单张图片，返回 (image_url, upload_err)"""
+    upload_err = None
+    image_url = None
+    try:
+        if upload_service == "IMGURL":
+            image_url = upload_to_imgurl(image)
+        elif upload_service == "PICUI":
+            if not os.getenv("PICUI_TOKEN", "").strip():
+                upload_err = "PICUI_TOKEN 未配置"
+            else:
+                image_url = upload_to_picui(image)
+        elif upload_service == "GITHUB":
+            image_url = upload_to_github_repo(image, name, github_folder)
+        else:
+            image_url = upload_to_picgo(image)
+    except Exception as e:
+        upload_err = str(e)
+    return image_url, upload_err
+
+# ===== 多图床路由：按健康度选择后端，失败自动切换 =====
+# UPLOAD_BACKENDS=PICUI,PICGO,IMGURL（至少两个才启用）；UPLOAD_SERVICE 仍决定写入哪个 Gist 文件，并在分数相同时优先。
+# 每个后端记录最近 UPLOAD_HEALTH_WINDOW 次上传的耗时与成败：
+#   分数 = 成功平均耗时 × (1 + 4 × 失败率)，越小越好；连续失败 3 次的后端冷却 UPLOAD_HEALTH_COOLDOWN 秒（无其他可用时仍会尝试）
+# UPLOAD_HEDGE_AFTER > 0 时：首选后端超过该秒数未返回，就并行向下一个后端再传一份，取先成功的（可能在图床留下多余副本）
+UPLOAD_BACKENDS = [
+    b.strip().upper() for b in (os.getenv("UPLOAD_BACKENDS", "") or "").split(",") if b.strip()
+]
+UPLOAD_HEALTH_WINDOW = int((os.getenv("UPLOAD_HEALTH_WINDOW", "20") or "20").strip())
+UPLOAD_HEALTH_COOLDOWN = float((os.getenv("UPLOAD_HEALTH_COOLDOWN", "30") or "30").strip())
+UPLOAD_HEDGE_AFTER = float((os.getenv("UPLOAD_HEDGE_AFTER", "0") or "0").strip())
+
+class BackendHealth:
+    """单个图床后端的滚动统计（线程安全）"""
+
+    def __init__(self, window=None):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=max(1, window or UPLOAD_HEALTH_WINDOW))  # (ok, 耗时秒)
+        self.consecutive_failures = 0
+        self.last_failure_at = 0.0
+
+    def record(self, ok: bool, latency: float):
+        with self._lock:
+            self._samples.append((ok, latency))
+            if ok:
+                self.consecutive_failures = 0
+            else:
+                self.consecutive_failures += 1
+                self.last_failure_at = time.time()
+
+    def stats(self):
+        with self._lock:
+            samples = list(self._samples)
+            failures = self.consecutive_failures
+            last_failure_at = self.last_failure_at
+        ok_latencies = [lat for ok, lat in samples if ok]
+        return {
+            "samples": len(samples),
+            "error_rate": (sum(1 for ok, _ in samples if not ok) / len(samples)) if samples else 0.0,
+            "avg_latency": (sum(ok_latencies) / len(ok_latencies)) if ok_latencies else None,
+            "cooling_down": failures >= 3 and time.time() - last_failure_at < UPLOAD_HEALTH_COOLDOWN,
+        }
+
+    def score(self):
+        st = self.stats()
+        # 没有成功样本时按 1 秒估计，保证新后端也有机会被选中
+        latency = st["avg_latency"] if st["avg_latency"] is not None else 1.0
+        return latency * (1 + 4 * st["error_rate"])
+
+_backend_health_lock = threading.Lock()
+_backend_health = {}
+
+def backend_health(upload_service: str):
+    with _backend_health_lock:
+        health = _backend_health.get(upload_service)
+        if health is None:
+            health = _backend_health[upload_service] = BackendHealth()
+        return health
+
+def _upload_backend_configured(upload_service: str):
+    if upload_service == "PICUI":
+        return bool(os.getenv("PICUI_TOKEN", "").strip())
+    if upload_service == "PICGO":
+        return bool(PICGO_API_KEY) and not PICGO_API_KEY.startswith("YOUR_")
+    if upload_service == "IMGURL":
+        return bool(IMGURL_API_TOKEN) and not IMGURL_API_TOKEN.startswith("YOUR_")
+    if upload_service == "GITHUB":
+        try:
+            _github_repo_owner_and_name()
+            _github_repo_token()
+            return True
+        except Exception:
+            return False
+    return False
+
+def _upload_routing_enabled():
+    return len(UPLOAD_BACKENDS) > 1
+
+def _upload_route_order(primary: str):
+    """按健康度排序的候选后端：冷却中的排到最后，分数相同时 UPLOAD_SERVICE 优先"""
+    candidates = [b for b in UPLOAD_BACKENDS if _upload_backend_configured(b)] or [primary]
+
+    def key(b):
+        health = backend_health(b)
+        return (health.stats()["cooling_down"], health.score(), b != primary)
+
+    return sorted(candidates, key=key)
+
+def _upload_one_timed(upload_service: str, image, name: str, github_folder: str = ""):
+    """_upload_one + 记录健康度，返回 (image_url, upload_err, upload_service)"""
+    start = time.perf_counter()
+    image_url, upload_err = _upload_one(upload_service, image, name, github_folder)
+    backend_health(upload_service).record(bool(image_url), time.perf_counter() - start)
+    return image_url, upload_err, upload_service
+
+def _upload_routed(primary: str, image, name: str, github_folder: str = ""):
+    """按健康度依次尝试各后端，返回 (image_url, upload_err, 实际使用的后端)"""
+    order = _upload_route_order(primary)
+    errors = []
+    pos = 0
+    while pos < len(order):
+        backend = order[pos]
+        hedge = order[pos + 1] if UPLOAD_HEDGE_AFTER > 0 and pos + 1 < len(order) else None
+        if hedge is None:
+            image_url, upload_err, used = _upload_one_timed(backend, image, name, github_folder)
+            if not image_url:
+                errors.append(f"{backend}: {upload_err or '上传失败'}")
+            pos += 1
+        else:
+            image_url, used = _upload_hedged(backend, hedge, image, name, github_folder, errors)
+            pos += 2
+        if image_url:
+            return image_url, None, used
+    return None, "；".join(errors) or "所有图床均上传失败", None
+
+def _upload_hedged(backend: str, hedge: str, image, name: str, github_folder: str, errors):
+    """
+    backend 超过 UPLOAD_HEDGE_AFTER 秒未返回（或已失败）时并行尝试 hedge，取先成功的，返回 (image_url, 后端)。
+    hedge 使用独立的文件副本，避免两个线程同时读同一个流；失败信息追加到 errors。
+    """
+    copy = _spool_upload(image)
+    hedge_started = False
+
+    def run_hedge():
+        try:
+            return _upload_one_timed(hedge, copy, name, github_folder)
+        finally:
+            copy.close()
+
+    pool = ContextThreadPoolExecutor(max_workers=2)
+    try:
+        futures = {pool.submit(_upload_one_timed, backend, image, name, github_folder): backend}
+        done, _ = wait(futures, timeout=UPLOAD_HEDGE_AFTER)
+        if not done or not next(iter(done)).result()[0]:
+            futures[pool.submit(run_hedge)] = hedge
+            hedge_started = True
+        for fut in as_completed(futures):
+            image_url, upload_err, used = fut.result()
+            if image_url:
+                return image_url, used
+            errors.append(f"{used}: {upload_err or '上传失败'}")
+        return None, None
+    finally:
+        # 不等待落后的那一个：它的结果只用于健康度统计
+        pool.shutdown(wait=False)
+        if not hedge_started:
+            copy.close()
+
+def _iter_upload_outcomes(upload_service: str, jobs, github_folder: str = ""):
+    """
+    jobs: [(idx, image, name)]
+    按完成顺序逐个产出 (idx, name, image_url, upload_err, backend)
+    """
+    if not jobs:
+        return
+
+    if upload_service == "GITHUB" and GITHUB_REPO_BATCH_COMMIT and not _upload_routing_enabled():
+        try:
+            outcomes = upload_batch_to_github_repo([(image, name) for _, image, name in jobs], github_folder)
+        except Exception as e:
+            outcomes = [(None, str(e))] * len(jobs)
+        for (idx, _, name), (image_url, upload_err) in zip(jobs, outcomes):
+            yield idx, name, image_url, upload_err, "GITHUB"
+        return
+
+    upload = _upload_routed if _upload_routing_enabled() else _upload_one_timed
+    with ContextThreadPoolExecutor(max_workers=min(_upload_concurrency(upload_service), len(jobs))) as pool:
+        futures = {
+            pool.submit(upload, upload_service, image, name, github_folder): (idx, name)
+            for idx, image, name in jobs
+        }
+        for fut in as_completed(futures):
+            idx, name = futures[fut]
+            image_url, upload_err, backend = fut.result()
+            yield idx, name, image_url, upload_err, backend
+
+def _run_upload_batch(images, raw_name: str, upload_service: str, github_folder: str = "", on_results=None):
     """
+    上传一批图片并写入 Gist，返回与输入顺序一致的结果列表（跳过的空文件为 None）。
     1. 单图上传：立即更新 Gist。
-    2. 批量上传：每积攒 10 张图的链接，更新一次 Gist（流控）。
+    2. 批量上传：按后端并发上传，每积攒 10 张图的链接（按完成顺序），更新一次 Gist（流控）。
     3. 剩余不足 10 张：最后统一更新。
+    4. 内容去重（UPLOAD_DEDUP）：与已收录图片完全相同的文件不再上传，直接返回已有条目（duplicate=true）。
+    on_results：结果列表分配好后回调一次（异步任务用它观察进度，列表会被原地填充）
+    """
+    gist_file_name = GIST_FILE_NAME
+    if upload_service == "GITHUB":
+        gist_file_name = _github_gist_file_for_folder(github_folder)
+
+    BATCH_SIZE = 10
+
+    gist_cache_for_unique_name = None
+    if upload_service == "GITHUB":
+        try:
+            gist_cache_for_unique_name = catalog_store().catalog(gist_file_name).copy()
+        except Exception:
+            gist_cache_for_unique_name = IconCatalog({"icons": []})
+
+    dedup_catalog = None
+    if UPLOAD_DEDUP:
+        try:
+            dedup_catalog = catalog_store().catalog(gist_file_name)
+        except Exception:
+            dedup_catalog = None
+
+    # 先在主线程里确定名称（GitHub 模式需要提前占位，避免并发上传时同名）
+    jobs = []
+    slots = 0
+    preset = {}  # idx -> 已确定的结果（重复文件）
+    pending_batch = []  # [(idx, {"name", "url", "sha256"})]
+    job_hashes = {}  # idx -> sha256
+    seen_hashes = {}  # sha256 -> 本批次第一次出现的 idx
+    aliases = []  # [(idx, 原 idx, name)] 本批次内重复的文件
+    for image in images:
+        if not image or not getattr(image, "filename", ""):
+            continue
+
+        auto_name = os.path.splitext(image.filename)[0]
+        name = raw_name or auto_name
+        idx = slots
+        slots += 1
+
+        sha256 = _stream_sha256(image.stream) if UPLOAD_DEDUP else None
+        if sha256 and sha256 in seen_hashes:
+            aliases.append((idx, seen_hashes[sha256], name))
+            continue
+        if sha256:
+            seen_hashes[sha256] = idx
+        known_url = dedup_catalog.hashes.get(sha256) if (dedup_catalog is not None and sha256) else None
+        if known_url:
+            existing = dedup_catalog.by_url.get(known_url)
+            if existing:
+                preset[idx] = {"ok": True, "name": existing.get("name"), "url": known_url, "duplicate": True}
+            else:
+                # 图床上已有，但目录里没有（例如之前 Gist 同步失败）：不重复上传，只补目录
+                pending_batch.append((idx, {"name": name, "url": known_url, "sha256": sha256}))
+            continue
+
+        if upload_service == "GITHUB" and gist_cache_for_unique_name is not None:
+            name = gist_cache_for_unique_name.unique_name(name)
+            gist_cache_for_unique_name.reserve(name)
+
+        job_hashes[idx] = sha256
+        jobs.append((idx, image, name))
+
+    # 每个文件一个结果槽位，保证输出顺序与输入一致
+    final_results = [None] * slots
+    for idx, r in preset.items():
+        final_results[idx] = r
+    if on_results is not None:
+        on_results(final_results)
+
+    def flush(warning_prefix):
+        # 上传按完成先后到达：按输入顺序写入，同名文件的序号才与顺序上传时一致
+        pending_batch.sort(key=lambda p: p[0])
+        batch = [item for _, item in pending_batch]
+        try:
+            saved_items = batch_append_to_gist(batch, file_name=gist_file_name)
+            for (idx, _), item in zip(pending_batch, saved_items):
+                final_results[idx] = {"ok": True, "name": item["name"], "url": item["url"]}
+        except Exception as e:
+            for idx, item in pending_batch:
+                final_results[idx] = {
+                    "ok": True,
+                    "name": item["name"],
+                    "url": item["url"],
+                    "warning": f"{warning_prefix}: {str(e)}"
+                }
+        pending_batch.clear()
+
+    jobs = _optimize_upload_jobs(jobs, keep_alpha=_image_keep_alpha(upload_service, github_folder))
+    for idx, name, image_url, upload_err, backend in _iter_upload_outcomes(upload_service, jobs, github_folder):
+        if not image_url:
+            final_results[idx] = {
+                "ok": False,
+                "name": name,
+                "error": upload_err or f"图片上传失败（{upload_service}）"
+            }
+        else:
+            pending_batch.append((idx, {"name": name, "url": image_url, "sha256": job_hashes.get(idx), "backend": backend}))
+            # 已上传、等待写入 Gist（flush 后会被最终结果覆盖；异步任务查询进度时可见）
+            final_results[idx] = {"ok": True, "name": name, "url": image_url, "pending": True}
+
+        if len(pending_batch) >= BATCH_SIZE:
+            flush("图片已上传但 Gist 阶段同步失败")
+
+    if pending_batch:
+        flush("图片已上传但 Gist 最后同步失败")
+
+    for idx, orig_idx, name in aliases:
+        orig = final_results[orig_idx] or {}
+        if orig.get("ok"):
+            final_results[idx] = {"ok": True, "name": orig.get("name"), "url": orig.get("url"), "duplicate": True}
+        else:
+            final_results[idx] = {"ok": False, "name": name, "error": orig.get("error") or "图片上传失败"}
+
+    return final_results
+
+# ===== 异步上传任务：/api/upload?async=1 立即返回 job_id，后台线程池执行上传与 Gist 写入 =====
+# 仅适合常驻进程部署（gunicorn / docker 等）；Vercel 等 serverless 在响应返回后会冻结进程，默认关闭。
+UPLOAD_ASYNC_ENABLED = (os.getenv("UPLOAD_ASYNC_ENABLED", "0") or "0").strip() == "1"
+UPLOAD_ASYNC_WORKERS = int((os.getenv("UPLOAD_ASYNC_WORKERS", "2") or "2").strip())
+UPLOAD_JOB_TTL = int((os.getenv("UPLOAD_JOB_TTL", "3600") or "3600").strip())
+
+_upload_jobs_lock = threading.Lock()
+_upload_jobs = {}  # job_id -> {"status", "created_at", "finished_at", "total", "results", "error"}
+_upload_job_pool = None
+
+def _spool_upload(image):
+    """请求结束后 werkzeug 会关闭上传流：先按块复制到临时文件，交给后台任务使用"""
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_STREAM_CHUNK_SIZE * 16)
+    for chunk in _iter_stream(image.stream):
+        spool.write(chunk)
+    spool.seek(0)
+    return FileStorage(stream=spool, filename=image.filename, content_type=image.mimetype)
+
+def _purge_upload_jobs():
+    now = time.time()
+    with _upload_jobs_lock:
+        for job_id in [k for k, job in _upload_jobs.items() if job["finished_at"] and now - job["finished_at"] > UPLOAD_JOB_TTL]:
+            del _upload_jobs[job_id]
+
+def _run_upload_job(job_id, images, raw_name, upload_service, github_folder):
+    job = _upload_jobs[job_id]
+    job["status"] = "running"
+    try:
+        _run_upload_batch(
+            images, raw_name, upload_service, github_folder,
+            on_results=lambda results: job.__setitem__("results", results),
+        )
+        job["status"] = "done"
+    except Exception as e:
+        job["status"] = "failed"
+        job["error"] = str(e)
+    finally:
+        job["finished_at"] = time.time()
+        for image in images:
+            image.close()
+
+def _submit_upload_job(images, raw_name, upload_service, github_folder):
+    global _upload_job_pool
+    _purge_upload_jobs()
+    images = [_spool_upload(image) for image in images if image and getattr(image, "filename", "")]
+    job_id = os.urandom(16).hex()
+    with _upload_jobs_lock:
+        _upload_jobs[job_id] = {
+            "status": "queued",
+            "created_at": time.time(),
+            "finished_at": None,
+            "total": len(images),
+            "results": None,
+            "error": None,
+        }
+        if _upload_job_pool is None:
+            _upload_job_pool = ThreadPoolExecutor(max_workers=max(1, UPLOAD_ASYNC_WORKERS))
+    _upload_job_pool.submit(_run_upload_job, job_id, images, raw_name, upload_service, github_folder)
+    return job_id
+
+@app.get("/api/upload/jobs/<job_id>")
+def api_upload_job_status(job_id):
+    """
+    异步任务进度：results 与 /api/upload 批量返回的结构一致，未完成的文件为 null，
+    已上传但尚未写入 Gist 的文件带 pending=true。
+    status: queued / running / done / failed
+    """
+    with _upload_jobs_lock:
+        job = _upload_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在或已过期"}), 404
+    results = list(job["results"] or [None] * job["total"])
+    resp = {
+        "success": job["status"] != "failed",
+        "job_id": job_id,
+        "status": job["status"],
+        "total": len(results),
+        "completed": sum(1 for r in results if r is not None),
+        "results": results,
+    }
+    if job["error"]:
+        resp["error"] = job["error"]
+    return jsonify(resp), 200
+
+@app.route("/api/upload", methods=["POST"])
+def upload_image():
+    """
+    上传图片并写入 Gist（见 _run_upload_batch），返回结果保持与上传文件相同的顺序。
+    async=1 且 UPLOAD_ASYNC_ENABLED=1 时：立即返回 job_id，后台执行，通过 /api/upload/jobs/<job_id> 查询进度。
     """
     try:
         images = request.files.getlist("source")
@@ -684,113 +3625,320 @@ def upload_image():
         raw_name = (request.form.get("name") or "").strip()
         upload_service = os.getenv("UPLOAD_SERVICE", "PICGO").upper()
         github_folder = (request.form.get("github_folder") or "").strip()
+
+        wants_async = (request.form.get("async") or request.args.get("async") or "").strip() == "1"
+        if wants_async and UPLOAD_ASYNC_ENABLED:
+            if not any(image and getattr(image, "filename", "") for image in images):
+                return jsonify({"error": "没有处理任何文件"}), 400
+            job_id = _submit_upload_job(images, raw_name, upload_service, github_folder)
+            return jsonify({
+                "success": True,
+                "job_id": job_id,
+                "status_url": url_for("api_upload_job_status", job_id=job_id),
+            }), 202
+
+        final_results = _run_upload_batch(images, raw_name, upload_service, github_folder)
+        final_results = [r for r in final_results if r is not None]
+        if not final_results:
+            return jsonify({"error": "没有处理任何文件"}), 400
+
+        if len(images) == 1 and len(final_results) == 1:
+            r = final_results[0]
+            if r.get("ok"):
+                resp = {"success": True, "name": r.get("name"), "url": r.get("url")}
+                if r.get("duplicate"):
+                    resp["duplicate"] = True
+                return jsonify(resp), 200
+            else:
+                return jsonify({"error": r.get("error")}), 400
+
+        return jsonify({"success": True, "results": final_results}), 200
+
+    except Exception as e:
+        return jsonify({"error": "服务器内部错误", "details": str(e)}), 500
+
+# ===== 上传会话：大批量分多次请求上传，最后一次性写入 Gist =====
+# 单个请求受平台请求体大小/函数时长限制，大图标包可以：
+#   1. POST /api/upload/session                  {name?, github_folder?} -> {session_id}
+#   2. POST /api/upload/session/<id>             multipart：source（可多个）+ index（可选，与 source 一一对应，用于排序）
+#      每次请求立即上传到图床并记录结果，可并行多次调用
+#   3. POST /api/upload/session/<id>/finalize    合并成一次 Gist 写入，按 index 顺序返回每个文件的结果
+# 会话状态存放在可替换的存储里（UPLOAD_SESSION_STORE），默认本地文件（/tmp 下，单实例内有效）。
+UPLOAD_SESSION_TTL = int((os.getenv("UPLOAD_SESSION_TTL", "3600") or "3600").strip())
+
+class LocalUploadSessionStore:
+    """
+    本地文件实现：每个会话一个目录，meta.json + 每个文件一条 item-*.json。
+    每个文件单独落盘，并行推送互不覆盖；写入走临时文件 + os.replace 保证原子性。
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _dir(self, session_id):
+        if not session_id or not all(ch in "0123456789abcdef" for ch in session_id):
+            raise KeyError(session_id)
+        return os.path.join(self.root, session_id)
+
+    def _write_json(self, path, data):
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def _read_json(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def create(self, meta):
+        self.purge_expired()
+        session_id = os.urandom(16).hex()
+        path = self._dir(session_id)
+        os.makedirs(path, exist_ok=True)
+        self._write_json(os.path.join(path, "meta.json"), {**meta, "id": session_id, "created_at": time.time()})
+        return session_id
+
+    def get(self, session_id):
+        """返回会话 meta；不存在或已过期返回 None"""
+        try:
+            meta = self._read_json(os.path.join(self._dir(session_id), "meta.json"))
+        except (KeyError, OSError, ValueError):
+            return None
+        if time.time() - meta.get("created_at", 0) > UPLOAD_SESSION_TTL:
+            self.delete(session_id)
+            return None
+        return meta
+
+    def add_items(self, session_id, items):
+        path = self._dir(session_id)
+        for item in items:
+            self._write_json(os.path.join(path, f"item-{item['key']}.json"), item)
+
+    def items(self, session_id):
+        path = self._dir(session_id)
+        out = []
+        for fn in os.listdir(path):
+            if fn.startswith("item-") and fn.endswith(".json"):
+                try:
+                    out.append(self._read_json(os.path.join(path, fn)))
+                except (OSError, ValueError):
+                    continue
+        return out
+
+    def delete(self, session_id):
+        try:
+            shutil.rmtree(self._dir(session_id), ignore_errors=True)
+        except KeyError:
+            pass
+
+    def purge_expired(self):
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return
+        for session_id in names:
+            self.get(session_id)
+
+UPLOAD_SESSION_STORES = {
+    "local": lambda: LocalUploadSessionStore(
+        (os.getenv("UPLOAD_SESSION_DIR", "") or "").strip() or os.path.join("/tmp", "tubiaoku-upload-sessions")
+    ),
+}
+_upload_session_store = None
+
+def upload_session_store():
+    global _upload_session_store
+    if _upload_session_store is None:
+        kind = (os.getenv("UPLOAD_SESSION_STORE", "local") or "local").strip().lower()
+        if kind not in UPLOAD_SESSION_STORES:
+            raise Exception(f"未知的 UPLOAD_SESSION_STORE: {kind}")
+        _upload_session_store = UPLOAD_SESSION_STORES[kind]()
+    return _upload_session_store
+
+def _upload_session_item_order(item):
+    order = item.get("order")
+    return (order is None, order if order is not None else 0, item.get("received_at", 0))
+
+@app.route("/api/upload/session", methods=["POST"])
+def api_upload_session_open():
+    try:
+        payload = request.get_json(silent=True) or request.form
+        github_folder = (payload.get("github_folder") or "").strip()
+        upload_service = os.getenv("UPLOAD_SERVICE", "PICGO").upper()
         gist_file_name = GIST_FILE_NAME
         if upload_service == "GITHUB":
             gist_file_name = _github_gist_file_for_folder(github_folder)
+        session_id = upload_session_store().create({
+            "name": (payload.get("name") or "").strip(),
+            "upload_service": upload_service,
+            "github_folder": github_folder,
+            "gist_file_name": gist_file_name,
+        })
+        return jsonify({"success": True, "session_id": session_id, "expires_in": UPLOAD_SESSION_TTL}), 200
+    except Exception as e:
+        return jsonify({"error": "服务器内部错误", "details": str(e)}), 500
 
-        final_results = []
-        pending_batch = []
-        BATCH_SIZE = 10
+@app.route("/api/upload/session/<session_id>", methods=["POST"])
+def api_upload_session_push(session_id):
+    """上传一部分文件到图床并记入会话（不写 Gist）"""
+    try:
+        store = upload_session_store()
+        meta = store.get(session_id)
+        if meta is None:
+            return jsonify({"error": "上传会话不存在或已过期"}), 404
 
-        gist_cache_for_unique_name = None
-        if upload_service == "GITHUB":
+        images = request.files.getlist("source")
+        if not images:
+            return jsonify({"error": "缺少图片"}), 400
+        orders = request.form.getlist("index")
+        upload_service = meta["upload_service"]
+
+        dedup_catalog = None
+        if UPLOAD_DEDUP:
             try:
-                gist_cache_for_unique_name = _read_icons_json_from_gist(file_name=gist_file_name)
+                dedup_catalog = catalog_store().catalog(meta["gist_file_name"])
             except Exception:
-                gist_cache_for_unique_name = {"icons": []}
+                dedup_catalog = None
 
-        for image in images:
+        items = {}
+        jobs = []
+        seen_hashes = set()
+        for pos, image in enumerate(images):
             if not image or not getattr(image, "filename", ""):
                 continue
-
-            auto_name = os.path.splitext(image.filename)[0]
-            name = raw_name or auto_name
-
-            if upload_service == "GITHUB" and isinstance(gist_cache_for_unique_name, dict):
-                try:
-                    name = get_unique_name(name, gist_cache_for_unique_name)
-                except Exception:
-                    pass
-
-            upload_err = None
-            image_url = None
-
             try:
-                if upload_service == "IMGURL":
-                    image_url = upload_to_imgurl(image)
-                elif upload_service == "PICUI":
-                    if not os.getenv("PICUI_TOKEN", "").strip():
-                        upload_err = "PICUI_TOKEN 未配置"
-                    else:
-                        image_url = upload_to_picui(image)
-                elif upload_service == "GITHUB":
-                    image_url = upload_to_github_repo(image, name, github_folder)
+                order = int(orders[pos]) if pos < len(orders) and orders[pos].strip() else None
+            except ValueError:
+                return jsonify({"error": "index 必须是整数"}), 400
+            name = meta["name"] or os.path.splitext(image.filename)[0]
+            item = {
+                "key": f"{order:08d}" if order is not None else f"t{time.time_ns()}-{os.urandom(4).hex()}",
+                "order": order,
+                "received_at": time.time(),
+                "name": name,
+                "sha256": _stream_sha256(image.stream) if UPLOAD_DEDUP else None,
+            }
+            items[pos] = item
+
+            sha256 = item["sha256"]
+            known_url = dedup_catalog.hashes.get(sha256) if (dedup_catalog is not None and sha256) else None
+            if known_url:
+                existing = dedup_catalog.by_url.get(known_url)
+                if existing:
+                    item.update(status="duplicate", name=existing.get("name"), url=known_url)
                 else:
-                    image_url = upload_to_picgo(image)
-            except Exception as e:
-                upload_err = str(e)
-
-            if not image_url:
-                final_results.append({
-                    "ok": False,
-                    "name": name,
-                    "error": upload_err or f"图片上传失败（{upload_service}）"
-                })
+                    item.update(status="uploaded", url=known_url)
+            elif sha256 and sha256 in seen_hashes:
+                # 与本次请求里前面的文件相同：finalize 时按 sha256 指向先上传的那一个
+                item["status"] = "alias"
             else:
-                pending_batch.append({"name": name, "url": image_url})
-                if upload_service == "GITHUB" and isinstance(gist_cache_for_unique_name, dict):
-                    gist_cache_for_unique_name.setdefault("icons", []).append({"name": name, "url": image_url})
-
-            if len(pending_batch) >= BATCH_SIZE:
-                try:
-                    saved_items = batch_append_to_gist(pending_batch, file_name=gist_file_name)
-                    for item in saved_items:
-                        final_results.append({"ok": True, "name": item["name"], "url": item["url"]})
-                    pending_batch = []
-                except Exception as e:
-                    for item in pending_batch:
-                        final_results.append({
-                            "ok": True,
-                            "name": item["name"],
-                            "url": item["url"],
-                            "warning": f"图片已上传但 Gist 阶段同步失败: {str(e)}"
-                        })
-                    pending_batch = []
-
-        if pending_batch:
-            try:
-                saved_items = batch_append_to_gist(pending_batch, file_name=gist_file_name)
-                for item in saved_items:
-                    final_results.append({"ok": True, "name": item["name"], "url": item["url"]})
-            except Exception as e:
-                for item in pending_batch:
-                    final_results.append({
-                        "ok": True,
-                        "name": item["name"],
-                        "url": item["url"],
-                        "warning": f"图片已上传但 Gist 最后同步失败: {str(e)}"
-                    })
+                if sha256:
+                    seen_hashes.add(sha256)
+                jobs.append((pos, image, name))
+
+        jobs = _optimize_upload_jobs(jobs, keep_alpha=_image_keep_alpha(upload_service, meta["github_folder"]))
+        for pos, name, image_url, upload_err, backend in _iter_upload_outcomes(upload_service, jobs, meta["github_folder"]):
+            if image_url:
+                items[pos].update(status="uploaded", url=image_url, backend=backend)
+            else:
+                items[pos].update(status="failed", error=upload_err or f"图片上传失败（{upload_service}）")
 
-        if not final_results:
+        if not items:
             return jsonify({"error": "没有处理任何文件"}), 400
+        store.add_items(session_id, list(items.values()))
+        return jsonify({
+            "success": True,
+            "results": [
+                {"index": item["order"], "name": item["name"], "status": item["status"], "error": item.get("error")}
+                for _, item in sorted(items.items())
+            ],
+        }), 200
 
-        if len(images) == 1 and len(final_results) == 1:
-            r = final_results[0]
-            if r.get("ok"):
-                return jsonify({"success": True, "name": r.get("name"), "url": r.get("url")}), 200
-            else:
-                return jsonify({"error": r.get("error")}), 400
-
-        return jsonify({"success": True, "results": final_results}), 200
+    except Exception as e:
+        return jsonify({"error": "服务器内部错误", "details": str(e)}), 500
 
+def _finalize_upload_session(session_id):
+    store = upload_session_store()
+    meta = store.get(session_id)
+    if meta is None:
+        return jsonify({"error": "上传会话不存在或已过期"}), 404
+    items = sorted(store.items(session_id), key=_upload_session_item_order)
+    if not items:
+        return jsonify({"error": "会话中没有任何文件"}), 400
+
+    # 同一内容只收录一次：以先出现的已上传文件为准（并行推送时可能各自上传了一份）
+    first_by_hash = {}
+    pending = []
+    for item in items:
+        if item["status"] == "uploaded":
+            sha256 = item.get("sha256")
+            if sha256 and sha256 in first_by_hash:
+                item["alias_of"] = first_by_hash[sha256]
+                continue
+            if sha256:
+                first_by_hash[sha256] = item
+            pending.append(item)
+    for item in items:
+        if item["status"] == "alias":
+            item["alias_of"] = first_by_hash.get(item.get("sha256"))
+
+    warning = None
+    try:
+        saved = catalog_store().write(
+            meta["gist_file_name"],
+            append_items=[
+                {"name": it["name"], "url": it["url"], "sha256": it.get("sha256"), "backend": it.get("backend")}
+                for it in pending
+            ],
+        )["saved"]
+        for item, icon in zip(pending, saved):
+            item["name"] = icon["name"]
+    except Exception as e:
+        warning = f"图片已上传但 Gist 同步失败: {str(e)}"
+
+    results = []
+    for item in items:
+        if item["status"] in ("uploaded", "alias") and "alias_of" in item:
+            orig = item["alias_of"]
+            if orig is None:
+                results.append({"ok": False, "name": item["name"], "error": "图片上传失败"})
+            else:
+                results.append({"ok": True, "name": orig["name"], "url": orig["url"], "duplicate": True})
+        elif item["status"] == "uploaded":
+            r = {"ok": True, "name": item["name"], "url": item["url"]}
+            if warning:
+                r["warning"] = warning
+            results.append(r)
+        elif item["status"] == "duplicate":
+            results.append({"ok": True, "name": item["name"], "url": item["url"], "duplicate": True})
+        else:
+            results.append({"ok": False, "name": item["name"], "error": item.get("error") or "图片上传失败"})
+
+    # Gist 写入失败时保留会话，客户端可以重试 finalize
+    if warning is None:
+        store.delete(session_id)
+    return jsonify({"success": True, "results": results}), 200
+
+@app.route("/api/upload/session/<session_id>/finalize", methods=["POST"])
+def api_upload_session_finalize(session_id):
+    try:
+        return _finalize_upload_session(session_id)
     except Exception as e:
         return jsonify({"error": "服务器内部错误", "details": str(e)}), 500
 
 @app.route("/api/finalize_batch", methods=["POST"])
 def api_finalize_batch():
-    return jsonify({"success": True, "message": "Batch is now handled automatically in upload"}), 200
+    """兼容旧入口：带 session_id 时等同于 /api/upload/session/<id>/finalize"""
+    payload = request.get_json(silent=True) or request.form
+    session_id = (payload.get("session_id") or "").strip()
+    if not session_id:
+        return jsonify({"success": True, "message": "Batch is now handled automatically in upload"}), 200
+    try:
+        return _finalize_upload_session(session_id)
+    except Exception as e:
+        return jsonify({"error": "服务器内部错误", "details": str(e)}), 500
 
-# ===================== AI 抠图相关 (保持不变) =====================
+# ===================== AI 抠图相关 =====================
 
 def call_clipdrop_remove_bg(image):
     api_key = os.getenv("CLIPDROP_API_KEY", "").strip()
@@ -799,7 +3947,7 @@ def call_clipdrop_remove_bg(image):
     url = "https://clipdrop-api.co/remove-background/v1"
     headers = {"x-api-key": api_key}
     files = {"image_file": (image.filename, image.stream, image.mimetype)}
-    r = requests.post(url, headers=headers, files=files, timeout=60)
+    r = http_session("clipdrop").post(url, headers=headers, files=files, timeout=http_timeout("clipdrop"))
     if r.status_code != 200:
         raise Exception(f"Clipdrop error: {r.status_code}")
     return r.content
@@ -812,7 +3960,7 @@ def call_removebg_remove_bg(image):
     headers = {"X-Api-Key": api_key}
     files = {"image_file": (image.filename, image.stream, image.mimetype)}
     data = {"size": "auto"}
-    r = requests.post(url, headers=headers, files=files, data=data, timeout=60)
+    r = http_session("removebg").post(url, headers=headers, files=files, data=data, timeout=http_timeout("removebg"))
     if r.status_code != 200:
         raise Exception(f"Removebg error: {r.status_code}")
     return r.content
@@ -829,11 +3977,136 @@ def call_custom_remove_bg(image):
     if api_key:
         headers[auth_header] = f"{auth_prefix}{api_key}"
     files = {file_field: (image.filename, image.stream, image.mimetype)}
-    r = requests.post(custom_url, headers=headers, files=files, timeout=90)
+    r = http_session("custom_ai").post(custom_url, headers=headers, files=files, timeout=http_timeout("custom_ai"))
     if r.status_code != 200:
         raise Exception(f"Custom AI error: {r.status_code}")
     return r.content
 
+# ===== AI 抠图：结果缓存 + 熔断 + 对冲请求 =====
+# - 结果按图片内容 sha256 缓存在内存（LRU，总大小上限 AI_CUTOUT_CACHE_MB），同一张图不重复付费
+# - 每个服务商一个熔断器：连续失败 AI_BREAKER_FAILURES 次后跳过 AI_BREAKER_RESET 秒，之后放行一次试探
+# - 默认模式：先请求一个服务商，超过 AI_HEDGE_AFTER 秒未返回（或失败）再并行请求下一个，取先成功的
+AI_CUTOUT_CACHE_MB = float((os.getenv("AI_CUTOUT_CACHE_MB", "64") or "64").strip())
+AI_BREAKER_FAILURES = int((os.getenv("AI_BREAKER_FAILURES", "3") or "3").strip())
+AI_BREAKER_RESET = float((os.getenv("AI_BREAKER_RESET", "60") or "60").strip())
+AI_HEDGE_AFTER = float((os.getenv("AI_HEDGE_AFTER", "5") or "5").strip())
+
+class LRUBytesCache:
+    """按总字节数限制大小的 LRU 缓存（线程安全）"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+class CircuitBreaker:
+    """closed -> 连续失败达到阈值 -> open（直接跳过）-> 冷却结束 -> half-open（放行一个请求试探）"""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at < AI_BREAKER_RESET or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.opened_at is not None or self.failures >= AI_BREAKER_FAILURES:
+                self.opened_at = time.time()
+
+_ai_cutout_cache = LRUBytesCache(AI_CUTOUT_CACHE_MB * 1024 * 1024)
+_ai_breakers = {name: CircuitBreaker(name) for name in ("clipdrop", "removebg", "custom_ai")}
+
+def _call_ai_provider(name, fn, image):
+    """经过熔断器调用服务商；熔断中直接报错，不发请求"""
+    breaker = _ai_breakers[name]
+    if not breaker.allow():
+        raise Exception(f"{name} 已熔断（连续失败），暂时跳过")
+    try:
+        result = fn(image)
+    except Exception:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
+    return result
+
+def _ai_cutout_hedged(candidates, image):
+    """
+    candidates: [(name, fn)]，依次启动；上一个超过 AI_HEDGE_AFTER 秒未返回或已失败时启动下一个。
+    每个服务商使用独立的文件副本。返回 (png bytes, 服务商)，全部失败时抛出汇总的错误。
+    """
+    def run(name, fn, copy):
+        try:
+            return _call_ai_provider(name, fn, copy)
+        finally:
+            copy.close()
+
+    pool = ContextThreadPoolExecutor(max_workers=len(candidates))
+    futures = {}
+    errors = []
+    try:
+        pending = list(candidates)
+        while pending or futures:
+            if pending:
+                name, fn = pending.pop(0)
+                futures[pool.submit(run, name, fn, _spool_upload(image))] = name
+            done, _ = wait(futures, timeout=AI_HEDGE_AFTER if pending else None, return_when=FIRST_COMPLETED)
+            for fut in done:
+                name = futures.pop(fut)
+                try:
+                    return fut.result(), name
+                except Exception as e:
+                    errors.append(f"{name}: {e}")
+        raise Exception("；".join(errors) or "没有可用的 AI 服务")
+    finally:
+        # 不等待落后的请求：其结果只用于熔断统计
+        pool.shutdown(wait=False)
+
+def _ai_cutout_response(data, provider, cache_status):
+    resp = Response(data, mimetype="image/png")
+    resp.headers["X-Cache"] = cache_status
+    if provider:
+        resp.headers["X-AI-Provider"] = provider
+    return resp
+
 @app.route("/api/ai_cutout", methods=["POST"])
 def api_ai_cutout_default():
     try:
@@ -842,20 +4115,27 @@ def api_ai_cutout_default():
             return jsonify({"error": "缺少图片"}), 400
         candidates = []
         if os.getenv("CLIPDROP_API_KEY", "").strip():
-            candidates.append(call_clipdrop_remove_bg)
+            candidates.append(("clipdrop", call_clipdrop_remove_bg))
         if os.getenv("REMOVEBG_API_KEY", "").strip():
-            candidates.append(call_removebg_remove_bg)
+            candidates.append(("removebg", call_removebg_remove_bg))
         if not candidates:
             return jsonify({"error": "默认AI未配置"}), 500
+
+        cache_key = ("default", _stream_sha256(image.stream))
+        cached = _ai_cutout_cache.get(cache_key)
+        if cached is not None:
+            return _ai_cutout_response(cached, None, "HIT")
+
         random.shuffle(candidates)
-        last_err = None
-        for fn in candidates:
-            try:
-                return Response(fn(image), mimetype="image/png")
-            except Exception as e:
-                last_err = str(e)
-                continue
-        return jsonify({"error": "AI抠图全失败", "details": last_err}), 500
+        # 熔断中的服务商排到最后（全部熔断时仍按顺序尝试，由熔断器直接报错）
+        candidates = [c for c in candidates if not _ai_breakers[c[0]].opened_at] + \
+                     [c for c in candidates if _ai_breakers[c[0]].opened_at]
+        try:
+            data, provider = _ai_cutout_hedged(candidates, image)
+        except Exception as e:
+            return jsonify({"error": "AI抠图全失败", "details": str(e)}), 500
+        _ai_cutout_cache.put(cache_key, data)
+        return _ai_cutout_response(data, provider, "MISS")
     except Exception as e:
         return jsonify({"error": "AI抠图失败", "details": str(e)}), 500
 
@@ -889,7 +4169,13 @@ def api_ai_cutout_custom():
         image = request.files.get("image")
         if not image:
             return jsonify({"error": "缺少图片"}), 400
-        return Response(call_custom_remove_bg(image), mimetype="image/png")
+        cache_key = ("custom_ai", _stream_sha256(image.stream))
+        cached = _ai_cutout_cache.get(cache_key)
+        if cached is not None:
+            return _ai_cutout_response(cached, None, "HIT")
+        data = _call_ai_provider("custom_ai", call_custom_remove_bg, image)
+        _ai_cutout_cache.put(cache_key, data)
+        return _ai_cutout_response(data, "custom_ai", "MISS")
     except Exception as e:
         return jsonify({"error": "自定义AI失败", "details": str(e)}), 500
 
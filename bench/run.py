@@ -0,0 +1,238 @@
+"""
+离线压测：用本地替身服务器（bench/stubs.py）代替 GitHub / PICUI / 各图床，通过 Flask test client 驱动 api/index.py。
+
+    python bench/run.py                                  # 默认：100 / 1000 / 10000 / 50000 条图标
+    python bench/run.py --sizes 100,5000 --requests 50 --concurrency 8
+    python bench/run.py --profile picui=latency_ms=300,error_rate=0.05 --profile github=rate_limit=20
+    python bench/run.py --json result.json               # 同时输出 JSON，方便对比回归
+
+每个场景输出 p50/p95/p99 延迟、吞吐、非 2xx 数量，以及期间各上游收到的请求次数。
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stubs import StubProfile, StubState, start_stub_server  # noqa: E402
+
+DEFAULT_PROFILES = {
+    "github": "latency_ms=80,jitter_ms=30",
+    "picui": "latency_ms=150,jitter_ms=50",
+    "picgo": "latency_ms=150,jitter_ms=50",
+    "imgurl": "latency_ms=150,jitter_ms=50",
+    "removebg": "latency_ms=800,jitter_ms=200",
+    "clipdrop": "latency_ms=800,jitter_ms=200",
+}
+SCENARIOS = ("icons", "upload", "admin_images", "admin_delete")
+
+class StubAdapter(HTTPAdapter):
+    """把 https://<host>/<path> 改写为 <替身地址>/<host>/<path>，其余（连接池、重试）保持原配置"""
+
+    def __init__(self, base_url, **kwargs):
+        self.base_url = base_url
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        request.url = f"{self.base_url}/{parts.netloc}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+        return super().send(request, **kwargs)
+
+def load_app(base_url, service):
+    """设置好环境变量后再导入 api/index.py（模块级常量在导入时读取）"""
+    defaults = {
+        "GIST_ID": "benchgist",
+        "GITHUB_USER": "bench",
+        "GITHUB_TOKEN": "bench-token",
+        "UPLOAD_SERVICE": service,
+        "PICUI_TOKEN": "bench-token",
+        "PICGO_API_KEY": "bench-key",
+        "IMGURL_API_UID": "bench",
+        "IMGURL_API_TOKEN": "bench-token",
+        "GITHUB_REPO": "bench/icons",
+        "ADMIN_ENABLED": "1",
+        "ADMIN_PASSWORD": "bench",
+        "HTTP_BACKOFF_FACTOR": "0.05",
+        "PICUI_MIRROR_PATH": os.path.join(tempfile.gettempdir(), f"bench-picui-mirror-{os.getpid()}.json"),
+    }
+    for k, v in defaults.items():
+        os.environ.setdefault(k, v)
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api"))
+    import index
+
+    for backend in index.HTTP_TIMEOUT_DEFAULTS:
+        session = index.http_session(backend)
+        old = session.get_adapter("https://")
+        adapter = StubAdapter(
+            base_url, pool_connections=1, pool_maxsize=index.HTTP_POOL_SIZE, max_retries=old.max_retries
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+    return index
+
+def flush_journal(index):
+    """开启了写入日志（CATALOG_JOURNAL=1）时，把积压写入替身 Gist"""
+    store = index.catalog_store()
+    if isinstance(store, index.JournaledCatalogStore):
+        store.flush()
+
+def reset_app_state(index):
+    """切换目录规模时清空进程内缓存，保证每轮从冷启动开始"""
+    index._invalidate_gist_cache()
+    index._github_repo_dir_cache.clear()
+    index.picui_mirror.clear()
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+def run_scenario(client_factory, make_request, n_requests, concurrency):
+    """并发执行 n_requests 次 make_request(client, i)，返回延迟/吞吐统计"""
+    latencies = []
+    errors = 0
+
+    def one(i):
+        client = client_factory()
+        start = time.perf_counter()
+        status = make_request(client, i)
+        return time.perf_counter() - start, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for seconds, status in pool.map(one, range(n_requests)):
+            latencies.append(seconds * 1000)
+            if not 200 <= status < 300 and status != 304:
+                errors += 1
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": n_requests,
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+        "throughput_rps": round(n_requests / wall, 2) if wall else 0.0,
+        "errors": errors,
+    }
+
+def call_delta(before, after):
+    return {k: after[k] - before.get(k, 0) for k in sorted(after) if after[k] - before.get(k, 0)}
+
+def fake_png(seed: int):
+    # 内容各不相同，避免被上传去重（UPLOAD_DEDUP）合并
+    return b"\x89PNG\r\n\x1a\n" + seed.to_bytes(8, "big") + os.urandom(2048)
+
+def bench_size(index, state, size, args):
+    import io
+
+    flush_journal(index)  # 上一轮的积压写入旧数据，不带入新一轮
+    state.seed(size)
+    reset_app_state(index)
+    admin = index.app.test_client()
+    admin.environ_base["wsgi.url_scheme"] = "https"  # 管理 Cookie 带 Secure
+    r = admin.post("/api/admin/login", json={"password": os.environ["ADMIN_PASSWORD"]})
+    if r.status_code != 200:
+        raise SystemExit(f"管理后台登录失败：{r.status_code} {r.get_data(as_text=True)}")
+
+    def client_factory():
+        return admin
+
+    counter = iter(range(10 ** 9))
+
+    def req_icons(client, i):
+        return client.get("/icons.json").status_code
+
+    def req_upload(client, i):
+        files = [(io.BytesIO(fake_png(next(counter))), f"bench{i}_{j}.png") for j in range(args.batch)]
+        return client.post("/api/upload", data={"source": files}, content_type="multipart/form-data").status_code
+
+    def req_admin_images(client, i):
+        return client.get(f"/api/admin/images?page={1 + i % 5}").status_code
+
+    with state.picui_lock:
+        victims = list(state.picui.items())[-(args.requests * args.batch):]
+
+    def req_admin_delete(client, i):
+        items = [{"key": k, "url": u} for k, u in victims[i * args.batch:(i + 1) * args.batch]]
+        if not items:
+            return 200
+        return client.post("/api/admin/delete", json={"items": items}).status_code
+
+    requests_by_name = {
+        "icons": req_icons,
+        "upload": req_upload,
+        "admin_images": req_admin_images,
+        "admin_delete": req_admin_delete,
+    }
+    results = {}
+    for name in args.scenarios:
+        before = state.snapshot_calls()
+        stats = run_scenario(client_factory, requests_by_name[name], args.requests, args.concurrency)
+        stats["outbound_calls"] = call_delta(before, state.snapshot_calls())
+        results[name] = stats
+    return results
+
+def print_table(report):
+    header = f"{'size':>7} {'scenario':<13} {'n':>5} {'p50ms':>9} {'p95ms':>9} {'p99ms':>9} {'req/s':>8} {'err':>4}  outbound calls"
+    print(header)
+    print("-" * len(header))
+    for size, scenarios in report.items():
+        for name, st in scenarios.items():
+            calls = ", ".join(f"{k}={v}" for k, v in st["outbound_calls"].items())
+            print(
+                f"{size:>7} {name:<13} {st['requests']:>5} {st['p50_ms']:>9} {st['p95_ms']:>9} {st['p99_ms']:>9} "
+                f"{st['throughput_rps']:>8} {st['errors']:>4}  {calls}"
+            )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="api/index.py 离线压测（本地替身上游）")
+    parser.add_argument("--sizes", default="100,1000,10000,50000", help="目录规模（图标条数），逗号分隔")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"场景，逗号分隔：{', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=20, help="每个场景的请求数")
+    parser.add_argument("--concurrency", type=int, default=4, help="并发客户端数")
+    parser.add_argument("--batch", type=int, default=5, help="每次上传/删除的文件数")
+    parser.add_argument("--service", default="PICUI", choices=("PICUI", "PICGO", "IMGURL", "GITHUB"), help="UPLOAD_SERVICE")
+    parser.add_argument(
+        "--profile", action="append", default=[],
+        help="上游配置，如 picui=latency_ms=300,jitter_ms=50,error_rate=0.05,rate_limit=20（可重复）",
+    )
+    parser.add_argument("--json", dest="json_path", help="把结果写入 JSON 文件")
+    args = parser.parse_args(argv)
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景：{', '.join(sorted(unknown))}")
+
+    specs = dict(DEFAULT_PROFILES)
+    for item in args.profile:
+        name, _, spec = item.partition("=")
+        specs[name.strip()] = spec
+    state = StubState(profiles={name: StubProfile.parse(spec) for name, spec in specs.items()})
+    server, base_url = start_stub_server(state)
+    index = load_app(base_url, args.service)
+
+    report = {}
+    try:
+        for size in [int(x) for x in args.sizes.split(",") if x.strip()]:
+            report[size] = bench_size(index, state, size, args)
+            print(f"完成：{size} 条图标", file=sys.stderr)
+    finally:
+        flush_journal(index)
+        server.shutdown()
+
+    print_table(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": report}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
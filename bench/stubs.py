@@ -0,0 +1,397 @@
+"""
+本地替身服务器：模拟 api/index.py 会调用的第三方接口，用于离线压测（不消耗真实配额）。
+
+一个 HTTP 服务承载所有上游，路径的第一段是被替换的原始主机名，例如：
+    https://api.github.com/gists/xxx  ->  http://127.0.0.1:<port>/api.github.com/gists/xxx
+
+每个上游有独立的延迟 / 错误率 / 限流配置（StubProfile），并统计收到的请求次数。
+"""
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# 原始主机名 -> 上游名称（与 api/index.py 的 http_session 名称一致）
+HOST_UPSTREAMS = {
+    "api.github.com": "github",
+    "gist.githubusercontent.com": "github",
+    "picui.cn": "picui",
+    "www.picgo.net": "picgo",
+    "www.imgurl.org": "imgurl",
+    "api.remove.bg": "removebg",
+    "clipdrop-api.co": "clipdrop",
+}
+
+# Gist API 对超过 1MB 的文件返回 truncated=true，需要走 raw_url
+GIST_TRUNCATE_BYTES = 1024 * 1024
+
+class StubProfile:
+    """延迟（毫秒，均值 ± 抖动）、错误率（返回 503）、限流（每秒请求数，超出返回 429）"""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, rate_limit=0.0):
+        self.latency_ms = float(latency_ms)
+        self.jitter_ms = float(jitter_ms)
+        self.error_rate = float(error_rate)
+        self.rate_limit = float(rate_limit)
+        self._lock = threading.Lock()
+        self._tokens = self.rate_limit
+        self._refilled_at = time.monotonic()
+
+    @classmethod
+    def parse(cls, spec: str):
+        """'latency_ms=120,jitter_ms=40,error_rate=0.02,rate_limit=30'"""
+        kwargs = {}
+        for part in (spec or "").split(","):
+            if part.strip():
+                k, _, v = part.partition("=")
+                kwargs[k.strip()] = float(v)
+        return cls(**kwargs)
+
+    def delay(self):
+        if self.latency_ms or self.jitter_ms:
+            ms = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+            time.sleep(max(0.0, ms) / 1000.0)
+
+    def throttled(self):
+        if self.rate_limit <= 0:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled_at) * self.rate_limit)
+            self._refilled_at = now
+            if self._tokens < 1:
+                return True
+            self._tokens -= 1
+            return False
+
+    def failed(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+class GistState:
+    """单个 Gist：文件内容 + 版本历史（最新在前），支持 ETag"""
+
+    def __init__(self, gist_id, files):
+        self.gist_id = gist_id
+        self.lock = threading.Lock()
+        self.versions = []  # [(version, {name: content})]
+        self.updated_at = {}  # version -> ISO 8601 时间（与 GitHub 的 updated_at 格式一致）
+        self._commit(dict(files))
+
+    def _commit(self, files):
+        version = os.urandom(20).hex()
+        self.versions.append((version, files))
+        self.updated_at[version] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+    @property
+    def etag(self):
+        return f'"{self.versions[-1][0]}"'
+
+    def doc(self, version=None, base_url=""):
+        with self.lock:
+            idx = len(self.versions) - 1
+            if version is not None:
+                idx = next((i for i, (v, _) in enumerate(self.versions) if v == version), None)
+                if idx is None:
+                    return None
+            ver, files = self.versions[idx]
+            history = [{"version": v} for v, _ in reversed(self.versions[:idx + 1])]
+        out = {}
+        for name, content in files.items():
+            truncated = len(content.encode("utf-8")) > GIST_TRUNCATE_BYTES
+            out[name] = {
+                "filename": name,
+                "content": content[:GIST_TRUNCATE_BYTES] if truncated else content,
+                "truncated": truncated,
+                "raw_url": f"https://gist.githubusercontent.com/bench/{self.gist_id}/raw/{ver}/{name}",
+            }
+        return {"id": self.gist_id, "files": out, "history": history, "updated_at": self.updated_at[ver]}
+
+    def raw(self, version, name):
+        with self.lock:
+            files = dict(self.versions).get(version) or {}
+        return files.get(name)
+
+    def patch(self, updates):
+        """应用更新并返回更新后的文档（同一把锁内完成，与 GitHub 一样 history[1] 一定是被覆盖的版本）"""
+        with self.lock:
+            files = dict(self.versions[-1][1])
+            for name, f in (updates or {}).items():
+                if f is None:
+                    files.pop(name, None)
+                else:
+                    files[name] = f.get("content", "")
+            self._commit(files)
+            version = self.versions[-1][0]
+        return self.doc(version=version)
+
+class StubState:
+    """所有替身上游的共享状态"""
+
+    def __init__(self, gist_id="benchgist", profiles=None):
+        self.gist_id = gist_id
+        self.profiles = profiles or {}
+        self.gist = GistState(gist_id, {"icons.json": json.dumps({"icons": []})})
+        self.picui = {}  # key -> url（保持插入顺序，按页列出）
+        self.picui_lock = threading.Lock()
+        self.repo_files = set()  # GitHub 仓库分支 head 中的路径
+        self.repo_objects = {}  # sha -> tree（路径集合）/ commit（{"tree", "parents"}），Git Data API 用
+        self.repo_head = None  # 分支当前 commit；Contents API 写入后置空，下次读取分支时重新生成
+        self.repo_lock = threading.Lock()
+        self.calls = {}  # "upstream METHOD 路由" -> 次数
+        self.calls_lock = threading.Lock()
+
+    def profile(self, upstream):
+        profile = self.profiles.get(upstream)
+        if profile is None:
+            profile = self.profiles[upstream] = StubProfile()
+        return profile
+
+    def count(self, key):
+        with self.calls_lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def snapshot_calls(self):
+        with self.calls_lock:
+            return dict(self.calls)
+
+    def seed(self, n_icons):
+        """生成 n 条图标：Gist 里的 icons.json 与 PICUI 图片列表一一对应（旧版未分片格式）"""
+        icons = []
+        picui = {}
+        for i in range(n_icons):
+            key = f"seed{i:06d}"
+            url = f"https://img.bench.local/{key}.png"
+            icons.append({"name": f"icon{i}", "url": url})
+            picui[key] = url
+        self.gist = GistState(self.gist_id, {"icons.json": json.dumps({"name": "bench", "icons": icons}, indent=2)})
+        with self.picui_lock:
+            self.picui = picui
+        with self.repo_lock:
+            self.repo_files = set()
+            self.repo_objects = {}
+            self.repo_head = None
+
+    # ----- GitHub 仓库（Contents API + Git Data API）-----
+    def _repo_object(self, obj):
+        sha = os.urandom(20).hex()
+        self.repo_objects[sha] = obj
+        return sha
+
+    def repo_put_file(self, rel):
+        """Contents API 创建文件；已存在返回 False（未带 sha 的 PUT 会被拒绝）"""
+        with self.repo_lock:
+            if rel in self.repo_files:
+                return False
+            self.repo_files.add(rel)
+            self.repo_head = None
+            return True
+
+    def repo_ref(self):
+        with self.repo_lock:
+            if self.repo_head is None:
+                tree = self._repo_object(frozenset(self.repo_files))
+                self.repo_head = self._repo_object({"tree": tree, "parents": []})
+            return self.repo_head
+
+    def repo_commit(self, sha):
+        with self.repo_lock:
+            obj = self.repo_objects.get(sha)
+            return obj if isinstance(obj, dict) else None
+
+    def repo_paths(self, ref):
+        """某个 commit 的路径集合；不认识的 ref（如分支名）按当前 head 处理"""
+        with self.repo_lock:
+            commit = self.repo_objects.get(ref)
+            if isinstance(commit, dict):
+                return self.repo_objects[commit["tree"]]
+            return frozenset(self.repo_files)
+
+    def repo_create_tree(self, base_tree, paths):
+        with self.repo_lock:
+            base = self.repo_objects.get(base_tree) if base_tree else frozenset()
+            if not isinstance(base, frozenset):
+                return None
+            return self._repo_object(base | frozenset(paths))
+
+    def repo_create_commit(self, tree, parents):
+        with self.repo_lock:
+            if not isinstance(self.repo_objects.get(tree), frozenset):
+                return None
+            return self._repo_object({"tree": tree, "parents": list(parents or ())})
+
+    def repo_update_ref(self, sha, force=False):
+        """只允许快进（新 commit 的父提交就是当前 head），否则与 GitHub 一样返回 False -> 422"""
+        with self.repo_lock:
+            commit = self.repo_objects.get(sha)
+            if not isinstance(commit, dict):
+                return False
+            if not force and (self.repo_head is None or self.repo_head not in commit["parents"]):
+                return False
+            self.repo_head = sha
+            self.repo_files = set(self.repo_objects[commit["tree"]])
+            return True
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None  # StubState，由 start_stub_server 绑定
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _dispatch(self):
+        parts = urlsplit(self.path)
+        host, _, path = parts.path.lstrip("/").partition("/")
+        path = "/" + path
+        upstream = HOST_UPSTREAMS.get(host, host)
+        body = self._body()
+        profile = self.state.profile(upstream)
+        profile.delay()
+        if profile.throttled():
+            self.state.count(f"{upstream} {self.command} 429")
+            return self._send(429, {"message": "rate limited"}, headers={"Retry-After": "1"})
+        if profile.failed():
+            self.state.count(f"{upstream} {self.command} 503")
+            return self._send(503, {"message": "injected failure"})
+
+        handler = getattr(self, f"_{upstream}", None)
+        if handler is None:
+            return self._send(404, {"message": f"unknown upstream {host}"})
+        route, status, payload, extra = handler(host, path, parse_qs(parts.query), body)
+        self.state.count(f"{upstream} {self.command} {route}")
+        content_type = "image/png" if isinstance(payload, bytes) else "application/json"
+        self._send(status, payload if payload is not None else b"", content_type, extra)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+    # ----- GitHub：Gist + 仓库 Contents / Git Data API（blob、tree、commit、ref）-----
+    def _github(self, host, path, query, body):
+        st = self.state
+        seg = [unquote(p) for p in path.strip("/").split("/")]
+        if host == "gist.githubusercontent.com":
+            # /<user>/<gist_id>/raw/<version>/<file>
+            content = st.gist.raw(seg[3], seg[4]) if len(seg) >= 5 else None
+            return "gist raw", (200 if content is not None else 404), (content or "").encode("utf-8"), None
+        if seg[0] == "gists":
+            if self.command == "PATCH":
+                doc = st.gist.patch((json.loads(body or b"{}")).get("files"))
+                return "gist patch", 200, doc, {"ETag": f'"{doc["history"][0]["version"]}"'}
+            if len(seg) >= 3:
+                doc = st.gist.doc(version=seg[2])
+                return "gist revision", (200 if doc else 404), doc or {"message": "Not Found"}, None
+            if self.headers.get("If-None-Match") == st.gist.etag:
+                return "gist get 304", 304, None, {"ETag": st.gist.etag}
+            return "gist get", 200, st.gist.doc(), {"ETag": st.gist.etag}
+        if seg[0] == "repos" and len(seg) >= 4:
+            if seg[3] == "contents" and self.command == "PUT":
+                rel = "/".join(seg[4:])
+                if not st.repo_put_file(rel):
+                    return "contents put", 422, {"message": "Invalid request. \"sha\" wasn't supplied."}, None
+                return "contents put", 201, {"content": {"path": rel}}, None
+            data = json.loads(body or b"{}") if self.command in ("POST", "PATCH") else {}
+            if seg[3:5] == ["git", "blobs"] and self.command == "POST":
+                return "git blobs", 201, {"sha": os.urandom(20).hex()}, None
+            if seg[3:5] == ["git", "ref"]:
+                return "git ref", 200, {"object": {"type": "commit", "sha": st.repo_ref()}}, None
+            if seg[3:5] == ["git", "commits"]:
+                if self.command == "POST":
+                    sha = st.repo_create_commit(data.get("tree"), data.get("parents"))
+                    if sha is None:
+                        return "git commits post", 422, {"message": "Tree SHA does not exist"}, None
+                    return "git commits post", 201, {"sha": sha}, None
+                commit = st.repo_commit(seg[5] if len(seg) > 5 else "")
+                if commit is None:
+                    return "git commits", 404, {"message": "Not Found"}, None
+                return "git commits", 200, {"sha": seg[5], "tree": {"sha": commit["tree"]}, "parents": commit["parents"]}, None
+            if seg[3:5] == ["git", "refs"] and self.command == "PATCH":
+                if not st.repo_update_ref(data.get("sha"), force=bool(data.get("force"))):
+                    return "git refs patch", 422, {"message": "Update is not a fast forward"}, None
+                return "git refs patch", 200, {"object": {"type": "commit", "sha": data.get("sha")}}, None
+            if seg[3:5] == ["git", "trees"] and self.command == "POST":
+                sha = st.repo_create_tree(data.get("base_tree"), [e["path"] for e in data.get("tree") or ()])
+                if sha is None:
+                    return "git trees post", 422, {"message": "base_tree is not a valid tree"}, None
+                return "git trees post", 201, {"sha": sha}, None
+            if seg[3:5] == ["git", "trees"]:
+                ref, _, repo_dir = "/".join(seg[5:]).partition(":")
+                prefix = repo_dir.strip("/") + "/" if repo_dir else ""
+                paths = st.repo_paths(ref)
+                if prefix and not any(p.startswith(prefix) for p in paths):
+                    return "git trees", 404, {"message": "Not Found"}, None
+                names = [p[len(prefix):] for p in paths if p.startswith(prefix) and "/" not in p[len(prefix):]]
+                return "git trees", 200, {"tree": [{"path": n, "type": "blob"} for n in names]}, None
+        return "unknown", 404, {"message": "Not Found"}, None
+
+    # ----- 图床 -----
+    def _new_image(self):
+        key = os.urandom(8).hex()
+        url = f"https://img.bench.local/{key}.png"
+        with self.state.picui_lock:
+            self.state.picui[key] = url
+        return key, url
+
+    def _picui(self, host, path, query, body):
+        st = self.state
+        if path == "/api/v1/upload" and self.command == "POST":
+            key, url = self._new_image()
+            return "upload", 200, {"status": True, "data": {"key": key, "links": {"url": url}}}, None
+        if path == "/api/v1/images" and self.command == "GET":
+            page = int((query.get("page") or ["1"])[0])
+            per_page = 40
+            with st.picui_lock:
+                items = list(st.picui.items())
+            rows = items[(page - 1) * per_page: page * per_page]
+            data = {
+                "data": [{"key": k, "links": {"url": u}} for k, u in rows],
+                "current_page": page,
+                "per_page": per_page,
+                "last_page": max(1, (len(items) + per_page - 1) // per_page),
+                "total": len(items),
+            }
+            return "list", 200, {"status": True, "data": data}, None
+        if path.startswith("/api/v1/images/") and self.command == "DELETE":
+            key = unquote(path.rsplit("/", 1)[1])
+            with st.picui_lock:
+                found = st.picui.pop(key, None) is not None
+            return "delete", (200 if found else 404), {"status": found}, None
+        return "unknown", 404, {"message": "Not Found"}, None
+
+    def _picgo(self, host, path, query, body):
+        _, url = self._new_image()
+        return "upload", 200, {"image": {"url": url}}, None
+
+    def _imgurl(self, host, path, query, body):
+        _, url = self._new_image()
+        return "upload", 200, {"data": {"url": url}}, None
+
+    # ----- AI 抠图：原样返回一个固定的 PNG 头 -----
+    def _removebg(self, host, path, query, body):
+        return "removebg", 200, b"\x89PNG\r\n\x1a\nstub", None
+
+    def _clipdrop(self, host, path, query, body):
+        return "clipdrop", 200, b"\x89PNG\r\n\x1a\nstub", None
+
+def start_stub_server(state, host="127.0.0.1", port=0):
+    """在后台线程启动替身服务器，返回 (server, base_url)"""
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
@@ -0,0 +1,27 @@
+"""
+测试共用：与 bench/run.py 一样，用本地替身服务器（bench/stubs.py）代替 GitHub / PICUI，离线驱动 api/index.py。
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+from run import load_app, reset_app_state  # noqa: E402
+from stubs import StubState, start_stub_server  # noqa: E402
+
+@pytest.fixture(scope="session")
+def stub():
+    state = StubState()
+    server, base_url = start_stub_server(state)
+    yield state, base_url
+    server.shutdown()
+
+@pytest.fixture
+def index(stub):
+    """每个测试从空目录开始"""
+    state, base_url = stub
+    module = load_app(base_url, "PICUI")
+    state.seed(0)
+    reset_app_state(module)
+    return module
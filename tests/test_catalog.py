@@ -0,0 +1,81 @@
+def test_gist_conflict_replays_add_then_remove_in_order(index, monkeypatch):
+    """A 读取后、写入前，B 先追加再删除同一条；A 冲突重放后这条不能复活"""
+    stale = index.get_gist_snapshot(request_cache=False)
+
+    index.gist_write(append_items=[{"name": "other", "url": "https://b/1.png"}])
+    index.gist_write(remove_urls={"https://b/1.png"})
+
+    real = index.get_gist_snapshot
+    calls = []
+
+    def first_read_is_stale(request_cache=True):
+        calls.append(request_cache)
+        return stale if len(calls) == 1 else real(request_cache)
+
+    monkeypatch.setattr(index, "get_gist_snapshot", first_read_is_stale)
+    index.gist_write(append_items=[{"name": "mine", "url": "https://a/1.png"}])
+    monkeypatch.undo()
+
+    index._invalidate_gist_cache()
+    urls = [icon["url"] for icon in index.get_gist_snapshot(request_cache=False).catalog(index.GIST_FILE_NAME).icons]
+    assert urls == ["https://a/1.png"]
+
+def _journal_scenario(index, inner, root):
+    """刷出后底层目录里的名字必须与写入日志当时返回给客户端的一致"""
+    inner.write(index.GIST_FILE_NAME, append_items=[{"name": "a", "url": "https://x/z.png"}])
+    journal = index.JournaledCatalogStore(inner, str(root))
+    acked = {}
+    for result in (
+        journal.write(append_items=[{"name": "a", "url": "https://x/1.png"}]),  # a 已被占用 -> a1
+        journal.write(remove_urls={"https://x/z.png"}),
+        journal.write(append_items=[{"name": "a", "url": "https://x/2.png"}]),  # a 已释放 -> a
+        journal.write(remove_urls={"https://x/1.png"}),
+        journal.write(append_items=[{"name": "b", "url": "https://x/1.png"}]),  # 同一 URL 先删后加
+    ):
+        acked.update({icon["url"]: icon["name"] for icon in result["saved"]})
+    journal.flush()
+    names = {icon["url"]: icon["name"] for icon in inner.catalog(index.GIST_FILE_NAME).icons}
+    assert names == acked == {"https://x/1.png": "b", "https://x/2.png": "a"}
+
+def test_journal_flush_keeps_acknowledged_names_gist(index, tmp_path):
+    _journal_scenario(index, index.GistCatalogStore(), tmp_path)
+
+def test_journal_flush_keeps_acknowledged_names_sqlite(index, tmp_path):
+    _journal_scenario(index, index.SqliteCatalogStore(str(tmp_path / "catalog.sqlite3")), tmp_path / "journal")
+
+def test_sqlite_names_match_icon_catalog_after_deletes(index, tmp_path):
+    """同一串追加/删除，SQLite 与 IconCatalog（Gist 模式）分配的名字必须一致：删除空出的序号要被重新使用"""
+    import random
+
+    store = index.SqliteCatalogStore(str(tmp_path / "catalog.sqlite3"))
+    catalog = index.IconCatalog({"icons": []})
+    rng = random.Random(7)
+    live = []
+    steps = [("add", "icon")] * 4 + [("del", "icon2"), ("add", "icon"), ("del", "icon"), ("add", "icon")]
+    steps += [("del", "icon1"), ("del", "icon3"), ("add", "icon"), ("add", "icon"), ("add", "icon1")]
+    steps += [rng.choice([("add", "icon"), ("add", "icon1"), ("add", "a"), ("del", None)]) for _ in range(200)]
+    for n, (op, name) in enumerate(steps):
+        if op == "add":
+            item = {"name": name, "url": f"https://x/{n}.png"}
+            got = store.write(append_items=[item])["saved"]
+            want, _ = index._apply_gist_ops(catalog, [item], set(), replay=False)
+            assert got == want, (n, got, want)
+            live.append(item["url"])
+        elif live:
+            by_name = {icon["name"]: icon["url"] for icon in catalog.icons}
+            url = by_name.get(name) or rng.choice(live)
+            store.write(remove_urls={url})
+            index._apply_gist_ops(catalog, [], {url}, replay=False)
+            live.remove(url)
+    assert [(i["name"], i["url"]) for i in store.catalog().icons] == [(i["name"], i["url"]) for i in catalog.icons]
+
+def test_icons_json_last_modified_is_http_date(index):
+    """上游没有 Last-Modified 时用 Gist 的 updated_at，必须是 HTTP-date，If-Modified-Since 才能命中"""
+    from email.utils import parsedate_to_datetime
+
+    client = index.app.test_client()
+    r = client.get("/icons.json")
+    assert r.status_code == 200
+    parsedate_to_datetime(r.headers["Last-Modified"])
+    again = client.get("/icons.json", headers={"If-Modified-Since": r.headers["Last-Modified"]})
+    assert again.status_code == 304
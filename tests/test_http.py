@@ -0,0 +1,23 @@
+import pytest
+
+def test_writes_are_not_retried_on_5xx(index, stub, monkeypatch):
+    """PATCH / PUT 遇到 5xx 不重发（服务端可能已经执行）；GET 照常重试"""
+    from stubs import StubProfile
+
+    state, _ = stub
+    snapshot = index.get_gist_snapshot(request_cache=False)
+    real = index.get_gist_snapshot
+    monkeypatch.setattr(index, "get_gist_snapshot", lambda request_cache=True: snapshot)  # 写入前不再 GET
+    monkeypatch.setitem(state.profiles, "github", StubProfile(error_rate=1.0))
+    before = state.snapshot_calls()
+
+    with pytest.raises(Exception):
+        index.gist_write(append_items=[{"name": "a", "url": "https://x/a.png"}])
+    index._invalidate_gist_cache()
+    with pytest.raises(Exception):
+        real(request_cache=False)
+
+    after = state.snapshot_calls()
+    delta = {k: after.get(k, 0) - before.get(k, 0) for k in after}
+    assert delta.get("github PATCH 503") == 1
+    assert delta.get("github GET 503") == index.HTTP_MAX_RETRIES + 1
@@ -0,0 +1,35 @@
+import pytest
+import requests
+
+def _response(status, payload):
+    r = requests.Response()
+    r.status_code = status
+    r._content = requests.compat.json.dumps(payload).encode("utf-8")
+    return r
+
+def test_list_dir_missing_directory_is_empty(index):
+    assert index._github_repo_list_dir("bench", "icons", "main", "no/such/dir") == set()
+
+def test_list_dir_missing_ref_raises(index, monkeypatch):
+    monkeypatch.setattr(index, "_github_repo_request", lambda *a, **k: _response(404, {"message": "Not Found"}))
+    with pytest.raises(Exception):
+        index._github_repo_list_dir("bench", "icons", "no-such-branch", "icons")
+
+def test_list_dir_truncated_raises(index, monkeypatch):
+    payload = {"tree": [{"path": "a.png", "type": "blob"}], "truncated": True}
+    monkeypatch.setattr(index, "_github_repo_request", lambda *a, **k: _response(200, payload))
+    with pytest.raises(Exception):
+        index._github_repo_list_dir("bench", "icons", "main", "icons")
+
+def test_prune_refused_when_a_source_fails(index, monkeypatch):
+    index.gist_write(append_items=[{"name": "a", "url": "https://raw.githubusercontent.com/bench/icons/main/a.png"}])
+
+    def broken(folder):
+        raise Exception("HTTP 404")
+
+    monkeypatch.setattr(index, "_reconcile_list_github", broken)
+    scan = index.reconcile_scan()
+    assert all("error" in st for name, st in scan["sources"].items() if name.startswith("GITHUB"))
+    with pytest.raises(ValueError):
+        index.reconcile_repair("prune_dangling")
+    assert len(index.catalog_store().catalog(index.GIST_FILE_NAME).icons) == 1
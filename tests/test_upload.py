@@ -0,0 +1,47 @@
+import io
+import time
+
+def test_batch_names_follow_input_order(index, monkeypatch):
+    """并发上传按完成先后到达，同名文件的序号仍按输入顺序分配"""
+    index.gist_write(append_items=[{"name": "icon", "url": "https://x/0.png"}])
+    real = index.upload_to_picui
+
+    def reversed_finish(image):
+        seq = image.stream.read(1)[0]
+        image.stream.seek(0)
+        time.sleep(0.05 * (3 - seq))  # 先提交的最后完成
+        return real(image)
+
+    monkeypatch.setattr(index, "upload_to_picui", reversed_finish)
+    files = [(io.BytesIO(bytes([i]) + bytes(64)), "icon.png") for i in range(3)]
+    r = index.app.test_client().post("/api/upload", data={"source": files}, content_type="multipart/form-data")
+    assert [item["name"] for item in r.get_json()["results"]] == ["icon1", "icon2", "icon3"]
+
+def test_concurrent_session_pushes_share_repo_dir_index(index, stub, monkeypatch):
+    """GITHUB 模式下并发推送同名文件：共用目录索引挑出不同文件名，不靠 PUT 的 422 重试"""
+    import os
+    import threading
+
+    from stubs import StubProfile
+
+    state, _ = stub
+    monkeypatch.setenv("UPLOAD_SERVICE", "GITHUB")
+    monkeypatch.setitem(state.profiles, "github", StubProfile(latency_ms=30, jitter_ms=20))
+    client = index.app.test_client()
+    session_id = client.post("/api/upload/session", json={"name": "icon"}).get_json()["session_id"]
+    before = state.snapshot_calls()
+
+    def push(i):
+        files = [(io.BytesIO(bytes([i]) + os.urandom(64)), "icon.png")]
+        client.post(f"/api/upload/session/{session_id}", data={"source": files, "index": str(i)},
+                    content_type="multipart/form-data")
+
+    threads = [threading.Thread(target=push, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    puts = state.snapshot_calls().get("github PUT contents put", 0) - before.get("github PUT contents put", 0)
+    assert puts == 4
+    assert len(state.repo_files) == 4